@@ -4,6 +4,7 @@ from cmath import pi
 import numpy as np
 import GeometryFunctions as gf
 import LatticeDefinitions as ld
+import MiscFunctions as mf
 import scipy as sc
 from sklearn.neighbors import KDTree
 from sympy.parsing.sympy_parser import parse_expr
@@ -18,6 +19,20 @@ from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 from scipy import linalg
 
+dctConstraintKernels = dict() #lambdified constraints keyed by expression and variable strings so each is only compiled once per process
+
+def GetConstraintKernel(strFunction: str, strVariables = '[x,y,z]'):
+    tupKey = (strFunction, strVariables)
+    if tupKey not in dctConstraintKernels:
+        dctConstraintKernels[tupKey] = lambdify(parse_expr(strVariables), parse_expr(strFunction))
+    return dctConstraintKernels[tupKey]
+
+def EvaluateConstraint(strFunction: str, inPoints: np.array, strVariables = '[x,y,z]')->np.array: #evaluates the constraint over all the points in one numpy call
+    arrPoints = np.asarray(inPoints)
+    if len(arrPoints) == 0:
+        return np.zeros(0)
+    fnKernel = GetConstraintKernel(strFunction, strVariables)
+    return np.broadcast_to(fnKernel(arrPoints[:,0], arrPoints[:,1], arrPoints[:,2]), len(arrPoints)) #constant expressions return a scalar
 
 class PureCell(object):
     def __init__(self,inCellNodes: np.array): 
@@ -133,14 +148,12 @@ class PureLattice(PureCell):
     def GetLatticePoints(self):
         return self.__LatticePoints
     def MakeLatticePoints(self, inCellPoints):
-        arrLatticePoints = np.zeros([self.GetNumberOfNodesPerCell()*len(inCellPoints), self.Dimensions()])
-        intCounter = 0
         arrNodes = self.GetMinimalNodeMotif()
-        for position in inCellPoints:
-            for cell in arrNodes:
-                arrLatticePoints[intCounter] = np.add(position,cell)
-                intCounter +=1
-        return np.unique(arrLatticePoints, axis = 0)
+        arrLatticePoints = np.reshape(np.asarray(inCellPoints)[:,np.newaxis,:] + arrNodes[np.newaxis,:,:], (-1, self.Dimensions())) #each cell position followed by its nodes
+        arrLatticePoints = arrLatticePoints[np.lexsort(np.transpose(arrLatticePoints)[::-1])] #same rows and order as np.unique(axis=0) without the slow structured sort
+        if len(arrLatticePoints) > 1:
+            arrLatticePoints = arrLatticePoints[np.append(True, np.any(np.diff(arrLatticePoints, axis=0) != 0, axis=1))]
+        return arrLatticePoints
     def CheckLatticeConstraints(self,inPoints: np.array, fltTolerance=1e-5)-> np.array: #returns indices to delete   
         lstIndices = []
         for j in self.__LatticeConstraints:
@@ -244,7 +257,7 @@ class GeneralLattice(PureLattice,RealCell):
         self.__RealPoints = np.delete(self.__RealPoints, lstDeletedIndices, axis=0) 
     def GetRealPoints(self)->np.array: #if points on the boundary have been removed don't include them unless blnRemoved is set to false
         return self.__RealPoints
-    def MakeRealPoints(self, inClosedConstraints: np.array):
+    def MakeRealPoints(self, inClosedConstraints: np.array, intChunkSize = 2**16):
         #assumes constraints are closed (e.g. includes boundary points) To change this call
         #SetOpenConstraints(arrPositions) and an array of which constraints are open
         self.__LinearConstraints = inClosedConstraints
@@ -253,9 +266,15 @@ class GeneralLattice(PureLattice,RealCell):
         arrBounds[:,0] = np.floor(arrBounds[:,0]) -np.ones(self.Dimensions())
         arrBounds[:,1] = np.ceil(arrBounds[:,1]) +np.ones(self.Dimensions()) #add one extra lattice points in each 
         #abstract direction as using the minimal node motif
-        arrCellPoints = np.array(gf.CreateCuboidPoints(arrBounds))
-        arrLatticePoints = self.MakeLatticePoints(arrCellPoints)
-        arrLatticePoints = np.delete(arrLatticePoints, self.CheckLatticeConstraints(arrLatticePoints), axis = 0)
+        lstRanges = list(map(lambda x: np.arange(x[0], x[1]+1), arrBounds)) #the same cell positions as gf.CreateCuboidPoints
+        intLayerSize = int(np.prod(list(map(len, lstRanges[1:]))))*self.GetNumberOfNodesPerCell()
+        intLayers = max(1, intChunkSize // max(1, intLayerSize))
+        lstLatticePoints = []
+        for i in range(0, len(lstRanges[0]), intLayers): #only the points of a few layers of cells are held before the constraints are applied
+            arrCellPoints = np.reshape(np.stack(np.meshgrid(lstRanges[0][i:i+intLayers], *lstRanges[1:], indexing='ij'), axis=-1), (-1, self.Dimensions()))
+            arrLatticePoints = self.MakeLatticePoints(arrCellPoints)
+            lstLatticePoints.append(np.delete(arrLatticePoints, self.CheckLatticeConstraints(arrLatticePoints), axis = 0))
+        arrLatticePoints = np.concatenate(lstLatticePoints) #node motifs lie in [0,1) so the layers are already in np.unique order
         self.GenerateRealPoints(arrLatticePoints)
     def GenerateRealPoints(self, inLatticePoints = None):
         self.SetLatticePoints(inLatticePoints)
@@ -284,14 +303,9 @@ class GeneralLattice(PureLattice,RealCell):
         lstDeletedIndices = gf.CheckLinearEquality(self.__RealPoints, inPlane, 0.01)
         self.DeletePoints(lstDeletedIndices)
     def ApplyGeneralConstraint(self,strFunction, strVariables='[x,y,z]',fltTolerance = 1e-5, strDomain = ''): #default scalar value is less than or equal to 0 if "inside" the region
-        lstVariables = parse_expr(strVariables)
-        fltFunction = lambdify(lstVariables,parse_expr(strFunction))
-        arrFunction = lambda X : fltFunction(X[0],X[1],X[2])
-        arrLess = np.array(list(map(arrFunction, self.__RealPoints)))
+        arrLess = EvaluateConstraint(strFunction, self.__RealPoints, strVariables)
         if len(strDomain) >0 :
-            fltDomain = lambdify(lstVariables,parse_expr(strDomain))
-            arrDomain = lambda X : fltDomain(X[0],X[1],X[2])
-            arrDomain = np.array(list(map(arrDomain, self.__RealPoints)))
+            arrDomain = EvaluateConstraint(strDomain, self.__RealPoints, strVariables)
             lstDeletedIndices = np.where((arrLess > fltTolerance) & (arrDomain >= 0))[0]
         else:
             lstDeletedIndices = np.where(arrLess > fltTolerance)[0]
@@ -682,8 +696,16 @@ class SimulationCell(object):
                 fdata.write('{}  {} {} xy xz yz \n'.format(self.__xy,self.__xz,self.__yz))
             fdata.write('\n')
             fdata.write('Atoms\n\n')
-            for i in range(len(self.__AllAtomPositions)):
-                fdata.write('{} {} {} {} {}\n'.format(i+1,self.__AllAtomTypes[i].astype('int'), *self.__AllAtomPositions[i]))          
+            intAtoms = len(self.__AllAtomPositions)
+            if intAtoms > 0 and np.asarray(self.__AllAtomPositions).dtype == np.float64: #ids and types are exact as floats so one array can be formatted in chunks
+                arrRows = np.zeros([intAtoms, 5])
+                arrRows[:,0] = np.arange(1, intAtoms+1)
+                arrRows[:,1] = np.asarray(self.__AllAtomTypes).astype('int')
+                arrRows[:,2:] = self.__AllAtomPositions
+                mf.WriteFormattedRows(fdata, '%d %d %s %s %s\n', arrRows)
+            else:
+                for i in range(intAtoms):
+                    fdata.write('{} {} {} {} {}\n'.format(i+1,self.__AllAtomTypes[i].astype('int'), *self.__AllAtomPositions[i]))          
               
     def SetOrigin(self,inOrigin: np.array):
         self.__Origin = inOrigin
@@ -797,37 +819,8 @@ class SimulationCell(object):
         arrUniqueIndices = np.unique(np.hstack(objGBTree.GetPeriodicIndices(arrIndices)))
         return arrExtendedGBAtoms[arrUniqueIndices]
     def MergeTooCloseAtoms(self,fltDistance:float, intAtomType: int, intLimit = 50):
-        if fltDistance == 0:
-            fltDistance = 1e-5
-        lstGBAtoms = []
-        lstMergedAtoms = []
-        blnStop = False
-        arrGBAtoms = self.GetNonGrainAtoms([intAtomType])
-        i = 0
-        while not(blnStop) and i < intLimit:
-            lstMergedAtoms = []
-            objGBTree = gf.PeriodicWrapperKDTree(arrGBAtoms,self.__BasisVectors,self.GetRealConstraints(),fltDistance/2)
-            arrExtendedGBAtoms = objGBTree.GetExtendedPoints()
-            arrIndices,arrDistances = objGBTree.Pquery_radius(arrGBAtoms,fltDistance) #by default points are returned in distance order
-            lstDistances = list(map(lambda x: np.round(x,5),arrDistances))
-            arrLengths = np.array(list(map(lambda x: len(x),arrIndices)))
-            arrRows = np.where(arrLengths > 1)[0]
-            if len(arrRows) > 0:
-                lstIndices = list(map(lambda x: arrIndices[x][lstDistances[x] <= lstDistances[x][1]],arrRows)) #every point 0 distance from itself 
-                #point at position [1] is then the next closest point. 
-                lstUsedIndices = [item for sublist in lstIndices for item in sublist]
-                lstTrueIndices = np.unique(objGBTree.GetPeriodicIndices(lstUsedIndices)).tolist()
-                arrUnusedIndices = np.unique(list(set(range(len(arrGBAtoms))).difference(lstTrueIndices)))
-                lstMergedAtoms = list(map(lambda x: np.mean(arrExtendedGBAtoms[x],axis=0),lstIndices))
-                if len(arrUnusedIndices) > 0:
-                    lstMergedAtoms.append(arrGBAtoms[arrUnusedIndices])
-                arrGBAtoms = np.vstack(lstMergedAtoms)
-                arrGBAtoms = self.RemoveRealDuplicates(arrGBAtoms,1e-3)
-            else:
-                blnStop = True
-            i +=1
-        if i == intLimit:
-            warnings.warn('Merge too close atoms terminated after ' + str(i) + ' iterations')
+        arrGBAtoms = gf.MergeTooCloseAtoms(self.GetNonGrainAtoms([intAtomType]), self.__BasisVectors, fltDistance, intLimit, self.__BoundaryTypes)
+        arrGBAtoms = self.WrapVectorIntoSimulationBox(arrGBAtoms)
         self.__NonGrainAtomPositions = arrGBAtoms
         self.__NonGrainAtomTypes = np.ones(len(arrGBAtoms))*intAtomType
     def RemoveRealDuplicates(self, inPoints, fltDistance = 1e-5): #returns the unique points that lie inside the simulation cell
@@ -1222,6 +1215,13 @@ class SigmaCell(object):
     def GetSigmaValues(self, intSigmaMax, blnDisorientation = True):
         return  gf.CubicCSLGenerator(self.__RotationAxis, intSigmaMax,blnDisorientation)
     def GetOnlyCSLPrimitiveVectors(self,intSigmaValue,fltPrimitiveCellSize: float):
+        lstKeys = [self.__RotationAxis, self.__CellType, intSigmaValue, fltPrimitiveCellSize]
+        dctCache = gf.ReadCSLCache('GetOnlyCSLPrimitiveVectors', lstKeys)
+        if dctCache is not None:
+            if len(dctCache['Bases']) > 0:
+                self.__CurrentSigmaValue = intSigmaValue
+                self.__OriginalBasis = dctCache['Bases'][-1]
+            return list(dctCache['PrimitiveVectors']),list(dctCache['Bases'])
         blnValidSigma = True
         arrSigma = self.GetSigmaValues(300, True)
         arrRows = np.where(arrSigma[:,0].astype('int') == intSigmaValue)[0]
@@ -1251,8 +1251,14 @@ class SigmaCell(object):
                 arrPrimitiveVectors = gf.FindPrimitiveVectors(arrCSLPoints)
                 lstAllCSLPrimitiveVectors.append(arrPrimitiveVectors)
                 lstAllBases.append(arrBasis2)
+        gf.WriteCSLCache('GetOnlyCSLPrimitiveVectors', lstKeys, {'PrimitiveVectors': np.reshape(lstAllCSLPrimitiveVectors, (-1,3,3)), 'Bases': np.reshape(lstAllBases, (-1,3,3))})
         return lstAllCSLPrimitiveVectors,lstAllBases
     def MakeCSLCell(self, intSigmaValue: int, blnUnitCell = True):
+        lstKeys = [self.__RotationAxis, self.__CellType, intSigmaValue, blnUnitCell]
+        dctCache = gf.ReadCSLCache('MakeCSLCell', lstKeys)
+        if dctCache is not None: #only valid sigma values are stored
+            self.__SetCSLCell(dctCache)
+            return
         blnValidSigma = True
         arrSigma = self.GetSigmaValues(100, True)
         arrRows = np.where(arrSigma[:,0].astype('int') == intSigmaValue)
@@ -1299,8 +1305,23 @@ class SigmaCell(object):
             lstLatticeBasis.append(np.matmul(arrBasis2,arrTransformation))
             self.__LatticeBases = lstLatticeBasis 
             self.__MedianLattice = np.matmul(arrBasisMedian,arrTransformation)   
+            gf.WriteCSLCache('MakeCSLCell', lstKeys, {'SigmaValue': self.__CurrentSigmaValue, 'LatticeRotation': self.__LatticeRotation,
+            'OriginalBasis': self.__OriginalBasis, 'CSLPoints': self.__CSLPoints, 'CSLPrimitiveVectors': self.__CSLPrimitiveVectors,
+            'BasisVectors': self.__BasisVectors, 'TransformationMatrix': self.__TransformationMatrix, 'LatticeBases': np.array(self.__LatticeBases),
+            'MedianLattice': self.__MedianLattice})
         else:
             warnings.warn("Invalid sigma value for axis " + str(self.__RotationAxis))
+    def __SetCSLCell(self, dctCell: dict):
+        self.__CurrentSigmaValue = int(dctCell['SigmaValue'])
+        self.__LatticeRotation = float(dctCell['LatticeRotation'])
+        self.__OriginalBasis = dctCell['OriginalBasis']
+        self.__CSLPoints = dctCell['CSLPoints']
+        self.__CSLPrimitiveVectors = dctCell['CSLPrimitiveVectors']
+        self.__CSLPrimitiveInverse = np.linalg.inv(self.__CSLPrimitiveVectors)
+        self.__BasisVectors = dctCell['BasisVectors']
+        self.__TransformationMatrix = dctCell['TransformationMatrix']
+        self.__LatticeBases = list(dctCell['LatticeBases'])
+        self.__MedianLattice = dctCell['MedianLattice']
     def GetCurrentSigmaValue(self):
         return self.__CurrentSigmaValue
     def GetPossibleSigmaFactors(self): 
@@ -9,7 +9,8 @@ import numpy as np
 import itertools as it
 from numpy.linalg.linalg import det
 import scipy as sc
-from scipy import spatial
+from scipy import spatial, sparse
+from scipy.sparse.csgraph import connected_components
 import sympy as sy
 from sklearn.cluster import DBSCAN
 from sklearn.neighbors import KDTree
@@ -22,6 +23,11 @@ import MiscFunctions as mf
 import cmath as cm
 from fractions import Fraction
 from functools import reduce
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
 
 #import shapely as sp
 #import geopandas as gpd
@@ -173,16 +179,129 @@ def EquidistantPoint(inVector1: np.array, inVector2: np.array, inVector3: np.arr
         else:
                 vctDirection= np.mean(np.unique(np.array([inVector1, inVector2, inVector3]),axis=0), axis=0)
         return vctDirection
+def EquidistantPoints(inVectors1: np.array, inVectors2: np.array, inVectors3: np.array)->np.array: #row by row version of EquidistantPoint
+        arrMatrices = np.zeros([len(inVectors1),3,3])
+        arrMatrices[:,0] = inVectors3-inVectors2
+        arrMatrices[:,1] = np.cross(inVectors2-inVectors1,inVectors3-inVectors1)
+        arrMatrices[:,2] = inVectors2-inVectors1
+        arrReturn = np.zeros([len(inVectors1),3])
+        arrRegular = np.linalg.det(arrMatrices) != 0
+        if np.any(arrRegular):
+                arrRHS = np.zeros([np.sum(arrRegular),3])
+                arrRHS[:,0] = np.matmul(arrMatrices[arrRegular,0,np.newaxis,:], (0.5*(inVectors2[arrRegular]+inVectors3[arrRegular]) - inVectors1[arrRegular])[:,:,np.newaxis])[:,0,0] #matmul keeps the same rounding as np.dot
+                arrRHS[:,2] = 0.5*np.matmul(arrMatrices[arrRegular,2,np.newaxis,:], arrMatrices[arrRegular,2,:,np.newaxis])[:,0,0]
+                arrReturn[arrRegular] = np.matmul(np.linalg.inv(arrMatrices[arrRegular]), arrRHS[:,:,np.newaxis])[:,:,0] + inVectors1[arrRegular]
+        for i in np.where(~arrRegular)[0]: #collinear or repeated points
+                arrReturn[i] = EquidistantPoint(inVectors1[i], inVectors2[i], inVectors3[i])
+        return arrReturn
    
 def CheckLinearEquality(inPoints: np.array, inPlane: np.array, fltTolerance: float)-> np.array: #returns indices to delete for real coordinates  
         arrPositions = np.subtract(np.matmul(inPoints, np.transpose(inPlane[:,:-1])), np.transpose(inPlane[:,-1]))
         arrPositions = np.argwhere(np.abs(arrPositions) < fltTolerance)[:,0]        
         return arrPositions
+def RadiusGraphPairs(inPoints: np.array, fltRadius: float, inCellVectors = None, lstBoundaryType = ['p','p','p'])->np.array: #index pairs i < j of points within fltRadius, periodic if inCellVectors is given
+        intLength = len(inPoints)
+        if intLength == 0:
+                return np.zeros([0,2], dtype='int')
+        if inCellVectors is None:
+                return spatial.cKDTree(inPoints).query_pairs(fltRadius, output_type='ndarray')
+        objTree = PeriodicNativeKDTree(inPoints, inCellVectors, None, fltRadius, lstBoundaryType)
+        arrIndices = objTree.Pquery_radius(inPoints, fltRadius, False, False)[0]
+        arrRows = np.repeat(np.arange(intLength), list(map(len, arrIndices)))
+        arrColumns = np.mod(np.concatenate(list(arrIndices)).astype('int'), intLength) #images of a point map back to the point itself
+        arrPairs = np.transpose([arrRows, arrColumns])[arrRows < arrColumns]
+        return np.unique(arrPairs, axis=0)
+def RadiusGraphClusters(inPoints: np.array, fltRadius: float, intMinSamples = 5, inCellVectors = None, lstBoundaryType = ['p','p','p'])->np.array: 
+        #the same labels as DBSCAN(fltRadius, min_samples=intMinSamples) with -1 for noise, found from the connected components of a sparse radius graph 
+        intLength = len(inPoints)
+        arrPairs = RadiusGraphPairs(inPoints, fltRadius, inCellVectors, lstBoundaryType)
+        arrCore = np.bincount(np.ravel(arrPairs), minlength=intLength) + 1 >= intMinSamples #each point counts itself as DBSCAN does
+        arrCorePairs = arrPairs[arrCore[arrPairs[:,0]] & arrCore[arrPairs[:,1]]]
+        objGraph = sparse.coo_matrix((np.ones(len(arrCorePairs)), (arrCorePairs[:,0], arrCorePairs[:,1])), shape=(intLength, intLength)).tocsr()
+        intComponents, arrComponents = connected_components(objGraph, directed=False)
+        arrCoreRows = np.where(arrCore)[0]
+        arrFirst = np.full(intComponents, intLength)
+        np.minimum.at(arrFirst, arrComponents[arrCoreRows], arrCoreRows)
+        arrOrder = np.argsort(arrFirst)
+        arrRank = np.zeros(intComponents, dtype='int')
+        arrRank[arrOrder] = np.arange(intComponents) #clusters are numbered in the order DBSCAN reaches their first core point
+        arrLabels = -np.ones(intLength, dtype='int')
+        arrLabels[arrCoreRows] = arrRank[arrComponents[arrCoreRows]]
+        arrBorderPairs = np.concatenate([arrPairs, arrPairs[:,::-1]])
+        arrBorderPairs = arrBorderPairs[arrCore[arrBorderPairs[:,0]] & np.invert(arrCore[arrBorderPairs[:,1]])]
+        arrBorder = np.full(intLength, intLength)
+        np.minimum.at(arrBorder, arrBorderPairs[:,1], arrLabels[arrBorderPairs[:,0]]) #border points join the first cluster which reaches them
+        arrRows = np.where(arrBorder < intLength)[0]
+        arrLabels[arrRows] = arrBorder[arrRows]
+        return arrLabels
+def CellListPairs(inPoints: np.array, fltRadius: float, inCellVectors: np.array, lstBoundaryType = ['p','p','p'])->tuple:
+        #index pairs i < j within fltRadius under the minimum image convention and the displacements from point i to point j. Points are 
+        #bucketed into cells at least fltRadius wide and only neighbouring cells are compared so the cost is linear in the number of points.
+        arrPoints = np.asarray(inPoints, dtype='float')
+        intLength = len(arrPoints)
+        if intLength == 0:
+                return np.zeros([0,2], dtype='int'), np.zeros([0,3])
+        arrCellVectors = np.asarray(inCellVectors, dtype='float')
+        arrInverse = np.linalg.inv(arrCellVectors)
+        arrPeriodic = np.array(list(map(lambda x: x == 'p', lstBoundaryType)))
+        arrWidths = np.abs(np.linalg.det(arrCellVectors))/np.linalg.norm(list(map(lambda k: np.cross(arrCellVectors[np.mod(k+1,3)], arrCellVectors[np.mod(k+2,3)]), range(3))), axis=1)
+        intCap = max(1, int(np.ceil(intLength**(1/3)))) #about one point per cell however small the radius
+        arrCells = np.maximum(1, np.minimum(np.floor(arrWidths/fltRadius), intCap)).astype('int')
+        arrWrapped = np.matmul(arrPoints, arrInverse)
+        arrWrapped[:, arrPeriodic] = np.mod(arrWrapped[:, arrPeriodic], 1)
+        arrBins = np.clip(np.floor(arrWrapped*arrCells).astype('int'), 0, arrCells - 1) #non periodic points outside the cell go into the end cells
+        arrCellIDs = np.ravel_multi_index(np.transpose(arrBins), arrCells)
+        arrOrder = np.argsort(arrCellIDs, kind='stable')
+        arrCounts = np.bincount(arrCellIDs, minlength=np.prod(arrCells))
+        arrStarts = np.cumsum(arrCounts) - arrCounts
+        lstOffsets = []
+        for j in range(3): #wrapped offsets must not visit the same neighbouring cell twice
+                if arrPeriodic[j] and arrCells[j] < 3:
+                        lstOffsets.append(list(range(arrCells[j])))
+                else:
+                        lstOffsets.append([-1,0,1])
+        arrFractional = np.matmul(arrPoints, arrInverse)[arrOrder] #work in cell order so the points of neighbouring cells are close in memory
+        arrSortedBins = arrBins[arrOrder]
+        lstPairs = []
+        lstDisplacements = []
+        for tupOffset in it.product(*lstOffsets):
+                arrOffset = np.array(tupOffset)
+                arrNegative = -arrOffset
+                arrOffset[arrPeriodic] = np.mod(arrOffset[arrPeriodic], arrCells[arrPeriodic])
+                arrNegative[arrPeriodic] = np.mod(arrNegative[arrPeriodic], arrCells[arrPeriodic])
+                if tuple(arrOffset) > tuple(arrNegative): #the pairs of cells this offset joins are all found from the other cell with the opposite offset
+                        continue
+                arrNeighbours = arrSortedBins + np.array(tupOffset)
+                arrNeighbours = np.where(arrPeriodic, np.mod(arrNeighbours, arrCells), arrNeighbours)
+                if np.all(arrPeriodic):
+                        arrRows = np.arange(intLength)
+                else:
+                        arrRows = np.where(np.all((arrNeighbours >= 0) & (arrNeighbours < arrCells), axis=1))[0]
+                        arrNeighbours = arrNeighbours[arrRows]
+                arrIDs = np.ravel_multi_index(np.transpose(arrNeighbours), arrCells)
+                arrNumbers = arrCounts[arrIDs]
+                arrI = np.repeat(arrRows, arrNumbers)
+                arrJ = np.arange(len(arrI)) + np.repeat(arrStarts[arrIDs] - np.cumsum(arrNumbers) + arrNumbers, arrNumbers)
+                if tuple(arrOffset) == tuple(arrNegative): #this offset joins cells both ways round so keep one order of each pair
+                        arrKeep = arrI < arrJ
+                        arrI = arrI[arrKeep]
+                        arrJ = arrJ[arrKeep]
+                arrDisplacements = arrFractional[arrJ] - arrFractional[arrI]
+                arrDisplacements -= np.round(arrDisplacements)*arrPeriodic
+                arrDisplacements = np.matmul(arrDisplacements, arrCellVectors)
+                arrClose = np.einsum('ij,ij->i', arrDisplacements, arrDisplacements) <= fltRadius**2
+                lstPairs.append(np.transpose([arrOrder[arrI[arrClose]], arrOrder[arrJ[arrClose]]]))
+                lstDisplacements.append(arrDisplacements[arrClose])
+        arrPairs = np.concatenate(lstPairs).astype('int')
+        arrDisplacements = np.concatenate(lstDisplacements)
+        arrSwap = arrPairs[:,0] > arrPairs[:,1]
+        arrPairs[arrSwap] = arrPairs[arrSwap][:, ::-1]
+        arrDisplacements[arrSwap] = -arrDisplacements[arrSwap]
+        return arrPairs, arrDisplacements
 def MergePeriodicClusters(inPoints: np.array, inCellVectors: np.array, inBoundaryList: list, fltMin = 4.05):
         inConstraints = FindConstraintsFromBasisVectors(inCellVectors)
         lstPoints = []
-        clustering = DBSCAN(fltMin).fit(inPoints)
-        arrValues = clustering.labels_
+        arrValues = RadiusGraphClusters(inPoints, fltMin)
         arrUniqueValues, arrCounts = np.unique(arrValues, return_counts=True)
         arrUniqueValues = arrUniqueValues[np.argsort(arrCounts)[::-1]]
         lstTranslations = []
@@ -611,9 +730,53 @@ def GetMatrixFromAxisAngle(inAxis, inAngle):
                                 [ x*z*(1-c)-y*s,y*z*(1-c)+x*s,c+z**2*(1-c)]])
         return arrMatrix
 
+strCSLCacheDirectory = os.environ.get('CSL_CACHE_DIRECTORY') #the CSL cache is off unless this names a directory, for example ~/.cache/CSLCache
+intCSLCacheVersion = 1 #increase whenever a cached CSL result changes so old files are no longer found
+def GetCSLCacheFileName(strFunction: str, lstKeys: list)->str: #content addressed so every set of arguments has its own file
+        strKey = json.dumps([strFunction, intCSLCacheVersion] + list(map(lambda x: np.asarray(x).tolist(), lstKeys)))
+        return os.path.join(strCSLCacheDirectory, strFunction + '_' + hashlib.sha1(strKey.encode()).hexdigest() + '.npz')
+def ReadCSLCache(strFunction: str, lstKeys: list): #returns None if the cache is off or these arguments have not been stored
+        if strCSLCacheDirectory is None:
+                return None
+        strFilename = GetCSLCacheFileName(strFunction, lstKeys)
+        if not(os.path.isfile(strFilename)):
+                return None
+        try:
+                with np.load(strFilename) as objFile:
+                        return dict(objFile)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile): #a damaged file is simply recomputed and overwritten
+                return None
+def WriteCSLCache(strFunction: str, lstKeys: list, dctArrays: dict):
+        if strCSLCacheDirectory is None:
+                return
+        strFilename = GetCSLCacheFileName(strFunction, lstKeys)
+        strTemporary = None
+        try:
+                os.makedirs(strCSLCacheDirectory, exist_ok=True)
+                intHandle, strTemporary = tempfile.mkstemp(suffix='.npz', dir=strCSLCacheDirectory)
+                with os.fdopen(intHandle, 'wb') as Cfile:
+                        np.savez_compressed(Cfile, **dctArrays)
+                        Cfile.close()
+                intMask = os.umask(0)
+                os.umask(intMask)
+                os.chmod(strTemporary, 0o666 & ~intMask) #mkstemp only gives the owner access
+                os.replace(strTemporary, strFilename) #jobs started together never see a half written file
+                strTemporary = None
+        except OSError:
+                warnings.warn('Unable to write CSL cache file ' + strFilename)
+        finally:
+                if strTemporary is not None: #a failed write leaves no temporary file behind
+                        try:
+                                os.remove(strTemporary)
+                        except OSError:
+                                pass
 def CubicCSLGenerator(inAxis: np.array, intIterations=5, blnDisorientation = False)->list: #usually five iterations is find the first 5 sigma values
         intGCD = np.gcd.reduce(inAxis)
         inAxis = inAxis*1/intGCD
+        lstKeys = ['Cubic', inAxis, intIterations, blnDisorientation]
+        dctCache = ReadCSLCache('CubicCSLGenerator', lstKeys)
+        if dctCache is not None:
+                return dctCache['Sigma']
         intSquared = np.sum(inAxis*inAxis).astype('int')
         dctSigma =dict()
         intLimit = int(intIterations + 1)
@@ -645,8 +808,14 @@ def CubicCSLGenerator(inAxis: np.array, intIterations=5, blnDisorientation = Fal
                 arrReturn[p,1] = dctSigma[k][1]
                 arrReturn[p,2] = 180*arrReturn[p,1]/np.pi
                 p +=1
-        return arrReturn[np.argsort(arrReturn[:,0])]
+        arrReturn = arrReturn[np.argsort(arrReturn[:,0])]
+        WriteCSLCache('CubicCSLGenerator', lstKeys, {'Sigma': arrReturn})
+        return arrReturn
 def FindAxesFromSigmaValues(intSigma :int, intLimit: int): #cubic only
+        lstKeys = ['Cubic', intSigma, intLimit]
+        dctCache = ReadCSLCache('FindAxesFromSigmaValues', lstKeys)
+        if dctCache is not None:
+                return dctCache['Axes']
         lstAxes = []
         lstPossibleAxes = list(it.combinations_with_replacement(list(range(intSigma)),3))
         lstPossibleAxes.remove((0,0,0))
@@ -669,7 +838,9 @@ def FindAxesFromSigmaValues(intSigma :int, intLimit: int): #cubic only
                                         lstAxes.append(a)
                                 n +=1
                         m +=1
-        return np.unique(lstAxes,axis=0)
+        arrAxes = np.unique(lstAxes,axis=0)
+        WriteCSLCache('FindAxesFromSigmaValues', lstKeys, {'Axes': arrAxes})
+        return arrAxes
 def GetBoundaryPoints(inPoints, intNumberOfNeighbours: int, fltRadius: float, inCellVectors = None):
         intLength = len(inPoints) #assumes a lattice configuration with fixed number of neighbours
         inConstraints = FindConstraintsFromBasisVectors(inCellVectors)
@@ -726,46 +897,61 @@ def CubicQuaternions():
                                 fltLength = np.round(np.linalg.norm(arrDirection),5)
                                 if  fltLength == 1:
                                         for a in range(0,4):
-                                                lstQuaternions.append(GetQuaternionFromVector(arrDirection,np.pi/4*a))
+                                                lstQuaternions.append(GetQuaternionFromVector(arrDirection,np.pi/2*a))
                                 elif fltLength == np.round(np.sqrt(2),5):
                                         lstQuaternions.append(GetQuaternionFromVector(arrDirection,np.pi))
                                 elif fltLength ==np.round(np.sqrt(3),5):
                                         for b in range(0,3):
                                                 lstQuaternions.append(GetQuaternionFromVector(arrDirection,2*np.pi/3*b))
         arrValues = np.vstack(lstQuaternions)
+        arrSigns = np.sign(arrValues[np.arange(len(arrValues)), np.argmax(np.abs(arrValues) > 1e-5, axis=1)])
+        arrValues = arrValues*arrSigns[:,np.newaxis] #q and -q are the same rotation so only the 24 cubic rotations are kept
         arrRows = np.unique(np.round(arrValues,3),axis=0, return_index=True)[1]                              
         return arrValues[arrRows]
 
-def MergeTooCloseAtoms(inPoints, inBasisVectors, fltDistance, intLimit =50):
+def CubicSymmetryDots(inQuaternions: np.array, inReferences: np.array, strDType = 'float64', intChunkSize = 65536)->np.array: 
+        #largest |q.(r*s)| over the 24 cubic rotations s for every quaternion q (rows) against every reference r (columns). With q.(r*s) = p.s 
+        #and a >= b >= c >= d the absolute components of p this is max(a, (a+b)/sqrt(2), (a+b+c+d)/2) as in FCCQuaternionEquivalence
+        arrReferences = np.reshape(inReferences, (-1,4))
+        intReferences = len(arrReferences)
+        arrTransform = np.concatenate(list(map(lambda r: np.transpose([QuaternionProduct(r, e) for e in np.identity(4)]), arrReferences)), axis=1).astype(strDType)
+        intLength = len(inQuaternions)
+        arrDots = np.zeros([intLength, intReferences], dtype=strDType)
+        for i in range(0, intLength, intChunkSize): #chunks keep the (rows, references, 4) intermediates small
+                arrChunk = np.abs(np.matmul(np.asarray(inQuaternions[i:i+intChunkSize], dtype=strDType), arrTransform))
+                arrChunk = np.sort(np.reshape(arrChunk, (len(arrChunk), intReferences, 4)), axis=2)
+                arrDots[i:i+intChunkSize] = np.maximum(np.maximum(arrChunk[:,:,3], (arrChunk[:,:,3] + arrChunk[:,:,2])/np.sqrt(2)), np.sum(arrChunk, axis=2)/2)
+        return arrDots
+def MinimumMisorientations(inQuaternions: np.array, inReferences: np.array, strDType = 'float64')->np.array: #smallest misorientation angle in radians allowing for cubic symmetry
+        return 2*np.arccos(np.minimum(CubicSymmetryDots(inQuaternions, inReferences, strDType), 1))
+def MergeTooCloseAtoms(inPoints, inBasisVectors, fltDistance, intLimit =50, lstBoundaryType = ['p','p','p']):
+        #each cluster of points joined by distances of at most fltDistance is replaced by its periodic mean, merged points first. This
+        #repeats in case a merged point has moved within fltDistance of another point.
         if fltDistance == 0:
                 fltDistance = 1e-5
         blnStop = False
         i = 0
         arrPoints = np.copy(inPoints)
-        inConstraints = FindConstraintsFromBasisVectors(inBasisVectors)
+        arrInverse = np.linalg.inv(inBasisVectors)
+        arrPeriodic = np.array(list(map(lambda x: x == 'p', lstBoundaryType)))
         while not(blnStop) and i < intLimit:
-                lstMergedAtoms = []
-                objGBTree = PeriodicWrapperKDTree(arrPoints,inBasisVectors,inConstraints,1.05*fltDistance/2)
-                arrExtendedGBAtoms = objGBTree.GetExtendedPoints()
-                arrIndices,arrDistances = objGBTree.Pquery_radius(arrPoints,fltDistance) #by default points are returned in distance order
-                lstDistances = list(map(lambda x: np.round(x,5),arrDistances))
-                arrLengths = np.array(list(map(lambda x: len(x),arrIndices)))
-                arrRows = np.where(arrLengths > 1)[0]
-                if len(arrRows) > 0:
-                        lstIndices = list(map(lambda x: arrIndices[x][lstDistances[x] <= lstDistances[x][1]],arrRows)) #every point 0 distance from itself 
-                        #point at position [1] is then the next closest point. 
-                        lstUsedIndices = [item for sublist in lstIndices for item in sublist]
-                        lstTrueIndices = np.unique(objGBTree.GetPeriodicIndices(lstUsedIndices)).tolist()
-                        arrUnusedIndices = np.unique(list(set(range(len(arrPoints))).difference(lstTrueIndices)))
-                        lstMergedAtoms = list(map(lambda x: np.mean(arrExtendedGBAtoms[x],axis=0),lstIndices))
-                        if len(arrUnusedIndices) > 0:
-                                lstMergedAtoms.append(arrPoints[arrUnusedIndices])
-                        arrPoints = np.vstack(lstMergedAtoms)
-                        arrRows = FindDuplicates(arrPoints, inBasisVectors,fltDistance) 
-                        lstUniqueIndices = list(set(range(len(arrPoints))).difference(arrRows.tolist()))
-                        arrUniqueIndices = np.unique(lstUniqueIndices)
-                        arrPoints = arrPoints[arrUniqueIndices]
-
+                arrPairs = CellListPairs(arrPoints, fltDistance, inBasisVectors, lstBoundaryType)[0]
+                if len(arrPairs) > 0:
+                        intLength = len(arrPoints)
+                        objGraph = sparse.coo_matrix((np.ones(len(arrPairs)), (arrPairs[:,0], arrPairs[:,1])), shape=(intLength, intLength)).tocsr()
+                        intComponents, arrComponents = connected_components(objGraph, directed=False)
+                        arrFirst = np.full(intComponents, intLength)
+                        np.minimum.at(arrFirst, arrComponents, np.arange(intLength))
+                        arrShifts = np.matmul(arrPoints - arrPoints[arrFirst[arrComponents]], arrInverse) #minimum image positions relative to the first point of each cluster
+                        arrShifts[:, arrPeriodic] -= np.round(arrShifts[:, arrPeriodic])
+                        arrShifts = np.matmul(arrShifts, inBasisVectors)
+                        arrSizes = np.bincount(arrComponents, minlength=intComponents)
+                        arrMeans = np.zeros([intComponents, np.shape(arrPoints)[1]])
+                        np.add.at(arrMeans, arrComponents, arrShifts)
+                        arrMeans = arrPoints[arrFirst] + arrMeans/arrSizes[:, np.newaxis]
+                        arrMerged = np.where(arrSizes > 1)[0]
+                        arrMerged = arrMerged[np.argsort(arrFirst[arrMerged])]
+                        arrPoints = np.concatenate([arrMeans[arrMerged], arrPoints[arrSizes[arrComponents] == 1]])
                 else:
                         blnStop = True
                 i +=1
@@ -786,7 +972,7 @@ def FindReciprocalVectors(inRealVectors: np.array):
 
 def FindDuplicates(inPoints, inCellVectors, fltDistance, lstBoundaryType = ['p','p','p']):
         arrConstraints = FindConstraintsFromBasisVectors(inCellVectors)
-        objPeriodicTree = PeriodicWrapperKDTree(inPoints, inCellVectors,arrConstraints,2*fltDistance, lstBoundaryType)
+        objPeriodicTree = PeriodicNativeKDTree(inPoints, inCellVectors,arrConstraints,2*fltDistance, lstBoundaryType)
         arrIndices = objPeriodicTree.Pquery_radius(inPoints,fltDistance)[0]
         lstIndices = objPeriodicTree.GetPeriodicIndices(arrIndices)
         arrLengths = np.array(list(map(lambda x: len(x),lstIndices)))
@@ -873,6 +1059,218 @@ class PeriodicWrapperKDTree(object):
     def GetOriginalPoints(self):
         return self.__OriginalPoints
 
+class PeriodicImagePoints(object): #stands in for the extended points of a PeriodicWrapperKDTree without storing the periodic images
+    def __init__(self, inPoints: np.array, inPeriodicVectors: np.array, fltWrapperLength: float, lstBoundaryType: list, intBase: int):
+        self.__OriginalPoints = inPoints
+        self.__PeriodicVectors = inPeriodicVectors
+        self.__WrapperWidth = fltWrapperLength
+        self.__BoundaryType = lstBoundaryType
+        self.__Base = intBase
+        self.__WrapperPoints = None
+    def GetImageShifts(self, inIndices: np.array)->np.array: #an image index is intCode*N + the original index and intCode holds the cell shift in base self.__Base
+        arrCodes = np.floor_divide(inIndices, len(self.__OriginalPoints))
+        lstShifts = []
+        for i in range(len(self.__PeriodicVectors)):
+            arrDigits = np.mod(arrCodes, self.__Base)
+            lstShifts.append(np.where(arrDigits >= self.__Base/2, arrDigits - self.__Base, arrDigits))
+            arrCodes = np.floor_divide(arrCodes, self.__Base)
+        return np.stack(lstShifts, axis=-1)
+    def __getitem__(self, inKey):
+        if isinstance(inKey, tuple):
+            return self[inKey[0]][(slice(None),)*np.ndim(inKey[0]) + inKey[1:]]
+        arrIndices = np.asarray(inKey)
+        if arrIndices.dtype == bool:
+            arrIndices = np.where(arrIndices)[0]
+        arrIndices = arrIndices.astype('int64')
+        return self.__OriginalPoints[np.mod(arrIndices, len(self.__OriginalPoints))] + np.matmul(self.GetImageShifts(arrIndices), self.__PeriodicVectors)
+    def GetWrapperPoints(self): #the original points and their images within the wrapper length, only built if asked for
+        if self.__WrapperPoints is None:
+            if len(self.__OriginalPoints) == 0:
+                self.__WrapperPoints = np.copy(self.__OriginalPoints)
+            else:
+                self.__WrapperPoints = AddPeriodicWrapperAndIndices(self.__OriginalPoints, self.__PeriodicVectors, FindConstraintsFromBasisVectors(self.__PeriodicVectors), self.__WrapperWidth, self.__BoundaryType)[0]
+        return self.__WrapperPoints
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.GetWrapperPoints()
+        return self.GetWrapperPoints().astype(dtype)
+    def __len__(self):
+        return len(self.GetWrapperPoints())
+
+class PeriodicNativeKDTree(object): #periodic tree over the original points only, images are found by shifting the queries rather than copying the points
+    def __init__(self, inPoints,inPeriodicVectors,inConstraints = None, fltWrapperLength = 0, lstBoundaryType = ['p','p','p']):
+        self.__OriginalPoints = np.copy(inPoints)
+        self.__PeriodicVectors = np.copy(inPeriodicVectors)
+        arrInverse = np.linalg.inv(inPeriodicVectors)
+        self.__InverseBasis = arrInverse
+        self.__ModValue = len(inPoints)
+        self.__WrapperWidth = fltWrapperLength
+        self.__BoundaryTypes = list(lstBoundaryType)
+        self.__Base = 64
+        self.__ChunkSize = 4096
+        intDimensions = len(inPeriodicVectors)
+        self.__Periodic = np.array(list(map(lambda x: x in ['p','pp'], lstBoundaryType[:intDimensions])))
+        arrNormals = np.transpose(arrInverse)
+        self.__CellWidths = 1/np.linalg.norm(arrNormals, axis=1) #perpendicular distance between opposite faces
+        self.__Orthogonal = np.allclose(inPeriodicVectors, np.diag(np.diag(inPeriodicVectors))) and np.all(np.diag(inPeriodicVectors) > 0)
+        arrFractional = np.matmul(self.__OriginalPoints, arrInverse) if self.__ModValue > 0 else np.zeros([0,intDimensions])
+        self.__CellOffsets = np.where(self.__Periodic, -np.floor(arrFractional), 0).astype('int') #shift taking each original point into the cell
+        arrFractional = arrFractional + self.__CellOffsets
+        arrFractional[:,self.__Periodic] = np.where(arrFractional[:,self.__Periodic] >= 1, 0, arrFractional[:,self.__Periodic])
+        self.__WrappedPoints = np.matmul(arrFractional, inPeriodicVectors)
+        if self.__Orthogonal: #cKDTree handles the periodicity itself for orthogonal cells
+            self.__BoxSize = np.where(self.__Periodic, np.diag(inPeriodicVectors), 0)
+        else:
+            self.__BoxSize = None
+        self.__PeriodicTree = spatial.cKDTree(self.__WrappedPoints, boxsize=self.__BoxSize)
+        self.__ExtendedPoints = PeriodicImagePoints(self.__OriginalPoints, self.__PeriodicVectors, fltWrapperLength, lstBoundaryType, self.__Base)
+    def __WrapQueries(self, inPoints: np.array):
+        arrFractional = np.matmul(inPoints, self.__InverseBasis)
+        arrOffsets = np.where(self.__Periodic, -np.floor(arrFractional), 0).astype('int')
+        arrFractional = arrFractional + arrOffsets
+        arrFractional[:,self.__Periodic] = np.where(arrFractional[:,self.__Periodic] >= 1, 0, arrFractional[:,self.__Periodic])
+        return arrFractional, np.matmul(arrFractional, self.__PeriodicVectors), arrOffsets
+    def __ImageIndices(self, inIndices: np.array, inShifts: np.array)->np.array:
+        arrShifts = self.__CellOffsets[inIndices] + inShifts
+        if np.any(np.abs(arrShifts) >= self.__Base/2):
+            raise Exception('Periodic image is too far from the simulation cell to index')
+        arrCodes = np.zeros(np.shape(inIndices), dtype='int64')
+        for i in reversed(range(len(self.__PeriodicVectors))):
+            arrCodes = arrCodes*self.__Base + np.mod(arrShifts[...,i], self.__Base)
+        return arrCodes*self.__ModValue + inIndices
+    def __MinimumImageShifts(self, inQueries: np.array, inIndices: np.array)->np.array: #cell shift of the image of each tree point nearest its query
+        arrFractional = np.matmul(inQueries - self.__WrappedPoints[inIndices], self.__InverseBasis)
+        return np.where(self.__Periodic, np.round(arrFractional), 0).astype('int')
+    def __QueryShifts(self, inFractional: np.array, inBounds: np.array): #candidate cell shifts for each query given an upper bound on the search distance
+        lstRanges = []
+        for i in range(len(self.__PeriodicVectors)):
+            if self.__Periodic[i]:
+                intRange = int(np.ceil(np.max(inBounds, initial=0)/self.__CellWidths[i]))
+                lstRanges.append(range(-intRange, intRange+1))
+            else:
+                lstRanges.append(range(0,1))
+        for tupShift in it.product(*lstRanges):
+            if not any(tupShift):
+                continue
+            arrShift = np.array(tupShift)
+            arrRows = np.where(self.__ShiftGaps(inFractional, arrShift) <= inBounds)[0]
+            if len(arrRows) > 0:
+                yield arrShift, arrRows
+    def Pquery_radius(self, inPoints: np.array, fltRadius: float,blnReturnDistance=True, blnSortResults=True):
+        inPoints = np.atleast_2d(np.asarray(inPoints, dtype='float'))
+        intQueries = len(inPoints)
+        arrIndices = np.empty(intQueries, dtype=object)
+        arrDistances = np.empty(intQueries, dtype=object)
+        for i in range(0, intQueries, self.__ChunkSize): #chunked so the flattened matches stay small
+            lstIndices, lstDistances = self.__RadiusChunk(inPoints[i:i+self.__ChunkSize], fltRadius, blnSortResults)
+            for j in range(len(lstIndices)):
+                arrIndices[i+j] = lstIndices[j]
+                arrDistances[i+j] = lstDistances[j]
+        if blnReturnDistance:
+            return arrIndices, arrDistances
+        return arrIndices, None
+    def __RadiusChunk(self, inPoints: np.array, fltRadius: float, blnSortResults: bool):
+        intQueries = len(inPoints)
+        arrFractional, arrQueries, arrOffsets = self.__WrapQueries(inPoints)
+        lstRows = []
+        lstIndices = []
+        lstShifts = []
+        lstDistances = []
+        if self.__ModValue > 0:
+            lstPairs = [(np.zeros(len(self.__PeriodicVectors),dtype='int'), np.arange(intQueries))]
+            if not self.__Orthogonal:
+                lstPairs.extend(self.__QueryShifts(arrFractional, np.full(intQueries, fltRadius)))
+            for arrShift, arrRows in lstPairs:
+                objQueryTree = spatial.cKDTree(arrQueries[arrRows] - np.matmul(arrShift, self.__PeriodicVectors), boxsize=self.__BoxSize)
+                arrFound = objQueryTree.sparse_distance_matrix(self.__PeriodicTree, fltRadius, output_type='ndarray')
+                if len(arrFound) == 0:
+                    continue
+                arrFoundRows = arrRows[arrFound['i']]
+                if self.__Orthogonal:
+                    arrFoundShifts = self.__MinimumImageShifts(arrQueries[arrFoundRows], arrFound['j'])
+                else:
+                    arrFoundShifts = np.tile(arrShift, (len(arrFound),1))
+                lstRows.append(arrFoundRows)
+                lstIndices.append(arrFound['j'])
+                lstShifts.append(arrFoundShifts)
+                lstDistances.append(arrFound['v'])
+        if len(lstRows) > 0:
+            arrRows = np.concatenate(lstRows)
+            arrAllIndices = self.__ImageIndices(np.concatenate(lstIndices), np.concatenate(lstShifts) - arrOffsets[arrRows])
+            arrAllDistances = np.concatenate(lstDistances)
+        else:
+            arrRows = np.array([], dtype='int')
+            arrAllIndices = np.array([], dtype='int64')
+            arrAllDistances = np.array([])
+        if blnSortResults:
+            arrOrder = np.lexsort((arrAllDistances, arrRows))
+        else:
+            arrOrder = np.argsort(arrRows, kind='stable')
+        arrSplits = np.cumsum(np.bincount(arrRows, minlength=intQueries))[:-1]
+        return np.split(arrAllIndices[arrOrder], arrSplits), np.split(arrAllDistances[arrOrder], arrSplits)
+    def GetExtendedPoints(self):
+        return self.__ExtendedPoints
+    def GetPeriodicIndices(self, inRealIndices: list)->list:
+        return list(map(lambda x: np.mod(x, self.__ModValue),inRealIndices))
+    def GetBoundaryTypes(self)->list:
+        return self.__BoundaryTypes
+    def Pquery(self,inPoints:np.array,k=1):
+        inPoints = np.atleast_2d(np.asarray(inPoints, dtype='float'))
+        arrFractional, arrQueries, arrOffsets = self.__WrapQueries(inPoints)
+        arrDistances, arrIndices = self.__PeriodicTree.query(arrQueries, k=[*range(1,k+1)])
+        if self.__Orthogonal:
+            arrShifts = self.__MinimumImageShifts(arrQueries[:,np.newaxis,:], arrIndices)
+        else:
+            arrShifts = np.zeros(np.shape(arrIndices) + (len(self.__PeriodicVectors),), dtype='int')
+            for arrShift, arrRows in self.__QueryShifts(arrFractional, arrDistances[:,-1]): #only queries whose kth distance reaches past a face need the shifted search
+                arrRows = arrRows[self.__ShiftGaps(arrFractional[arrRows], arrShift) <= arrDistances[arrRows,-1]]
+                if len(arrRows) == 0:
+                    continue
+                arrNewDistances, arrNewIndices = self.__PeriodicTree.query(arrQueries[arrRows] - np.matmul(arrShift, self.__PeriodicVectors), k=[*range(1,k+1)])
+                arrAllDistances = np.concatenate([arrDistances[arrRows], arrNewDistances], axis=1)
+                arrAllIndices = np.concatenate([arrIndices[arrRows], arrNewIndices], axis=1)
+                arrAllShifts = np.concatenate([arrShifts[arrRows], np.broadcast_to(arrShift, np.shape(arrNewIndices) + (len(arrShift),))], axis=1)
+                arrOrder = np.argsort(arrAllDistances, axis=1, kind='stable')[:,:k]
+                arrDistances[arrRows] = np.take_along_axis(arrAllDistances, arrOrder, axis=1)
+                arrIndices[arrRows] = np.take_along_axis(arrAllIndices, arrOrder, axis=1)
+                arrShifts[arrRows] = np.take_along_axis(arrAllShifts, arrOrder[:,:,np.newaxis], axis=1)
+        arrIndices = self.__ImageIndices(arrIndices, arrShifts - arrOffsets[:,np.newaxis,:])
+        return arrDistances, arrIndices
+    def __ShiftGaps(self, inFractional: np.array, inShift: np.array)->np.array: #distance from each shifted query to the cell along the face normals
+        arrGap = np.zeros(len(inFractional))
+        for i in np.where(inShift != 0)[0]:
+            if inShift[i] > 0:
+                arrGap = np.maximum(arrGap, (inShift[i] - inFractional[:,i])*self.__CellWidths[i])
+            else:
+                arrGap = np.maximum(arrGap, (inFractional[:,i] - inShift[i] - 1)*self.__CellWidths[i])
+        return arrGap
+    def GetWrapperLength(self):
+        return self.__WrapperWidth
+    def GetOriginalPoints(self):
+        return self.__OriginalPoints
+
+class PeriodicNeighbourList(object): #one periodic tree over all the points which answers radius queries for any radius up to the cutoff
+    def __init__(self, inPoints: np.array, inPeriodicVectors: np.array, fltCutoff: float, lstBoundaryType = ['p','p','p']):
+        self.__Cutoff = fltCutoff
+        self.__NumberOfPoints = len(inPoints)
+        self.__PeriodicTree = PeriodicNativeKDTree(inPoints, inPeriodicVectors, None, fltCutoff, lstBoundaryType)
+    def GetCutoff(self)->float:
+        return self.__Cutoff
+    def GetNumberOfPoints(self)->int:
+        return self.__NumberOfPoints
+    def GetPeriodicTree(self):
+        return self.__PeriodicTree
+    def Pquery_radius(self, inPoints: np.array, fltRadius: float)->list: #returns the original point indices within fltRadius of each point
+        if fltRadius > self.__Cutoff:
+            raise Exception('Radius ' + str(fltRadius) + ' exceeds the neighbour list cutoff ' + str(self.__Cutoff))
+        arrIndices = self.__PeriodicTree.Pquery_radius(inPoints, fltRadius, True, False)[0]
+        return list(map(lambda x: np.unique(np.mod(x, self.__NumberOfPoints)).astype('int'), arrIndices)) #image indices are offset by multiples of the number of points
+    def GetIndicesNearPoints(self, inPoints: np.array, fltRadius: float)->np.array: #all original point indices within fltRadius of any of the points
+        lstIndices = self.Pquery_radius(inPoints, fltRadius)
+        if len(lstIndices) == 0:
+            return np.array([], dtype='int')
+        return np.unique(np.concatenate(lstIndices)).astype('int')
+
 class PeriodicFullKDTree(object):
     def __init__(self, inPoints: np.array,inPeriodicVectors: np.array):
         self.__OriginalPoints = np.copy(inPoints)
@@ -1364,15 +1762,17 @@ def GroupClustersPeriodically(lstPoints: np.array, arrPeriodicVectors: np.array,
         intLength = len(lstPoints)
         lstAllMatches = []
         lstUsedIndices = []
+        arrAdjacent = np.zeros([intLength, intLength], dtype='bool') #true if clusters i and j have points within fltMinDistance of each other
+        if intLength > 0:
+                arrClusters = np.repeat(np.arange(intLength), list(map(len, lstPoints)))
+                arrPairs = RadiusGraphPairs(np.concatenate(lstPoints), fltMinDistance, arrPeriodicVectors, list(map(lambda x: 'p' if x == 'pp' else 'n', lstBoundary)))
+                arrAdjacent[arrClusters[arrPairs[:,0]], arrClusters[arrPairs[:,1]]] = True
+                arrAdjacent = arrAdjacent | np.transpose(arrAdjacent)
         for i in range(intLength):
                 lstMatches = []
-                objPeriodicCell = PeriodicKDTree(lstPoints[i],arrPeriodicVectors, lstBoundary)
-                for j in range(i+1, intLength):
-                        arrIndices = objPeriodicCell.Pquery_radius(lstPoints[j],fltMinDistance)
-                        lstIndices = mf.FlattenList(arrIndices)
-                        if len(lstIndices) > 0:
-                                lstMatches.append(j)
-                                lstMatches.append(i)
+                for j in np.where(arrAdjacent[i,i+1:])[0] + i + 1:
+                        lstMatches.append(j)
+                        lstMatches.append(i)
                 if len(lstMatches) > 0:
                         arrUniqueMatches = np.unique(lstMatches)
                         if not(np.any(np.isin(arrUniqueMatches,lstUsedIndices))):
@@ -1,10 +1,18 @@
 import re
+import os
+import json
+import multiprocessing
+import tempfile
+import gzip
+import lzma
+import io
 #from types import NoneType
 import numpy as np
 import GeometryFunctions as gf
 import GeneralLattice as gl
 import LatticeDefinitions as ld
-from scipy import spatial, optimize, ndimage, stats 
+from scipy import spatial, optimize, ndimage, stats, sparse 
+from scipy.sparse.csgraph import connected_components
 from skimage.morphology import skeletonize, thin, medial_axis, remove_small_holes, remove_small_objects, skeletonize_3d, binary_dilation
 from scipy.cluster.vq import kmeans,vq
 from scipy.interpolate import RectBivariateSpline, RegularGridInterpolator
@@ -122,87 +130,359 @@ class LAMMPSLog(object):
     def GetColumnNames(self, intStage):
             return self.__ColumnNames[intStage]    
 
+def OpenDumpFile(strFilename: str, strMode = 'rb'): #.gz, .xz and .zst files are decompressed or compressed as a stream and anything else is opened as it is
+    if strFilename.endswith('.gz'):
+        return gzip.open(strFilename, strMode, compresslevel=6) #close to the size of level 9 for dump files at a fraction of the time
+    elif strFilename.endswith('.xz'):
+        return lzma.open(strFilename, strMode)
+    elif strFilename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstandard package is needed to open ' + strFilename)
+        if 'r' in strMode:
+            return io.BufferedReader(zstandard.open(strFilename, strMode))
+        return zstandard.open(strFilename, strMode)
+    return open(strFilename, strMode)
+
+def IsCompressedDumpFile(strFilename: str)->bool:
+    return strFilename.endswith(('.gz', '.xz', '.zst'))
+
 class LAMMPSData(object):
-    def __init__(self,strFilename: str, intLatticeType: int, fltLatticeParameter: float, objAnalysis: object):
+    def __init__(self,strFilename: str, intLatticeType: int, fltLatticeParameter: float, objAnalysis: object, blnLazy = False, blnCache = False, lstColumns = None):
+        #lstColumns restricts parsing and storage to the named columns; id is always kept as the first column
         self.__dctTimeSteps = dict()
         self.__FileName = strFilename
+        self.__LatticeType = intLatticeType
+        self.__LatticeParameter = fltLatticeParameter
+        self.__Analysis = objAnalysis
+        self.__blnLazy = blnLazy
+        self.__dctOffsets = dict()
+        self.__dctHeaders = dict()
+        self.__dctCachedSteps = dict()
+        self.__CacheValues = None
+        self.__Dfile = None
+        self.__Columns = lstColumns
+        self.__ChunkSize = 65536 #rows converted at a time so only the selected columns of a timestep are held in full
         lstNumberOfAtoms = []
         lstTimeSteps = []
-        lstColumnNames = []
-        lstBoundaryType = []
         self.__Dimensions = 3 # assume 3d unless file shows the problem is 2d
-        intRow = 0
-        with open(strFilename) as Dfile:
+        dctCache = None
+        if blnCache:
+            dctCache = self.ReadCache()
+        if dctCache is not None: #the binary cache is memory mapped so timesteps are views of the cache file
+            for dctStep in dctCache['TimeSteps']:
+                lstTimeSteps.append(dctStep['TimeStep'])
+                lstNumberOfAtoms.append(dctStep['NumberOfAtoms'])
+                self.__dctCachedSteps[str(dctStep['TimeStep'])] = dctStep
+                if len(dctStep['Bounds']) == 2:
+                    self.__Dimensions = 2
+            if not(blnLazy):
+                for intTimeStep in lstTimeSteps:
+                    self.GetTimeStep(str(intTimeStep))
+        elif blnLazy: #only record where each timestep starts and parse it when it is requested
+            lstIndex = self.ReadIndexFile()
+            if lstIndex is None:
+                lstIndex = self.MakeIndex()
+                self.WriteIndexFile(lstIndex)
+            for lstEntry in lstIndex:
+                lstTimeSteps.append(lstEntry[0])
+                lstNumberOfAtoms.append(lstEntry[2])
+                self.__dctOffsets[str(lstEntry[0])] = lstEntry[1]
+        else:
+            with OpenDumpFile(strFilename) as Dfile:
+                while True:
+                    intOffset = Dfile.tell()
+                    tupHeader = self.__ReadHeader(Dfile)
+                    if tupHeader is None:
+                        break
+                    objTimeStep = self.__ReadAtoms(Dfile, *tupHeader)
+                    lstTimeSteps.append(tupHeader[0])
+                    lstNumberOfAtoms.append(tupHeader[1])
+                    self.__dctOffsets[str(tupHeader[0])] = intOffset
+                    self.__dctTimeSteps[str(tupHeader[0])] = objTimeStep
+                Dfile.close()
+        self.__lstTimeSteps = lstTimeSteps
+        self.__lstNumberOfAtoms = lstNumberOfAtoms
+        if blnCache and dctCache is None:
+            self.WriteCache()
+    def __ReadHeader(self, Dfile):
+        line = Dfile.readline()
+        if len(line) == 0:
+            return None
+        line = line.decode().strip()
+        if "ITEM: TIMESTEP" != line:
+            raise Exception("Unexpected "+repr(line))
+        timestep = int(Dfile.readline().decode().strip())
+        line = Dfile.readline().decode().strip()
+        if "ITEM: NUMBER OF ATOMS" != line:
+            raise Exception("Unexpected "+repr(line))
+        N = int(Dfile.readline().decode().strip())
+        line = Dfile.readline().decode().strip()
+        if "ITEM: BOX BOUNDS" != line[0:16]:
+            raise Exception("Unexpected "+repr(line))
+        lstBoundaryType = line[17:].strip().split()
+        lstBounds = []
+        lstBounds.append(list(map(float, Dfile.readline().decode().strip().split())))
+        lstBounds.append(list(map(float, Dfile.readline().decode().strip().split())))
+        if len(lstBoundaryType)%3 == 0:
+            lstBounds.append(list(map(float, Dfile.readline().decode().strip().split())))
+        else:
+            self.__Dimensions = 2
+        line = Dfile.readline().decode().strip()
+        if "ITEM: ATOMS id" != line[0:14]:
+            raise Exception("Unexpected "+repr(line))
+        lstColumnNames = line[11:].strip().split()
+        return timestep, N, lstBoundaryType, lstBounds, lstColumnNames
+    def __SelectColumns(self, lstColumnNames: list)->list: #indices of the loaded columns in the order they appear in the dump file
+        if self.__Columns is None:
+            return list(range(len(lstColumnNames)))
+        lstMissing = list(filter(lambda x: x not in lstColumnNames, self.__Columns))
+        if len(lstMissing) > 0:
+            raise Exception('Columns ' + ', '.join(lstMissing) + ' are not in ' + self.__FileName)
+        return list(filter(lambda x: lstColumnNames[x] == 'id' or lstColumnNames[x] in self.__Columns, range(len(lstColumnNames))))
+    def __ReadAtoms(self, Dfile, timestep: int, N: int, lstBoundaryType: list, lstBounds: list, lstColumnNames: list):
+        intNumberOfColumns = len(lstColumnNames)
+        lstSelected = self.__SelectColumns(lstColumnNames)
+        arrValues = np.zeros([N, len(lstSelected)])
+        line = lstColumnNames
+        for i in range(0, N, self.__ChunkSize): #stream the ITEM: ATOMS block and convert each chunk in one pass
+            intRows = min(self.__ChunkSize, N - i)
+            lstLines = list(it.islice(Dfile, intRows))
+            if len(lstLines) != intRows:
+                raise Exception('Unexpected end of file in timestep ' + str(timestep))
+            arrChunk = np.fromstring(b''.join(lstLines), sep=' ')
+            if len(arrChunk) != intRows*intNumberOfColumns:
+                raise Exception('Expected ' + str(intRows*intNumberOfColumns) + ' values in rows ' + str(i) + ' to ' + str(i+intRows) + ' of timestep ' + str(timestep) + ' but found ' + str(len(arrChunk)))
+            arrValues[i:i+intRows] = np.reshape(arrChunk, (intRows, intNumberOfColumns))[:, lstSelected]
+            line = lstLines[-1].decode().strip().split()
+        lstColumnTypes = []
+        for j in line:
+            if "." in j:
+                lstColumnTypes.append('%s')
+            else:
+                lstColumnTypes.append('%i')
+        lstColumnNames = list(map(lambda x: lstColumnNames[x], lstSelected))
+        lstColumnTypes = list(map(lambda x: lstColumnTypes[x], lstSelected))
+        self.__dctHeaders[str(timestep)] = [timestep, N, lstBoundaryType, lstBounds, list(lstColumnNames), list(lstColumnTypes)]
+        return self.__MakeTimeStep(timestep, N, lstBoundaryType, lstBounds, lstColumnNames, lstColumnTypes, arrValues)
+    def __MakeTimeStep(self, timestep: int, N: int, lstBoundaryType: list, lstBounds: list, lstColumnNames: list, lstColumnTypes: list, arrValues: np.array):
+        intNumberOfColumns = len(lstColumnNames)
+        objTimeStep = self.__Analysis(timestep, N,intNumberOfColumns,lstColumnNames, lstBoundaryType, lstBounds,self.__LatticeType, self.__LatticeParameter)
+        objTimeStep.SetColumnNames(lstColumnNames)
+        objTimeStep.SetAtomData(arrValues)
+        objTimeStep.SetColumnTypes(lstColumnTypes) 
+        objTimeStep.CategoriseAtoms()
+        objTimeStep.SetFileName(self.__FileName)
+        return objTimeStep
+    def MakeIndex(self)->list: #each entry is [timestep, byte offset, number of atoms]
+        lstIndex = []
+        with OpenDumpFile(self.__FileName) as Dfile:
             while True:
-                lstBounds = []
-                try:
-                    line = next(Dfile).strip()
-                    intRow +=1
-                except StopIteration as EndOfFile:
+                intOffset = Dfile.tell() #offsets are positions in the decompressed stream for compressed files
+                tupHeader = self.__ReadHeader(Dfile)
+                if tupHeader is None:
                     break
-                if "ITEM: TIMESTEP" != line:
-                    raise Exception("Unexpected "+repr(line))
-                timestep = int(next(Dfile).strip())
-                intRow +=1
-                lstTimeSteps.append(timestep)
-                line = next(Dfile).strip()
-                intRow +=1
-                if "ITEM: NUMBER OF ATOMS" != line:
-                    raise Exception("Unexpected "+repr(line))
-                N = int(next(Dfile).strip())
-                intRow +=1
-                lstNumberOfAtoms.append(N)
-                line = next(Dfile).strip()
-                intRow +=1
-                if "ITEM: BOX BOUNDS" != line[0:16]:
-                    raise Exception("Unexpected "+repr(line))
-                lstBoundaryType = line[17:].strip().split()
-                lstBounds.append(list(map(float, next(Dfile).strip().split())))
-                lstBounds.append(list(map(float, next(Dfile).strip().split())))
-                intRow +=2
-                if len(lstBoundaryType)%3 == 0:
-                    lstBounds.append(list(map(float, next(Dfile).strip().split())))
-                    intRow +=1
-                else:
-                    self.__Dimensions = 2
-                line = next(Dfile).strip()
-                intRow +=1
-                if "ITEM: ATOMS id" != line[0:14]:
-                    raise Exception("Unexpected "+repr(line))
-                lstColumnNames = line[11:].strip().split()
-                intNumberOfColumns = len(lstColumnNames)
-                objTimeStep = objAnalysis(timestep, N,intNumberOfColumns,lstColumnNames, lstBoundaryType, lstBounds,intLatticeType, fltLatticeParameter)
-                objTimeStep.SetColumnNames(lstColumnNames)
-                #arrValues = np.loadtxt(strFilename, skiprows =intRow , max_rows=N)
-                #objTimeStep.SetAtomData(arrValues)
-                intRow += N
-                for i in range(N):
-                     line = next(Dfile).strip().split()
-                     objTimeStep.SetRow(i,list(map(float,line)))
-                lstColumnTypes = []
-                for j in line:
-                    if "." in j:
-                        lstColumnTypes.append('%s')
-                    else:
-                        lstColumnTypes.append('%i')
-                objTimeStep.SetColumnTypes(lstColumnTypes) 
-                objTimeStep.CategoriseAtoms()
-                objTimeStep.SetFileName(strFilename)
-                self.__dctTimeSteps[str(timestep)] = objTimeStep            
+                lstIndex.append([tupHeader[0], intOffset, tupHeader[1]])
+                for line in it.islice(Dfile, tupHeader[1]): #skip the atom rows without converting them
+                    pass
             Dfile.close()
-            self.__lstTimeSteps = lstTimeSteps
-            self.__lstNumberOfAtoms = lstNumberOfAtoms
+        return lstIndex
+    def __OpenAt(self, intOffset: int):
+        #compressed streams can't seek directly so one handle is kept open and read forward to the offset. Timesteps requested
+        #in file order are then only decompressed once and an earlier timestep restarts the stream from the beginning.
+        if not(IsCompressedDumpFile(self.__FileName)):
+            Dfile = open(self.__FileName, 'rb')
+            Dfile.seek(intOffset)
+            return Dfile
+        if self.__Dfile is None or self.__Dfile.tell() > intOffset:
+            if self.__Dfile is not None:
+                self.__Dfile.close()
+            self.__Dfile = OpenDumpFile(self.__FileName)
+        intSkip = intOffset - self.__Dfile.tell()
+        while intSkip > 0:
+            intRead = len(self.__Dfile.read(min(intSkip, 2**24)))
+            if intRead == 0:
+                raise Exception('Unexpected end of file in ' + self.__FileName)
+            intSkip -= intRead
+        return self.__Dfile
+    def __CloseAt(self, Dfile):
+        if Dfile is not self.__Dfile:
+            Dfile.close()
+    def GetIndexFileName(self)->str:
+        return self.__FileName + '.idx'
+    def ReadIndexFile(self): #returns None if the index is missing or was made from a different version of the dump file
+        strIndexFile = self.GetIndexFileName()
+        if not os.path.isfile(strIndexFile):
+            return None
+        objStat = os.stat(self.__FileName)
+        lstIndex = []
+        with open(strIndexFile) as Ifile:
+            lstCheck = Ifile.readline().strip().split()
+            if lstCheck != [str(objStat.st_size), str(objStat.st_mtime_ns)]:
+                return None
+            for line in Ifile:
+                lstIndex.append(list(map(int, line.strip().split())))
+            Ifile.close()
+        return lstIndex
+    def WriteIndexFile(self, lstIndex: list):
+        objStat = os.stat(self.__FileName)
+        try:
+            with open(self.GetIndexFileName(), 'w') as Ifile:
+                Ifile.write(str(objStat.st_size) + ' ' + str(objStat.st_mtime_ns) + '\n')
+                for lstEntry in lstIndex:
+                    Ifile.write(' '.join(map(str, lstEntry)) + '\n')
+                Ifile.close()
+        except OSError:
+            warnings.warn('Unable to write index file ' + self.GetIndexFileName())
+    def IsLazy(self)->bool:
+        return self.__blnLazy
     def GetTimeSteps(self):
         return self.__lstTimeSteps
     def GetAtomNumbers(self):
         return self.__lstNumberOfAtoms
+    def GetCacheFileNames(self)->tuple: #binary atom data and the text description of each timestep
+        return self.__FileName + '.cache.npy', self.__FileName + '.cache.json'
+    def ReadCache(self): #returns None if there is no cache or the dump file has changed since it was written
+        strDataFile, strMetaFile = self.GetCacheFileNames()
+        if not(os.path.isfile(strDataFile)) or not(os.path.isfile(strMetaFile)):
+            return None
+        objStat = os.stat(self.__FileName)
+        with open(strMetaFile) as Mfile:
+            dctCache = json.load(Mfile)
+            Mfile.close()
+        if dctCache['Size'] != objStat.st_size or dctCache['MTime'] != objStat.st_mtime_ns:
+            return None
+        if self.__Columns is None and not(dctCache.get('AllColumns', False)): #a cache written from a subset of the columns can't serve a full read
+            return None
+        for dctStep in dctCache['TimeSteps']: #the cache holds the columns it was written with so it can only serve a subset of them
+            lstSelected = self.__SelectCachedColumns(dctStep['ColumnNames'])
+            if lstSelected is None:
+                return None
+            dctStep['Columns'] = lstSelected
+        self.__CacheValues = np.load(strDataFile, mmap_mode='c') #copy on write so analysis can still change the atom data
+        return dctCache
+    def __SelectCachedColumns(self, lstColumnNames: list): #returns None if a requested column is not in the cache
+        if self.__Columns is None:
+            return list(range(len(lstColumnNames)))
+        if any(map(lambda x: x not in lstColumnNames, self.__Columns)):
+            return None
+        return list(filter(lambda x: lstColumnNames[x] == 'id' or lstColumnNames[x] in self.__Columns, range(len(lstColumnNames))))
+    def WriteCache(self):
+        if len(set(map(lambda x: len(self.__ReadHeaderAt(x)[4]), self.__lstTimeSteps))) > 1:
+            warnings.warn('Number of columns changes between timesteps so no cache has been written for ' + self.__FileName)
+            return
+        strDataFile, strMetaFile = self.GetCacheFileNames()
+        objStat = os.stat(self.__FileName)
+        lstSteps = []
+        intRows = sum(self.__lstNumberOfAtoms)
+        intColumns = 0
+        if len(self.__lstTimeSteps) > 0:
+            intColumns = len(self.__ReadHeaderAt(self.__lstTimeSteps[0])[4])
+        strDirectory = os.path.dirname(os.path.abspath(strDataFile))
+        lstTemporary = []
+        try:
+            if os.path.isfile(strMetaFile): #without a description a crash part way through can't leave an old one next to new data
+                os.remove(strMetaFile)
+            intMask = os.umask(0)
+            os.umask(intMask)
+            for strSuffix in ['.npy', '.json']:
+                intHandle, strTemporary = tempfile.mkstemp(prefix=os.path.basename(self.__FileName) + '.', suffix=strSuffix, dir=strDirectory)
+                os.close(intHandle)
+                os.chmod(strTemporary, 0o666 & ~intMask) #mkstemp only gives the owner access
+                lstTemporary.append(strTemporary)
+            arrCache = np.lib.format.open_memmap(lstTemporary[0], mode='w+', dtype=np.float64, shape=(intRows, intColumns)) #a new file as the old cache may still be mapped by another LAMMPSData
+            intRow = 0
+            for intTimeStep in self.__lstTimeSteps:
+                strTimeStep = str(intTimeStep)
+                if strTimeStep in self.__dctTimeSteps: #already parsed and not yet changed by any analysis
+                    arrValues = self.__dctTimeSteps[strTimeStep].GetAtomData()
+                else: #lazy mode so parse one step at a time and don't keep it
+                    Dfile = self.__OpenAt(self.__dctOffsets[strTimeStep])
+                    arrValues = self.__ReadAtoms(Dfile, *self.__ReadHeader(Dfile)).GetAtomData()
+                    self.__CloseAt(Dfile)
+                lstHeader = self.__dctHeaders[strTimeStep]
+                arrCache[intRow:intRow+lstHeader[1]] = arrValues[:, :intColumns]
+                lstSteps.append({'TimeStep': lstHeader[0], 'NumberOfAtoms': lstHeader[1], 'Row': intRow, 'BoundaryTypes': lstHeader[2],
+                'Bounds': lstHeader[3], 'ColumnNames': lstHeader[4], 'ColumnTypes': lstHeader[5]})
+                intRow += lstHeader[1]
+            arrCache.flush()
+            del arrCache
+            with open(lstTemporary[1], 'w') as Mfile:
+                json.dump({'Size': objStat.st_size, 'MTime': objStat.st_mtime_ns, 'AllColumns': self.__Columns is None, 'TimeSteps': lstSteps}, Mfile)
+                Mfile.close()
+            os.replace(lstTemporary[0], strDataFile) #existing maps keep the old file
+            os.replace(lstTemporary[1], strMetaFile) #the description goes last so it always matches the data
+            lstTemporary = []
+        except OSError:
+            warnings.warn('Unable to write cache files for ' + self.__FileName)
+        finally:
+            for strTemporary in lstTemporary: #a failed write leaves no temporary file behind
+                try:
+                    os.remove(strTemporary)
+                except OSError:
+                    pass
+    def __ReadHeaderAt(self, intTimeStep: int):
+        strTimeStep = str(intTimeStep)
+        if strTimeStep not in self.__dctHeaders:
+            Dfile = self.__OpenAt(self.__dctOffsets[strTimeStep])
+            tupHeader = self.__ReadHeader(Dfile)
+            self.__CloseAt(Dfile)
+            return tupHeader[:4] + (list(map(lambda x: tupHeader[4][x], self.__SelectColumns(tupHeader[4]))),)
+        return self.__dctHeaders[strTimeStep]
     def GetTimeStep(self, strTimeStep: str):
+        if strTimeStep not in self.__dctTimeSteps and strTimeStep in self.__dctCachedSteps:
+            dctStep = self.__dctCachedSteps[strTimeStep]
+            intRow = dctStep['Row']
+            lstSelected = dctStep['Columns']
+            arrValues = self.__CacheValues[intRow:intRow+dctStep['NumberOfAtoms']]
+            if len(lstSelected) < len(dctStep['ColumnNames']):
+                arrValues = arrValues[:, lstSelected]
+            self.__dctTimeSteps[strTimeStep] = self.__MakeTimeStep(dctStep['TimeStep'], dctStep['NumberOfAtoms'], list(dctStep['BoundaryTypes']), 
+            copy.deepcopy(dctStep['Bounds']), list(map(lambda x: dctStep['ColumnNames'][x], lstSelected)), list(map(lambda x: dctStep['ColumnTypes'][x], lstSelected)), arrValues)
+        elif strTimeStep not in self.__dctTimeSteps and strTimeStep in self.__dctOffsets:
+            Dfile = self.__OpenAt(self.__dctOffsets[strTimeStep])
+            tupHeader = self.__ReadHeader(Dfile)
+            self.__dctTimeSteps[strTimeStep] = self.__ReadAtoms(Dfile, *tupHeader)
+            self.__CloseAt(Dfile)
         return self.__dctTimeSteps[strTimeStep]
     def GetTimeStepByIndex(self, intIndex : int):
-        return self.__dctTimeSteps[str(self.__lstTimeSteps[intIndex])]
+        return self.GetTimeStep(str(self.__lstTimeSteps[intIndex]))
+    def ReleaseTimeStep(self, strTimeStep: str): #lazy mode only; the timestep is parsed again if it is requested later
+        if self.__blnLazy and strTimeStep in self.__dctTimeSteps:
+            del self.__dctTimeSteps[strTimeStep]
+    def CloseFile(self): #releases the handle kept open between timesteps of a lazily read compressed dump file
+        if self.__Dfile is not None:
+            self.__Dfile.close()
+            self.__Dfile = None
     def GetNumberOfDimensions(self)-> int:
         return self.__Dimensions 
               
+def ApplyToDumpFile(tupArguments: tuple)->list: #reads one dump file and returns [timestep, result] for each of its timesteps
+    strFilename, fnTimeStep, intLatticeType, fltLatticeParameter, objAnalysis, blnLazy, blnCache, lstColumns = tupArguments
+    objData = LAMMPSData(strFilename, intLatticeType, fltLatticeParameter, objAnalysis, blnLazy, blnCache, lstColumns)
+    lstResults = []
+    for intTimeStep in objData.GetTimeSteps():
+        lstResults.append([intTimeStep, fnTimeStep(objData.GetTimeStep(str(intTimeStep)))])
+        objData.ReleaseTimeStep(str(intTimeStep))
+    objData.CloseFile()
+    return lstResults
+
+def MapOverDumpFiles(lstFilenames: list, fnTimeStep, intLatticeType: int, fltLatticeParameter: float, objAnalysis: object, intWorkers = 1, blnLazy = False, blnCache = False, lstColumns = None):
+    #yields [timestep, fnTimeStep(objTimeStep)] in the order of lstFilenames and then the order of the timesteps in each file. 
+    #fnTimeStep must be a module level function so it can be sent to the worker processes. By default intWorkers = 1 runs 
+    #everything in this process, intWorkers = n uses a pool of n processes and intWorkers = None uses every core.
+    lstArguments = list(map(lambda x: (x, fnTimeStep, intLatticeType, fltLatticeParameter, objAnalysis, blnLazy, blnCache, lstColumns), lstFilenames))
+    if intWorkers is not None and intWorkers <= 1:
+        for tupArguments in lstArguments:
+            for lstResult in ApplyToDumpFile(tupArguments):
+                yield lstResult
+    else:
+        with multiprocessing.Pool(intWorkers) as objPool:
+            for lstResults in objPool.imap(ApplyToDumpFile, lstArguments): #imap keeps the submission order and returns each file as soon as it is ready
+                for lstResult in lstResults:
+                    yield lstResult
+
 class LAMMPSTimeStep(object):
     def __init__(self,fltTimeStep: float,intNumberOfAtoms: int, lstColumnNames: list, lstBoundaryType: list, lstBounds: list):
         self.__Dimensions = 3 #assume three dimensional unless specificed otherwise
@@ -211,9 +491,13 @@ class LAMMPSTimeStep(object):
         self.__NumberOfAtoms = intNumberOfAtoms
         self.__NumberOfColumns = len(lstColumnNames)
         self.__TimeStep = fltTimeStep
-        self.__AtomData = np.zeros([intNumberOfAtoms,self.__NumberOfColumns])
+        self.__SpareColumns = 8 #extra columns allocated whenever the atom data buffer has to grow
+        self.__AtomBuffer = np.zeros([intNumberOfAtoms,self.__NumberOfColumns])
+        self.__AtomData = self.__AtomBuffer #always a view of the first columns of the buffer
         self.__ColumnNames = lstColumnNames
         self.__ColumnTypes = []
+        self.__IDIndex = None #maps atom IDs to rows of the atom data and is rebuilt only when the IDs change
+        self.__NeighbourList = None #periodic tree over all atom positions shared by the analysis stages
         self.SetBoundBoxLabels(lstBoundaryType)
         self.SetBoundBoxDimensions(lstBounds)
     def DeleteColumnByIndex(self,intColumnIndex: int):
@@ -221,6 +505,11 @@ class LAMMPSTimeStep(object):
             self.__ColumnNames.pop(intColumnIndex)
             self.__ColumnTypes.pop(intColumnIndex)
             self.__AtomData = np.delete(self.__AtomData,intColumnIndex,1)
+            self.__AtomBuffer = self.__AtomData
+            if intColumnIndex == 0:
+                self.ResetIDIndex()
+            elif intColumnIndex < 4:
+                self.ResetNeighbourList()
     def DeleteColumnByName(self,strColumnName: str):
         if strColumnName in self.__ColumnNames:
             intColumnIndex = self.GetColumnIndex(strColumnName)
@@ -233,34 +522,99 @@ class LAMMPSTimeStep(object):
         return len(self.__ColumnNames)
     def SetColumnByIndex(self, arrColumn:np.array, intColumnIndex: int):
         self.__AtomData[:, intColumnIndex] = arrColumn
+        if intColumnIndex == 0:
+            self.ResetIDIndex()
+        elif intColumnIndex < 4:
+            self.ResetNeighbourList()
+    def ResetIDIndex(self): #must be called whenever atoms are added, removed or renumbered
+        self.__IDIndex = None
+    def ResetNeighbourList(self): #must be called whenever atoms are added, removed or moved
+        self.__NeighbourList = None
+    def GetNeighbourList(self, fltCutoff: float): #built once with the largest cutoff requested so far and reused for smaller radii
+        if self.__NeighbourList is None or self.__NeighbourList.GetCutoff() < fltCutoff:
+            self.__NeighbourList = gf.PeriodicNeighbourList(self.__AtomData[:,1:4], self.GetCellVectors(), fltCutoff, self.GetPeriodicDirections())
+        return self.__NeighbourList
+    def __BuildIDIndex(self):
+        arrIDs = self.__AtomData[:,0]
+        intLength = len(arrIDs)
+        if intLength == 0 or np.any(np.mod(arrIDs,1) != 0) or len(np.unique(arrIDs)) != intLength:
+            self.__IDIndex = ('isin',) #non-integer or repeated IDs so fall back to np.isin
+        elif np.min(arrIDs) >= 0 and np.max(arrIDs) <= 2*intLength + 1000: #LAMMPS IDs are usually dense so use a direct lookup table
+            arrLookup = -np.ones(int(np.max(arrIDs))+1, dtype='int64')
+            arrLookup[arrIDs.astype('int64')] = np.arange(intLength)
+            self.__IDIndex = ('table', arrLookup)
+        else:
+            arrOrder = np.argsort(arrIDs)
+            self.__IDIndex = ('sorted', arrIDs[arrOrder], arrOrder)
+    def GetRowsByIDs(self, lstOfAtomIDs: list)->np.array: #rows are in atom data order and missing or repeated IDs are ignored, as with np.isin
+        if self.__IDIndex is None:
+            self.__BuildIDIndex()
+        arrIDs = np.asarray(lstOfAtomIDs, dtype='float').ravel()
+        if self.__IDIndex[0] == 'isin':
+            return np.where(np.isin(self.__AtomData[:,0], arrIDs))[0]
+        elif self.__IDIndex[0] == 'table':
+            arrLookup = self.__IDIndex[1]
+            arrIDs = arrIDs[(arrIDs >= 0) & (arrIDs < len(arrLookup)) & (np.mod(arrIDs,1) == 0)]
+            arrRows = arrLookup[arrIDs.astype('int64')]
+            arrRows = arrRows[arrRows >= 0]
+        else:
+            arrSortedIDs = self.__IDIndex[1]
+            arrPositions = np.searchsorted(arrSortedIDs, arrIDs)
+            arrPositions[arrPositions == len(arrSortedIDs)] = 0
+            arrRows = self.__IDIndex[2][arrPositions[arrSortedIDs[arrPositions] == arrIDs]]
+        return np.unique(arrRows)
     def GetColumnByIDs(self,lstOfAtomIDs: list, intColumn: int):
-        return self.__AtomData[np.isin(self.__AtomData[:,0], lstOfAtomIDs), intColumn]     
+        return self.__AtomData[self.GetRowsByIDs(lstOfAtomIDs), intColumn]     
     def SetColumnByIDs(self,lstOfAtomIDs: list, intColumn: int, arrValues: np.array):
-        self.__AtomData[np.isin(self.__AtomData[:,0], lstOfAtomIDs), intColumn] = arrValues
+        self.__AtomData[self.GetRowsByIDs(lstOfAtomIDs), intColumn] = arrValues
+        if intColumn == 0:
+            self.ResetIDIndex()
+        elif intColumn < 4:
+            self.ResetNeighbourList()
     def SetRow(self, intRowNumber: int, lstRow: list):
         self.__AtomData[intRowNumber] = lstRow
+        self.ResetIDIndex()
+        self.ResetNeighbourList()
     def AddColumn(self, arrColumn: np.array, strColumnName: str, strFormat = '%s'):
         if strColumnName not in self.__ColumnNames:
-            self.__AtomData = np.append(self.__AtomData, arrColumn, axis=1)
+            intColumns = np.shape(self.__AtomData)[1]
+            if np.shape(self.__AtomBuffer)[1] <= intColumns: #buffer is full so copy once into a wider buffer with spare columns
+                arrBuffer = np.zeros([np.shape(self.__AtomData)[0], intColumns + self.__SpareColumns])
+                arrBuffer[:, :intColumns] = self.__AtomData
+                self.__AtomBuffer = arrBuffer
+            self.__AtomBuffer[:, intColumns] = np.ravel(arrColumn)
+            self.__AtomData = self.__AtomBuffer[:, :intColumns+1]
             self.__ColumnNames.append(strColumnName)
-            self.__ColumnTypes += ' ' + strFormat
+            self.__ColumnTypes.append(strFormat)
     def SetColumnToZero(self, strColumnName: str):
         arrColumn = np.zeros(self.GetNumberOfAtoms())
         intColumnIndex = self.GetColumnIndex(strColumnName)
         self.__AtomData[:,intColumnIndex] = arrColumn
+        if intColumnIndex == 0:
+            self.ResetIDIndex()
+        elif intColumnIndex < 4:
+            self.ResetNeighbourList()
     def GetRow(self,intRowNumber: int):
         return self.__AtomData[intRowNumber]
     def GetRows(self, lstOfRows: list):
         return self.__AtomData[lstOfRows,:]
     def GetAtomsByID(self, lstOfAtomIDs: list, intAtomColumn = 0):
-        return self.__AtomData[np.isin(self.__AtomData[:,intAtomColumn],lstOfAtomIDs)]
+        if intAtomColumn == 0:
+            return self.__AtomData[self.GetRowsByIDs(lstOfAtomIDs)]
+        else:
+            return self.__AtomData[np.isin(self.__AtomData[:,intAtomColumn],lstOfAtomIDs)]
     def SetAtomData(self, inArray:np.array):
         self.__AtomData= inArray
+        self.__AtomBuffer = inArray
+        self.ResetIDIndex()
+        self.ResetNeighbourList()
     def GetAtomData(self):
         return self.__AtomData
     def SetColumnNames(self, lstColumnNames):
         self.__ColumnNames = lstColumnNames
     def GetColumnIndex(self, strColumnName):
+        if strColumnName not in self.__ColumnNames:
+            raise Exception('Column ' + strColumnName + ' has not been loaded for timestep ' + str(self.GetTimeStep()) + '; add it to lstColumns when reading the dump file')
         return self.__ColumnNames.index(strColumnName) 
     def GetColumnNames(self): 
         return self.__ColumnNames
@@ -268,7 +622,7 @@ class LAMMPSTimeStep(object):
         return self.__AtomData[:,intStructureIndex]
     def GetColumnByName(self, strColumnName: str):
         if self.__ColumnNames != []:
-            intStructureIndex = self.__ColumnNames.index(strColumnName)
+            intStructureIndex = self.GetColumnIndex(strColumnName)
             return self.GetColumnByIndex(intStructureIndex)
     def SetBoundBoxLabels(self, lstBoundBox: list):
         self.__BoundBoxLabels = lstBoundBox
@@ -352,9 +706,9 @@ class LAMMPSTimeStep(object):
     def PeriodicMinimumDistance(self, inVector1: np.array, inVector2: np.array)->float:
         return gf.PeriodicMinimumDistance(inVector1, inVector2, self.__CellVectors, self.__BasisConversion, self.__BoundaryTypes)
     def StandardiseOrientationData(self):
-        self.__AtomData[:, [self.GetColumnNames().index('OrientationX'),self.GetColumnNames().index('OrientationY'),self.GetColumnNames().index('OrientationZ'), self.GetColumnNames().index('OrientationW')]]=np.apply_along_axis(gf.FCCQuaternionEquivalence,1,self.GetOrientationData()) 
+        self.__AtomData[:, [self.GetColumnIndex('OrientationX'),self.GetColumnIndex('OrientationY'),self.GetColumnIndex('OrientationZ'), self.GetColumnIndex('OrientationW')]]=np.apply_along_axis(gf.FCCQuaternionEquivalence,1,self.GetOrientationData()) 
     def GetOrientationData(self)->np.array:
-        return (self.__AtomData[:, [self.GetColumnNames().index('OrientationX'),self.GetColumnNames().index('OrientationY'),self.GetColumnNames().index('OrientationZ'), self.GetColumnNames().index('OrientationW')]])  
+        return (self.__AtomData[:, [self.GetColumnIndex('OrientationX'),self.GetColumnIndex('OrientationY'),self.GetColumnIndex('OrientationZ'), self.GetColumnIndex('OrientationW')]])  
     def GetData(self, inDimensions: np.array, lstOfColumns):
         return np.where(self.__AtomData[:,lstOfColumns])
     def GetBoundingBox(self):
@@ -380,7 +734,9 @@ class LAMMPSTimeStep(object):
             for j in range(3):
                 strHeader += str(self.__BoundBoxDimensions[j,0]) + ' ' + str(self.__BoundBoxDimensions[j,1]) + ' '  + str(self.__BoundBoxDimensions[j,2]) + '\n'
         strHeader += 'ITEM: ATOMS ' + ' '.join(self.__ColumnNames)
-        np.savetxt(strFilename, self.GetAtomData(), fmt= ' '.join(self.__ColumnTypes), header=strHeader, comments='')
+        with OpenDumpFile(strFilename, 'wb') as Ofile: #compressed by the extension of strFilename
+            Ofile.write((strHeader + '\n').encode('latin1'))
+            mf.WriteFormattedRows(Ofile, ' '.join(self.__ColumnTypes) + '\n', self.GetAtomData())
     def WriteDataFile(self, strFilename: str, blnIncludeVelocities = False):
         now = datetime.now()
         strDateTime = now.strftime("%d/%m/%Y %H:%M:%S")
@@ -405,12 +761,14 @@ class LAMMPSTimeStep(object):
         arrValues = np.ones([self.GetNumberOfAtoms(),intCols]) ##currently hard coded to atom type 1
         arrValues[:,0] = self.GetAtomData()[:,0]
         arrValues[:,2:intCols] = self.GetAtomData()[:,1:intCols-1]
-        np.savetxt(strFilename, arrValues, fmt = strFormat, header=strHeader, comments='')
-        if blnIncludeVelocities:
-            strHeader = '\nVelocities \n '
-            arrValues = self.GetAtomData()[:,[0,5,6,7]]
-            f = open(strFilename,'a')
-            np.savetxt(f,arrValues, fmt = "%d " "%.6f " "%.6f " "%.6f ", header=strHeader,comments='')
+        with open(strFilename, 'wb') as f:
+            f.write((strHeader + '\n').encode('latin1'))
+            mf.WriteFormattedRows(f, strFormat + '\n', arrValues)
+            if blnIncludeVelocities:
+                strHeader = '\nVelocities \n '
+                arrValues = self.GetAtomData()[:,[0,5,6,7]]
+                f.write((strHeader + '\n').encode('latin1'))
+                mf.WriteFormattedRows(f, "%d " "%.6f " "%.6f " "%.6f " + '\n', arrValues)
             f.close()
 
 class LAMMPSPostProcess(LAMMPSTimeStep):
@@ -432,9 +790,9 @@ class LAMMPSPostProcess(LAMMPSTimeStep):
             self._intPE = int(self.GetColumnNames().index('c_pe1'))
         else:
             warnings.warn('Per atom potential energy is missing.')
-        self._intPositionX = int(self.GetColumnNames().index('x'))
-        self._intPositionY = int(self.GetColumnNames().index('y'))
-        self._intPositionZ = int(self.GetColumnNames().index('z'))
+        self._intPositionX = int(self.GetColumnIndex('x'))
+        self._intPositionY = int(self.GetColumnIndex('y'))
+        self._intPositionZ = int(self.GetColumnIndex('z'))
         self.CellHeight = np.linalg.norm(self.GetCellVectors()[2])
         self.__fltGrainTolerance = 1.96
         self.__DefectiveAtomIDs = []
@@ -453,7 +811,7 @@ class LAMMPSPostProcess(LAMMPSTimeStep):
     def GetPlaneNormalVectors(self):
         return self.__PlaneNormalVectors
     def CategoriseAtoms(self, fltTolerance = None):    
-        if 'StructureType' in self.GetColumnNames() or 'c_pt[1]' in self.GetColumnNames():
+        if ('StructureType' in self.GetColumnNames() or 'c_pt[1]' in self.GetColumnNames()) and 'c_pe1' in self.GetColumnNames(): #both are needed to find the defective atoms
             self.__DefectiveAtomIDs = []
             self.__NonDefectiveAtomIDs = []
             lstOtherAtoms = list(np.where(self.GetColumnByIndex(self._intStructureType).astype('int') == 0)[0])
@@ -475,6 +833,9 @@ class LAMMPSPostProcess(LAMMPSTimeStep):
     def GetNonLatticeAtomIDs(self):
         return self.__NonLatticeAtomIDs  
     def FindDefectiveAtoms(self, fltTolerance = None):
+        self.GetColumnIndex('c_pe1')
+        if not(hasattr(self, '_intStructureType')):
+            raise Exception('Column StructureType or c_pt[1] has not been loaded for timestep ' + str(self.GetTimeStep()) + '; add it to lstColumns when reading the dump file')
         if fltTolerance is None:
             if self.GetNumberOfNonPTMAtoms() > 0:
                 fltThreshold = np.mean(self.GetNonPTMAtoms()[:,self.GetColumnIndex('c_pe1')])
@@ -632,6 +993,65 @@ class LAMMPSPostProcess(LAMMPSTimeStep):
             lstIndices.extend(gf.ArcSegment(arrPoints[:,1:4], arrCentre, arrVector1, arrVector2, fltRadius,fltHeight))
         return list(arrPoints[lstIndices,0])
     
+def MeshAtomIDsFromTrees(lstTrees: list, arrPoints: np.array, arrIDs: np.array, fltMaxGBWidth: float, fltWidth: float): #IDs of the points close to every grain tree and the mean of their nearest grain points
+    arrAllPoints = np.zeros([len(arrPoints),3,len(lstTrees)])
+    lstAllDistances = []
+    for i, objTree in enumerate(lstTrees):
+        arrDistances1, arrIndices1 = objTree.Pquery(arrPoints, k=1)
+        arrAllPoints[:,:,i] = objTree.GetExtendedPoints()[arrIndices1[:,0]]
+        lstAllDistances.append(arrDistances1[:,0])
+    arrMean = np.mean(arrAllPoints,axis=2)
+    arrMeanDistances = np.linalg.norm(arrPoints - arrMean, axis=1)
+    arrAllDistances = np.transpose(np.vstack(lstAllDistances))
+    arrRows1 = np.where(np.all(arrAllDistances <= fltMaxGBWidth,axis=1))[0]
+    arrRows2 = np.where(arrMeanDistances <= fltWidth)[0]
+    arrReturn = []
+    arrMeanPoints = []
+    if len(arrRows1) > 0 and len(arrRows2) >0:
+        arrRows = np.intersect1d(arrRows1, arrRows2, assume_unique=True)
+        if len(arrRows) > 0:
+            arrReturn = arrIDs[arrRows]
+            arrMeanPoints = arrMean[arrRows]
+    return arrReturn, arrMeanPoints
+
+def DefectiveMeshFromTrees(objTree1, objTree2, fltWidth: float): #midpoints of the closest pairs of points from the two grain trees
+    lstAllPoints = []
+    for objTreeA, objTreeB in [(objTree1, objTree2), (objTree2, objTree1)]:
+        arrDistances1, arrIndices1 = objTreeA.Pquery(objTreeB.GetExtendedPoints(),k=1) 
+        arrDistances1 = np.array([x[0] for x in arrDistances1])
+        arrRows1 = np.where(arrDistances1 < fltWidth)[0]
+        if len(arrRows1) > 0:
+            arrIndices1 = np.array([x[0] for x in arrIndices1[arrRows1]])
+            arrPoints1 = objTreeA.GetExtendedPoints()[arrIndices1]
+            arrDistances2, arrIndices2 = objTreeB.Pquery(arrPoints1,k=1)
+            arrIndices2 = np.array([x[0] for x in arrIndices2])
+            arrPoints2 = objTreeB.GetExtendedPoints()[arrIndices2]
+            lstAllPoints.append(np.unique((arrPoints1+arrPoints2)/2,axis=0))
+    if len(lstAllPoints)> 0:
+        return np.concatenate(lstAllPoints,axis=0)
+    else:
+        return [] 
+
+def ExtractGrainBoundaryPair(tupArguments: tuple)->tuple: #builds trees over the atoms near one grain pair's interface and returns the mesh atom IDs, mesh points and defective mesh
+    arrPoints1, arrPoints2, arrDefectPoints, arrDefectIDs, arrCellVectors, fltWrapper, lstBoundaryType, fltMaxGBWidth, fltGBWidth, fltSearchWidth = tupArguments
+    arrConstraints = gf.FindConstraintsFromBasisVectors(arrCellVectors)
+    objTree1 = gf.PeriodicNativeKDTree(arrPoints1, arrCellVectors, arrConstraints, fltWrapper, lstBoundaryType)
+    objTree2 = gf.PeriodicNativeKDTree(arrPoints2, arrCellVectors, arrConstraints, fltWrapper, lstBoundaryType)
+    arrIDs, arrMeshPoints = [], []
+    if len(arrDefectPoints) > 0:
+        arrIDs, arrMeshPoints = MeshAtomIDsFromTrees([objTree1, objTree2], arrDefectPoints, arrDefectIDs, fltMaxGBWidth, fltGBWidth)
+    arrMesh = []
+    if len(arrIDs) > 0: #the defective mesh is only needed for pairs which share a grain boundary
+        arrMesh = DefectiveMeshFromTrees(objTree1, objTree2, fltSearchWidth)
+    return arrIDs, arrMeshPoints, arrMesh
+
+def FindGrainBoundaryPairIDs(tupArguments: tuple)->list: #IDs of the atoms within fltGBWidth of one grain pair's mesh
+    arrMesh, arrPoints, arrIDs, arrCellVectors, lstBoundaryType, fltGBWidth = tupArguments
+    if len(arrPoints) == 0:
+        return []
+    objNeighbourList = gf.PeriodicNeighbourList(arrPoints, arrCellVectors, fltGBWidth, lstBoundaryType)
+    return list(np.unique(arrIDs[objNeighbourList.GetIndicesNearPoints(arrMesh, fltGBWidth)].astype('int')))
+
 class LAMMPSAnalysis3D(LAMMPSPostProcess):
     def __init__(self, fltTimeStep: float,intNumberOfAtoms: int, intNumberOfColumns: int, lstColumnNames: list, lstBoundaryType: list, lstBounds: list,intLatticeType: int, fltLatticeParameter: float):
         LAMMPSPostProcess.__init__(self, fltTimeStep,intNumberOfAtoms, intNumberOfColumns, lstColumnNames, lstBoundaryType, lstBounds,intLatticeType)
@@ -652,6 +1072,7 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         self.__JunctionMesh = []
         self.__GrainBoundaryMesh = []
         self.__GBSeparation = 0 
+        self.__GrainAtomCutoff = 0 #neighbour distance cutoff used by the last call of FindGrainAtomIDs
         self.blnPEAssigned = False
         self.blnVolumeAssigned = False
         self.blnAdjustedMeshPointsAssigned = False
@@ -684,7 +1105,7 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         arrGrainAtoms = self.GetAtomsByID(arrIDs)[:,1:4] 
         arrUsedRows = np.array(list(range(len(arrIDs))))
         for i in range(intN):
-            objGrainTree = gf.PeriodicWrapperKDTree(arrGrainAtoms,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),2*self.__LatticeParameter,self.GetPeriodicDirections())
+            objGrainTree = gf.PeriodicNativeKDTree(arrGrainAtoms,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),2*self.__LatticeParameter,self.GetPeriodicDirections())
             arrDistances1,arrIndices1 =objGrainTree.Pquery(arrGrainAtoms,k = self.__objRealCell.GetNumberOfNeighbours()+1)
             arrIndices1 = mf.FlattenList(arrIndices1)
             arrIndices1= objGrainTree.GetPeriodicIndices(arrIndices1)
@@ -692,7 +1113,8 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
             arrAllDistances = arrTrueDistances1.ravel()
             fltNearest = np.median(arrAllDistances)
             fltMin = np.min(arrAllDistances)
-            arrRows1 = np.where(np.all(arrTrueDistances1 < 2*fltNearest -fltMin,axis =1))[0]
+            self.__GrainAtomCutoff = 2*fltNearest -fltMin
+            arrRows1 = np.where(np.all(arrTrueDistances1 < self.__GrainAtomCutoff,axis =1))[0]
             arrTrueDistances2 = arrTrueDistances1[arrRows1]
             arrUsedRows = arrUsedRows[arrRows1]
             arrGrainAtoms = arrGrainAtoms[arrRows1]
@@ -719,7 +1141,7 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         for k in range(len(lstNewLabels)):
             self.SetColumnByIDs(lstAllIDs[k], self.GetColumnIndex('GrainNumber'),lstNewLabels[k]*np.ones(len(lstAllIDs[k])))
         for g in lstCurrentLabels:
-            self.__PeriodicGrains[g] = gf.PeriodicWrapperKDTree(self.GetAtomsByID(self.GetGrainAtomIDs(g))[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),25)
+            self.__PeriodicGrains[g] = gf.PeriodicNativeKDTree(self.GetAtomsByID(self.GetGrainAtomIDs(g))[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),25)
     def FindPEPerVolume(self, lstIDs=None):
         if lstIDs is None:
             return self.GetColumnByName('c_pe1')/self.GetColumnByName('c_v[1]')
@@ -734,12 +1156,14 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         else:
             intCol = self.GetColumnIndex('GrainNumber')
             self.SetColumnByIndex(np.zeros(self.GetNumberOfAtoms()),intCol)
-    def PartitionGrains(self, intN: int,intMinGrainSize = 25, fltWrapperWidth = 25):
+    def PartitionGrains(self, intN: int,intMinGrainSize = 25, fltWrapperWidth = 25, objPreviousStep = None, fltBoundaryWidth = None, fltTolerance = 0.001):
+        if objPreviousStep is not None and 'GrainNumber' in objPreviousStep.GetColumnNames() and np.any(objPreviousStep.GetColumnByName('GrainNumber') > 0): #incremental mode which keeps the previous labels away from the old boundaries
+            self.__PartitionFromPreviousStep(objPreviousStep, intN, intMinGrainSize, fltWrapperWidth, fltBoundaryWidth, fltTolerance)
+            return
         arrIDs = self.FindGrainAtomIDs(intN)
         if len(arrIDs) > 0:
             arrPoints = self.GetAtomsByID(arrIDs)[:,1:4]
-            clustering = DBSCAN(eps=1.05*self.__GBSeparation).fit(arrPoints)
-            arrLabels = clustering.labels_
+            arrLabels = gf.RadiusGraphClusters(arrPoints, 1.05*self.__GBSeparation)
             arrUniqueLabels,arrCounts = np.unique(arrLabels,return_counts=True)
             if 'GrainNumber' not in self.GetColumnNames():
                 self.AddColumn(np.zeros([self.GetNumberOfAtoms(),1]),'GrainNumber',strFormat='%i')
@@ -752,13 +1176,86 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
                     self.SetColumnByIDs(arrCurrentIDs,self.GetColumnIndex('GrainNumber'),(intMax+1)*np.ones(len(arrCurrentIDs)))
             self.__GrainLabels = self.GetGrainLabels()
             for k in self.__GrainLabels:
-                self.__PeriodicGrains[k] = gf.PeriodicWrapperKDTree(self.GetAtomsByID(self.GetGrainAtomIDs(k))[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapperWidth,self.GetPeriodicDirections())
+                self.__PeriodicGrains[k] = gf.PeriodicNativeKDTree(self.GetAtomsByID(self.GetGrainAtomIDs(k))[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapperWidth,self.GetPeriodicDirections())
         else:
             self.__GrainLabels = []
+    def __PartitionFromPreviousStep(self, objPreviousStep, intN: int, intMinGrainSize: int, fltWrapperWidth: float, fltBoundaryWidth: float, fltTolerance: float):
+        #atoms keep their previous grain number unless their structure or orientation has changed or they are within 
+        #fltBoundaryWidth of an atom which was not in a grain. Only these atoms are tested and labelled again.
+        if fltBoundaryWidth is None:
+            fltBoundaryWidth = 2*self.__LatticeParameter
+        self.__GBSeparation = objPreviousStep.__GBSeparation
+        self.__GrainAtomCutoff = objPreviousStep.__GrainAtomCutoff
+        fltEps = 1.05*self.__GBSeparation #same linking distance as the DBSCAN clustering
+        intNeighbours = self.__objRealCell.GetNumberOfNeighbours()
+        arrIDs = self.GetAtomData()[:,0]
+        arrPreviousIDs = objPreviousStep.GetAtomData()[:,0]
+        arrOrder = np.argsort(arrPreviousIDs)
+        arrPreviousRows = arrOrder[np.minimum(np.searchsorted(arrPreviousIDs, arrIDs, sorter=arrOrder), len(arrOrder)-1)]
+        arrFound = arrPreviousIDs[arrPreviousRows] == arrIDs
+        arrLabels = np.where(arrFound, objPreviousStep.GetColumnByName('GrainNumber')[arrPreviousRows], 0).astype('int')
+        arrStructure = self.GetColumnByIndex(self._intStructureType).astype('int')
+        arrChanged = np.invert(arrFound) | (arrStructure != objPreviousStep.GetColumnByIndex(objPreviousStep._intStructureType)[arrPreviousRows].astype('int'))
+        if 'c_pt[4]' in self.GetColumnNames() and 'c_pt[4]' in objPreviousStep.GetColumnNames():
+            intFirst = self.GetColumnIndex('c_pt[4]')
+            intPreviousFirst = objPreviousStep.GetColumnIndex('c_pt[4]')
+            arrDots = np.sum(self.GetAtomData()[:,intFirst:intFirst+4]*objPreviousStep.GetAtomData()[arrPreviousRows,intPreviousFirst:intPreviousFirst+4], axis=1)
+            arrChanged = arrChanged | (np.abs(arrDots) < 1 - fltTolerance)
+        objNeighbourList = self.GetNeighbourList(max(fltBoundaryWidth, fltEps, self.__GrainAtomCutoff))
+        arrPoints = self.GetAtomData()[:,1:4]
+        arrUnsettled = np.where(arrChanged | (arrLabels <= 0))[0]
+        arrRows = objNeighbourList.GetIndicesNearPoints(arrPoints[arrUnsettled], fltBoundaryWidth)
+        arrRows = np.union1d(arrRows, arrUnsettled).astype('int')
+        arrLabels[arrRows] = 0
+        arrGrain = arrLabels > 0 #the kept atoms are treated as grain atoms
+        arrCandidates = arrRows[arrStructure[arrRows] == self._LatticeStructure]
+        arrGrain[arrCandidates] = True
+        lstNear = objNeighbourList.Pquery_radius(arrPoints[arrCandidates], self.__GrainAtomCutoff)
+        arrSource = np.repeat(np.arange(len(arrCandidates)), list(map(len, lstNear)))
+        arrTarget = np.concatenate(lstNear + [np.zeros(0, dtype='int')]).astype('int')
+        arrSelf = arrTarget != arrCandidates[arrSource]
+        arrSource, arrTarget = arrSource[arrSelf], arrTarget[arrSelf]
+        for i in range(intN): #the same test as FindGrainAtomIDs, an atom needs all of its nearest neighbours among the grain atoms
+            arrCounts = np.bincount(arrSource[arrGrain[arrTarget]], minlength=len(arrCandidates))
+            arrGrain[arrCandidates[arrCounts < intNeighbours]] = False
+        arrCandidates = arrCandidates[arrGrain[arrCandidates]]
+        lstNear = objNeighbourList.Pquery_radius(arrPoints[arrCandidates], fltEps)
+        arrSource = np.repeat(arrCandidates, list(map(len, lstNear)))
+        arrTarget = np.concatenate(lstNear + [np.zeros(0, dtype='int')]).astype('int')
+        arrLinked = arrGrain[arrTarget] & (arrSource != arrTarget)
+        arrSource, arrTarget = arrSource[arrLinked], arrTarget[arrLinked]
+        blnAssigned = True
+        while blnAssigned: #grow the kept grains into the candidates taking the most common label of the labelled neighbours
+            arrEdges = (arrLabels[arrSource] == 0) & (arrLabels[arrTarget] > 0)
+            blnAssigned = np.any(arrEdges)
+            if blnAssigned:
+                arrPairs, arrCounts = np.unique(np.transpose([arrSource[arrEdges], arrLabels[arrTarget[arrEdges]]]), axis=0, return_counts=True)
+                arrPairs = arrPairs[np.lexsort((-arrCounts, arrPairs[:,0]))]
+                arrFirst = np.unique(arrPairs[:,0], return_index=True)[1]
+                arrLabels[arrPairs[arrFirst,0]] = arrPairs[arrFirst,1]
+        arrRemaining = arrCandidates[arrLabels[arrCandidates] == 0] #candidates which are not connected to a previous grain
+        if len(arrRemaining) > 0:
+            arrLookUp = -np.ones(len(arrLabels), dtype='int')
+            arrLookUp[arrRemaining] = np.arange(len(arrRemaining))
+            arrEdges = (arrLookUp[arrSource] >= 0) & (arrLookUp[arrTarget] >= 0)
+            objGraph = sparse.coo_matrix((np.ones(np.sum(arrEdges)), (arrLookUp[arrSource[arrEdges]], arrLookUp[arrTarget[arrEdges]])), shape=(len(arrRemaining), len(arrRemaining)))
+            intComponents, arrComponents = connected_components(objGraph, directed=False)
+            arrComponentCounts = np.bincount(arrComponents, minlength=intComponents)
+            intMax = max(np.max(arrLabels), int(np.max(objPreviousStep.GetColumnByName('GrainNumber')))) #previous labels are kept so a new grain never reuses the label of one which has gone
+            for k in np.where(arrComponentCounts >= intMinGrainSize)[0]: #a new grain has appeared
+                intMax += 1
+                arrLabels[arrRemaining[arrComponents == k]] = intMax
+        if 'GrainNumber' not in self.GetColumnNames():
+            self.AddColumn(np.zeros([self.GetNumberOfAtoms(),1]),'GrainNumber',strFormat='%i')
+        self.SetColumnByIndex(arrLabels, self.GetColumnIndex('GrainNumber'))
+        self.__PeriodicGrains = dict()
+        self.__GrainLabels = self.GetGrainLabels()
+        for k in self.__GrainLabels:
+            self.__PeriodicGrains[k] = gf.PeriodicNativeKDTree(self.GetAtomsByID(self.GetGrainAtomIDs(k))[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapperWidth,self.GetPeriodicDirections())
     def SetPeriodicGrain(self, strName: str, arrIDs: np.array, fltWrapperWidth: float):
         arrOriginalIDs = arrIDs
         arrPoints = self.GetAtomsByID(arrIDs)[:,1:4]
-        self.__PeriodicGrains[strName] = gf.PeriodicWrapperKDTree(arrPoints,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapperWidth,self.GetPeriodicDirections())
+        self.__PeriodicGrains[strName] = gf.PeriodicNativeKDTree(arrPoints,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapperWidth,self.GetPeriodicDirections())
         #arrRows = []
         # if strName != 0:
         #     fltDistance = 1.05*self.GetRealCell().GetNearestNeighbourDistance()
@@ -850,7 +1347,7 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
             lstGrainIDs = np.unique(lstGrainIDs).tolist()
             arrPoints = self.GetAtomsByID(lstGrainIDs)[:,1:4]
             self.AppendGrainNumbers(intGrainNumber*np.ones(len(lstGrainIDs)),lstGrainIDs)
-            self.__PeriodicGrains[intGrainNumber] = gf.PeriodicWrapperKDTree(arrPoints,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapper,self.GetPeriodicDirections())
+            self.__PeriodicGrains[intGrainNumber] = gf.PeriodicNativeKDTree(arrPoints,self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltWrapper,self.GetPeriodicDirections())
         n = 1
         lstGrainLabels = self.GetGrainLabels()
         if 0 in lstGrainLabels:
@@ -859,7 +1356,7 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         for l in lstGrainLabels:
             if l != n:
                 self.AppendGrainNumbers(n*np.ones(len(self.GetGrainAtomIDs(l))),self.GetGrainAtomIDs(l))
-                self.__PeriodicGrains[n] = gf.PeriodicWrapperKDTree(self.__PeriodicGrains[l].GetOriginalPoints(),self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),self.__PeriodicGrains[l].GetWrapperLength(),self.GetPeriodicDirections())
+                self.__PeriodicGrains[n] = gf.PeriodicNativeKDTree(self.__PeriodicGrains[l].GetOriginalPoints(),self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),self.__PeriodicGrains[l].GetWrapperLength(),self.GetPeriodicDirections())
                 #self.__PeriodicGrains.pop(l)
                 del self.__PeriodicGrains[l]               
             n +=1 
@@ -880,16 +1377,15 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         lstGrains = self.GetGrainLabels()
         if 0 in lstGrains:
             lstGrains.remove(0)
-        intL = len(lstGrains)
         lstMaxDistances = []
         if len(lstGrains) <= 1:
             fltMax = 0
         else:
             fltMax = 0
-            for i in range(1,intL+1):
+            for i in lstGrains: #labels are not always sequential once grains are tracked between timesteps
                 lstAllDistances = []
                 arrPoints = self.__PeriodicGrains[i].GetExtendedPoints()
-                for j in range(1, intL+1):
+                for j in lstGrains:
                     if i != j:
                         arrDistances1, arrIndices1 = self.__PeriodicGrains[j].Pquery(arrPoints, k=1)
                         arrIndices1 = mf.FlattenList(arrIndices1)
@@ -916,28 +1412,90 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         intCol = self.GetColumnIndex(strColumnName)
         arrRows = np.where(self.GetAtomData()[:,intCol] == intGB)[0]
         return self.GetAtomData()[arrRows][:,0]
-    def FindGrainBoundaries(self, fltGBWidth, fltSearchWidth = None):
+    def __CellGrid(self, fltWidth: float)->tuple: #cells at least fltWidth across so atoms closer than fltWidth are in the same or neighbouring cells
+        arrInverse = np.linalg.inv(self.GetCellVectors())
+        arrShape = np.maximum(np.floor(1/(np.linalg.norm(np.transpose(arrInverse), axis=1)*fltWidth)), 1).astype('int')
+        arrPeriodic = np.array(list(map(lambda x: x == 'p', self.GetPeriodicDirections())))
+        return arrInverse, arrShape, arrPeriodic, list(map(lambda x: 'wrap' if x else 'constant', arrPeriodic))
+    def __CellBins(self, arrPoints: np.array, tupGrid: tuple)->np.array:
+        arrInverse, arrShape, arrPeriodic = tupGrid[:3]
+        arrCells = np.floor(np.matmul(arrPoints - self.GetOrigin(), arrInverse)*arrShape).astype('int')
+        arrCells = np.where(arrPeriodic, np.mod(arrCells, arrShape), np.clip(arrCells, 0, arrShape-1))
+        return np.ravel_multi_index(np.transpose(arrCells), tuple(arrShape))
+    def __NeighbouringCells(self, arrBins: np.array, tupGrid: tuple)->np.array: #cells holding or next to one of the binned points
+        arrOccupied = np.zeros(np.prod(tupGrid[1]), dtype='uint8')
+        arrOccupied[arrBins] = 1
+        return ndimage.maximum_filter(np.reshape(arrOccupied, tupGrid[1]), size=3, mode=tupGrid[3])
+    def __ExtractGrainBoundaries(self, fnMap, lstTwos: list, fltGBWidth: float, fltSearchWidth: float)->tuple: 
+        #each worker is only sent the atoms in cells around its pair's shared interface, and then the atoms in cells around its mesh
+        arrCellVectors = self.GetCellVectors()
+        tupGrid = self.__CellGrid(max(fltSearchWidth, self.__MaxGBWidth))
+        arrDefects = self.GetAtomsByID(self.GetGrainAtomIDs(0))
+        arrDefectBins = self.__CellBins(arrDefects[:,1:4], tupGrid)
+        dctBins = dict()
+        dctNear = dict()
+        for k in set(it.chain(*lstTwos)):
+            dctBins[k] = self.__CellBins(self.__PeriodicGrains[k].GetOriginalPoints(), tupGrid)
+            dctNear[k] = self.__NeighbouringCells(dctBins[k], tupGrid)
+        lstPairs = []
+        lstArguments = []
+        for k in lstTwos:
+            arrInterface = dctNear[k[0]] & dctNear[k[1]]
+            if np.any(arrInterface): #otherwise the two grains do not meet so they cannot share a grain boundary
+                arrRegion = np.ravel(ndimage.maximum_filter(arrInterface, size=3, mode=tupGrid[3])).astype('bool')
+                lstTrees = list(map(lambda x: self.__PeriodicGrains[x], k))
+                arrRows = np.where(arrRegion[arrDefectBins])[0]
+                lstPairs.append(k)
+                lstArguments.append((lstTrees[0].GetOriginalPoints()[arrRegion[dctBins[k[0]]]], lstTrees[1].GetOriginalPoints()[arrRegion[dctBins[k[1]]]],
+                arrDefects[arrRows,1:4], arrDefects[arrRows,0], arrCellVectors, lstTrees[0].GetWrapperLength(), lstTrees[0].GetBoundaryTypes(), self.__MaxGBWidth, fltGBWidth, fltSearchWidth))
+        lstIDs = []
+        lstUsedTwos = []
+        lstMeshes = []
+        for k, tupResult in zip(lstPairs, fnMap(ExtractGrainBoundaryPair, lstArguments)):
+            lstTemp, mpts, arrMesh = tupResult
+            if len(mpts) > 0:
+                mpts = self.WrapVectorIntoSimulationBox(mpts)
+            if len(lstTemp)> 0:
+                lstIDs.append(lstTemp)
+                lstUsedTwos.append(k)
+                if len(arrMesh) > 0  and len(mpts) > 0:
+                    arrMesh = np.append(arrMesh, mpts, axis=0)
+                elif len(mpts) > 0:
+                    arrMesh = mpts
+                if len(arrMesh) > 0:
+                    arrMesh = self.WrapVectorIntoSimulationBox(arrMesh)
+                    arrMesh = np.unique(arrMesh, axis=0)
+                lstMeshes.append(arrMesh)
+        tupGrid = self.__CellGrid(fltGBWidth)
+        arrAtomBins = self.__CellBins(self.GetAtomData()[:,1:4], tupGrid)
+        arrGrainNumbers = self.GetColumnByName('GrainNumber').astype('int')
+        lstArguments = []
+        lstMeshIndices = []
+        for intIndex, (k, arrMesh) in enumerate(zip(lstUsedTwos, lstMeshes)):
+            if len(arrMesh) > 0:
+                lstMeshIndices.append(intIndex)
+                arrRegion = np.ravel(self.__NeighbouringCells(self.__CellBins(arrMesh, tupGrid), tupGrid)).astype('bool')
+                arrRows = np.where(arrRegion[arrAtomBins] & np.isin(arrGrainNumbers, [0] + list(k)))[0] #unassigned atoms and atoms from either grain
+                lstArguments.append((arrMesh, self.GetAtomData()[arrRows,1:4], self.GetAtomData()[arrRows,0], arrCellVectors, self.GetPeriodicDirections(), fltGBWidth))
+        dctExtraIDs = dict(zip(lstMeshIndices, fnMap(FindGrainBoundaryPairIDs, lstArguments))) #pairs without a mesh have no extra IDs
+        lstExtraIDs = [dctExtraIDs.get(intIndex, []) for intIndex in range(len(lstMeshes))]
+        return lstIDs, lstUsedTwos, lstMeshes, lstExtraIDs
+    def FindGrainBoundaries(self, fltGBWidth, fltSearchWidth = None, intWorkers = 1):
+        #the grain pairs can be extracted independently over intWorkers processes; by default intWorkers = 1 runs everything 
+        #in this process and intWorkers = None uses every core
         if fltSearchWidth is None:
             fltSearchWidth = self.__MaxGBWidth
         lstGrains = self.GetGrainLabels()
         lstGrains.remove(0)
         lstTwos = list(it.combinations(lstGrains, 2))
-        lstIDs = []
         if 'GrainBoundary' not in self.GetColumnNames():
             self.AddColumn(np.zeros([self.GetNumberOfAtoms(),1]),'GrainBoundary', strFormat = '%i')
         intGBCol = self.GetColumnIndex('GrainBoundary')
-        lstMeshPoints = []
-        lstUsedTwos = []
-        lstAllIDs = []
-        for k in lstTwos:
-            lstTemp,mpts = self.FindMeshAtomIDs(k,fltGBWidth)
-            if len(mpts) > 0:
-                mpts = self.WrapVectorIntoSimulationBox(mpts)
-            if len(lstTemp)> 0:
-                lstIDs.append(lstTemp)
-                lstMeshPoints.append(mpts)
-                lstUsedTwos.append(k)
-                lstAllIDs.extend(lstTemp)
+        if len(lstTwos) <= 1 or (intWorkers is not None and intWorkers <= 1) or multiprocessing.current_process().daemon: #pool workers cannot start their own pools
+            lstIDs, lstUsedTwos, lstMeshes, lstAllExtraIDs = self.__ExtractGrainBoundaries(lambda f, l: list(map(f, l)), lstTwos, fltGBWidth, fltSearchWidth)
+        else:
+            with multiprocessing.Pool(intWorkers) as objPool:
+                lstIDs, lstUsedTwos, lstMeshes, lstAllExtraIDs = self.__ExtractGrainBoundaries(objPool.map, lstTwos, fltGBWidth, fltSearchWidth)
         intN = len(lstUsedTwos)
         lstDuplicateIDs = []
         for d in range(intN):
@@ -949,39 +1507,15 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         lstAllGBMesh = []
         for l in range(intN): 
             lstGBIDs = []  #lstIDs[l]
-            lstExtraIDs = []
-            arrMesh = self.FindDefectiveMesh(lstUsedTwos[l][0],lstUsedTwos[l][1],fltSearchWidth)
-            if len(arrMesh) > 0  and len(lstMeshPoints[l]) > 0:
-                arrMesh = np.append(arrMesh, lstMeshPoints[l], axis=0)
-            elif len(lstMeshPoints[l]) > 0:
-                arrMesh = lstMeshPoints[l]
-            if len(arrMesh) > 0:
-                arrMesh = self.WrapVectorIntoSimulationBox(arrMesh)
-                arrMesh = np.unique(arrMesh, axis=0)
-                lstAllGBMesh.append(arrMesh)
-                arrIDs = self.GetGrainAtomIDs(0)
-                arrIndices, arrDistances = self.__PeriodicGrains[0].Pquery_radius(arrMesh, fltGBWidth)
-                arrIndices = self.__PeriodicGrains[0].GetPeriodicIndices(arrIndices)
-                arrIndices = np.unique(mf.FlattenList(arrIndices))
-                lstExtraIDs.extend(arrIDs[arrIndices])
-                for m in lstUsedTwos[l]:
-                    arrIDs = self.GetGrainAtomIDs(m)
-                    arrIndices, arrDistances = self.__PeriodicGrains[m].Pquery_radius(arrMesh, fltGBWidth)
-                    arrIndices = np.unique(mf.FlattenList(arrIndices))
-                    arrIndices = self.__PeriodicGrains[m].GetPeriodicIndices(arrIndices)
-                    arrIndices = np.unique(arrIndices)
-                    if len(arrIndices) > 0 :
-                        lstExtraIDs.extend(arrIDs[arrIndices])
-                lstExtraIDs  = list(np.unique(lstExtraIDs))
-                # if len(lstExtraIDs) > 0:
-                #     arrIndices = self.__PeriodicGrains[0].GetPeriodicIndices(lstExtraIDs)
-                #     lstExtraIDs = arrIDs[arrIndices]
+            lstExtraIDs = lstAllExtraIDs[l]
+            if len(lstMeshes[l]) > 0:
+                lstAllGBMesh.append(lstMeshes[l])
             if len(lstExtraIDs) > 0:
                 lstGBIDs.extend(lstExtraIDs)
                 lstGBIDs = np.unique(lstGBIDs).tolist()
                 self.SetColumnByIDs(lstGBIDs,intGBCol, (l+1)*np.ones(len(lstGBIDs)))
                 lstGBIDs = self.GetGBAtomIDs(l+1)
-                self.__PeriodicGrainBoundaries[l+1] = gf.PeriodicWrapperKDTree(self.GetAtomsByID(lstGBIDs)[:,1:4],self.GetCellVectors(), gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltGBWidth,self.GetPeriodicDirections())
+                self.__PeriodicGrainBoundaries[l+1] = gf.PeriodicNativeKDTree(self.GetAtomsByID(lstGBIDs)[:,1:4],self.GetCellVectors(), gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltGBWidth,self.GetPeriodicDirections())
         self.SetColumnByIDs(arrDuplicates, intGBCol, -1*np.ones(len(arrDuplicates))) #remove any duplicate GBs which may leave a small gap around the triple oine  
         return lstAllGBMesh #returns the mesh points for plotting              
     def FindJunctionLines(self, fltRadius, intOrder, fltSearchRadius = None):
@@ -990,37 +1524,32 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         if 'Tripleline' not in self.GetColumnNames():
             self.AddColumn(np.zeros([self.GetNumberOfAtoms(),1]),'TripleLine', strFormat = '%i')
         intTJCol = self.GetColumnIndex('TripleLine')
+        intGBCol = self.GetColumnIndex('GrainBoundary')
         t=1
         lstAllTJs= []
         lstMergedPoints = self.FindJunctionMesh(fltRadius,intOrder)
         self.__JunctionMesh = lstMergedPoints
+        objNeighbourList = self.GetNeighbourList(max(fltRadius, fltSearchRadius))
+        lstGrainBoundaries = self.GetGrainBoundaryLabels()
+        lstGrainBoundaries.remove(0)
         for m in lstMergedPoints:
            # blnTJ = False
             lstAllIDs = []
-            lstGrainBoundaries = self.GetGrainBoundaryLabels()
-            lstGrainBoundaries.remove(0)
             lstTemp = []
             intTJ = 0
+            arrRows = objNeighbourList.GetIndicesNearPoints(m, fltRadius) #one query for all the grain boundaries around this mesh
+            arrGBValues = self.GetColumnByIndex(intGBCol)[arrRows].astype('int')
             for l in lstGrainBoundaries:
-                arrIDs1 = self.GetGBAtomIDs(l)
-                objTree = gf.PeriodicWrapperKDTree(self.GetAtomsByID(arrIDs1)[:,1:4],self.GetCellVectors(),gf.FindConstraintsFromBasisVectors(self.GetCellVectors()),fltSearchRadius, self.GetPeriodicDirections())
-                arrIndices1, arrDistances = objTree.Pquery_radius(m, fltRadius)
-                arrIndices1 = np.unique(mf.FlattenList(arrIndices1))
-                if len(arrIndices1)> 0:
-                    arrIndices1 = objTree.GetPeriodicIndices(arrIndices1)
-                    arrIndices1 = np.unique(arrIndices1)
-                    lstTemp.extend(arrIDs1[arrIndices1])
+                arrIDs1 = self.GetAtomData()[arrRows[arrGBValues == l],0].astype('int')
+                if len(arrIDs1)> 0:
+                    lstTemp.extend(arrIDs1)
                     intTJ += 1
                     # if l == -1: #this is an overlapped region of grain boundaries
                     #     blnTJ =  True
             if  intTJ == intOrder +1: #check this is a triple line (3 real grain boundaries and -1 is the intersection region)
                 lstAllIDs.extend(lstTemp)
-                arrIDs2 = self.GetGrainAtomIDs(0)
-                arrIndices2, arrDistances2 = self.__PeriodicGrains[0].Pquery_radius(m, fltRadius)
-                arrIndices2 = np.unique(mf.FlattenList(arrIndices2))
-                arrIndices2 = self.__PeriodicGrains[0].GetPeriodicIndices(arrIndices2)
-                arrIndices2 = np.unique(arrIndices2)
-                lstAllIDs.extend(arrIDs2[arrIndices2])   
+                arrGrainValues = self.GetColumnByName('GrainNumber')[arrRows].astype('int')
+                lstAllIDs.extend(self.GetAtomData()[arrRows[arrGrainValues == 0],0].astype('int'))   
             # if objDuplicate is not None:
             #     arrIndices, arrDistances = objDuplicate.Pquery_radius(m,fltWidth)
             #     arrIndices = np.unique(mf.FlattenList(arrIndices))
@@ -1034,15 +1563,13 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
                 lstAllTJs.extend(arrIndices3.tolist())
                 t +=1
         lstAllTJs = np.unique(lstAllTJs).tolist()
-        intGBCol = self.GetColumnIndex('GrainBoundary')
         self.SetColumnByIDs(lstAllTJs,intGBCol,0*np.ones(len(lstAllTJs)))
     def FindJunctionMesh(self,fltWidth: float, intOrder: int):
         arrReturn = [] 
         arrOverlapIDs = self.GetGrainBoundaryIDs(-1)
         arrOverlapPoints = self.GetAtomsByID(arrOverlapIDs)[:,1:4]
         lstSplitPoints = []
-        clustering = DBSCAN(2*self.__LatticeParameter,min_samples=5).fit(arrOverlapPoints)
-        arrLabels = clustering.labels_
+        arrLabels = gf.RadiusGraphClusters(arrOverlapPoints, 2*self.__LatticeParameter, 5)
         for a in np.unique(arrLabels):
             if a != -1:
                 arrRows = np.where(arrLabels == a)[0]
@@ -1060,96 +1587,50 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
         lstMeshTJPoints = []
         lstGrainLabels = self.GetGrainLabels()
         lstGrainLabels.remove(0)
-        for k in lstMergedPoints:
-            arrAllPoints = np.zeros([len(k), len(k[0]), intOrder])
-            arrAllDistances = np.zeros([len(k),intOrder])
-            intPos = 0
-            for j in range(len(lstGrainLabels)):
-                arrDistances, arrIndices = self.__PeriodicGrains[lstGrainLabels[j]].Pquery(k,1)
-                arrDistances = np.array(mf.FlattenList(arrDistances))
-                arrIndices = mf.FlattenList(arrIndices)
-                if np.all(arrDistances <= self.__MaxGBWidth):
-                    arrAllPoints[:,:,intPos] = self.__PeriodicGrains[lstGrainLabels[j]].GetExtendedPoints()[arrIndices]
-                    arrAllDistances[:,intPos] = arrDistances
-                    intPos += 1
-            if intOrder == 3:
-                arrReturn = np.vstack(list(map(lambda x: gf.EquidistantPoint(x[:,0],x[:,1],x[:,2]),arrAllPoints)))
-                arrReturn = self.WrapVectorIntoSimulationBox(arrReturn)
-                lstMeshTJPoints.append(np.unique(arrReturn,axis=0))
-            else:
-                arrMeanPoints = np.mean(arrAllPoints, axis=2)
-                #arrDistanceCheck = (np.sum(arrAllDistances,axis=1)-np.max(arrAllDistances,axis=1))/np.max(arrAllDistances,axis=1) #distance between two closest grain points must be at least 
-                arrRows = np.where(np.linalg.norm(k-arrMeanPoints,axis=1) < self.__MaxGBWidth/2)[0]
-                if len(arrRows) > 0:
-                    arrReturn = self.WrapVectorIntoSimulationBox(arrMeanPoints[arrRows])
-                    lstMeshTJPoints.append(np.unique(arrReturn,axis=0)) 
+        if len(lstMergedPoints) == 0:
+            return lstMeshTJPoints
+        arrPoints = np.vstack(lstMergedPoints) #all junction clusters are queried together and split up again by label
+        arrLabels = np.repeat(np.arange(len(lstMergedPoints)), list(map(len, lstMergedPoints)))
+        arrSplits = np.cumsum(list(map(len, lstMergedPoints)))[:-1]
+        lstNearestPoints = []
+        arrClose = np.zeros([len(lstMergedPoints), len(lstGrainLabels)],dtype=bool) #cluster by grain, true if every cluster point is within the GB width of the grain
+        for j in range(len(lstGrainLabels)):
+            arrDistances, arrIndices = self.__PeriodicGrains[lstGrainLabels[j]].Pquery(arrPoints,1)
+            arrClose[:,j] = np.bincount(arrLabels, weights = arrDistances[:,0] > self.__MaxGBWidth, minlength=len(lstMergedPoints)) == 0
+            lstNearestPoints.append(self.__PeriodicGrains[lstGrainLabels[j]].GetExtendedPoints()[arrIndices[:,0]])
+        arrPositions = np.cumsum(arrClose, axis=1) - 1
+        if np.any(arrPositions[arrClose] >= intOrder):
+            raise Exception('More than ' + str(intOrder) + ' grains are within ' + str(self.__MaxGBWidth) + ' of a junction mesh')
+        arrAllPoints = np.zeros([len(arrPoints), 3, intOrder])
+        for j in range(len(lstGrainLabels)):
+            arrRows = np.where(arrClose[arrLabels,j])[0]
+            arrAllPoints[arrRows,:,arrPositions[arrLabels[arrRows],j]] = lstNearestPoints[j][arrRows]
+        if intOrder == 3:
+            arrReturn = self.WrapVectorIntoSimulationBox(gf.EquidistantPoints(arrAllPoints[:,:,0],arrAllPoints[:,:,1],arrAllPoints[:,:,2]))
+            for arrCluster in np.split(arrReturn, arrSplits):
+                lstMeshTJPoints.append(np.unique(arrCluster,axis=0))
+        else:
+            arrMeanPoints = np.mean(arrAllPoints, axis=2)
+            arrNear = np.linalg.norm(arrPoints-arrMeanPoints,axis=1) < self.__MaxGBWidth/2
+            for arrCluster, arrClusterNear in zip(np.split(arrMeanPoints, arrSplits), np.split(arrNear, arrSplits)):
+                if np.any(arrClusterNear):
+                    arrReturn = self.WrapVectorIntoSimulationBox(arrCluster[arrClusterNear])
+                    lstMeshTJPoints.append(np.unique(arrReturn,axis=0))
         return lstMeshTJPoints
         
     def GetPeriodicGrainBoundary(self, intKey):
         return self.__PeriodicGrainBoundaries[intKey]
     def FindMeshAtomIDs(self, lstGrains, fltWidth):
         arrReturn = []
-        intNumberOfGrains = len(lstGrains)
+        arrMeanPoints = []
         if set(lstGrains).issubset(set(self.__GrainLabels)):
-           # arrPoints = self.GetAtomsByID(self.GetNonGrainAtomIDs())[:,0:4]
-            lstIDs = []
-            lstIDs.extend(self.GetGrainAtomIDs(0))
-            #lstGBLabels =  self.GetGrainBoundaryLabels()
-            # if -1 in lstGBLabels:
-            #     lstIDs.extend(self.GetGBAtomIDs(-1))
-            # #arrPoints = self.GetAtomsByID(self.GetGrainAtomIDs(0))
-            arrPoints = self.GetAtomsByID(lstIDs)
-            arrIDs = arrPoints[:,0]
-            arrPoints = arrPoints[:,1:4]
-            lstAllDistances = []
-            lstAllPoints = []
-            arrAllPoints = np.zeros([len(arrPoints),3,intNumberOfGrains])
-            i = 0
-            for l in lstGrains:
-                arrDistances1, arrIndices1 = self.__PeriodicGrains[l].Pquery(arrPoints, k=1)
-                arrGrainPoints = self.__PeriodicGrains[l].GetExtendedPoints()
-                arrAllPoints[:,:,i] = arrGrainPoints[mf.FlattenList(arrIndices1)]
-                #lstAllPoints.append(arrGrainPoints[mf.FlattenList(arrIndices1)])
-                lstAllDistances.append(np.array([x[0] for x in arrDistances1]))
-                i += 1
-            arrMean = np.mean(arrAllPoints,axis=2)
-            arrMeanDistances = np.linalg.norm(arrPoints - arrMean, axis=1)
-            #arrAllPoints = np.transpose(np.vstack(lstAllPoints))
-            arrAllDistances = np.transpose(np.vstack(lstAllDistances))
-            #arrSum = np.sum(arrAllDistances[:,:intNumberOfGrains], axis=1)
-            arrRows1 = np.where(np.all(arrAllDistances <= self.__MaxGBWidth,axis=1))[0]
-            arrRows2 = np.where(arrMeanDistances <= fltWidth)[0]
-           # arrRows = np.where(np.all(arrSum <= fltWidth*intNumberOfGrains))[0]
-            arrReturn = []
-            arrMeanPoints = []
-            if len(arrRows1) > 0 and len(arrRows2) >0:
-                arrRows = np.array(list(set(arrRows1.tolist()).intersection(arrRows2.tolist())))
-                if len(arrRows) > 0:
-                    arrReturn = arrIDs[arrRows]
-                    arrMeanPoints = arrMean[arrRows]
+            arrPoints = self.GetAtomsByID(self.GetGrainAtomIDs(0))
+            arrReturn, arrMeanPoints = MeshAtomIDsFromTrees(list(map(lambda x: self.__PeriodicGrains[x], lstGrains)), arrPoints[:,1:4], arrPoints[:,0], self.__MaxGBWidth, fltWidth)
         return arrReturn, arrMeanPoints            
     def FindDefectiveMesh(self,inGrain1, inGrain2, fltWidth = None):
         if fltWidth is None:
             fltWidth = self.__MaxGBWidth
-        lstPermutations =  list(it.permutations([inGrain1,inGrain2],2))
-        lstAllPoints = []
-        for i in lstPermutations:
-            intGrain1 = i[0]
-            intGrain2 = i[1]
-            arrDistances1, arrIndices1 = self.__PeriodicGrains[intGrain1].Pquery(self.__PeriodicGrains[intGrain2].GetExtendedPoints(),k=1) 
-            arrDistances1 = np.array([x[0] for x in arrDistances1])
-            arrRows1 = np.where(arrDistances1 < fltWidth)[0]
-            if len(arrRows1) > 0:
-                arrIndices1 = np.array([x[0] for x in arrIndices1[arrRows1]])
-                arrPoints1 = self.__PeriodicGrains[intGrain1].GetExtendedPoints()[arrIndices1]
-                arrDistances2, arrIndices2 = self.__PeriodicGrains[intGrain2].Pquery(arrPoints1,k=1)
-                arrIndices2 = np.array([x[0] for x in arrIndices2])
-                arrPoints2 = self.__PeriodicGrains[intGrain2].GetExtendedPoints()[arrIndices2]
-                lstAllPoints.append(np.unique((arrPoints1+arrPoints2)/2,axis=0))
-        if len(lstAllPoints)> 0:
-            return np.concatenate(lstAllPoints,axis=0)
-        else:
-            return [] 
+        return DefectiveMeshFromTrees(self.__PeriodicGrains[inGrain1], self.__PeriodicGrains[inGrain2], fltWidth)
     def SpreadToHigherEnergy(self, inlstIDs: list):
         lstReturnIDs = list(set(inlstIDs))
         lstAllIDs = list(set(inlstIDs))
@@ -1225,31 +1706,26 @@ class LAMMPSAnalysis3D(LAMMPSPostProcess):
     def GetGBAtomIDs(self, intGBNumber):
         lstGBAtoms = list(np.where(self.GetColumnByName('GrainBoundary').astype('int') == intGBNumber)[0])
         return self.GetAtomData()[lstGBAtoms,0].astype('int')
-    def GetAtomIDsByOrientation(self,inQuaternion: np.array, intLatticeType: int,fltTolerance = 0.001):
-        lstRows = []
+    def __QuaternionColumns(self)->tuple: #PTM structure types and the (N,4) quaternion block
         intFirst = self.GetColumnIndex('c_pt[1]')
         intSecond = self.GetColumnIndex('c_pt[7]')
         arrQuaternions = self.GetAtomData()[:,intFirst:intSecond+1]
-        #arrRows = np.matmul(arrQuaternions[:,1:5], inQuaternion)
-        #lstRows.append(np.where((np.abs(arrRows) > 1- fltTolerance) & (arrQuaternions[:,0].astype('int') == intLatticeType))[0])
-        for j in gf.CubicQuaternions():
-            y = gf.QuaternionProduct(inQuaternion,j)
-            #y = gf.QuaternionProduct(j,inQuaternion)
-            arrRows = np.matmul(arrQuaternions[:,1:5], y)
-            lstRows.append(np.where((np.abs(arrRows) > 1-fltTolerance) & (arrQuaternions[:,0].astype('int') == intLatticeType))[0])
-        arrRows2 = np.unique(np.concatenate(lstRows))
+        return arrQuaternions[:,0].astype('int'), arrQuaternions[:,1:5]
+    def FindMinimumMisorientations(self, inQuaternions: np.array, strDType = 'float64')->np.array: #(atoms, references) misorientation angles in radians
+        return gf.MinimumMisorientations(self.__QuaternionColumns()[1], inQuaternions, strDType)
+    def ClassifyAtomsByOrientation(self, inQuaternions: np.array, intLatticeType: int, fltTolerance = 0.001, strDType = 'float64')->np.array:
+        #index of the closest reference orientation for each atom or -1 if none is within the tolerance used by GetAtomIDsByOrientation
+        arrTypes, arrQuaternions = self.__QuaternionColumns()
+        arrDots = gf.CubicSymmetryDots(arrQuaternions, inQuaternions, strDType)
+        arrClosest = np.argmax(arrDots, axis=1)
+        arrMatched = (arrDots[np.arange(len(arrDots)), arrClosest] > 1-fltTolerance) & (arrTypes == intLatticeType)
+        return np.where(arrMatched, arrClosest, -1)
+    def GetAtomIDsByOrientation(self,inQuaternion: np.array, intLatticeType: int,fltTolerance = 0.001, strDType = 'float64'):
+        arrRows2 = np.where(self.ClassifyAtomsByOrientation(inQuaternion, intLatticeType, fltTolerance, strDType) == 0)[0]
         rtnValue = []
         if len(arrRows2) > 0:
             arrIDs = self.GetColumnByIndex(0)[arrRows2].astype('int')
             rtnValue = arrIDs
-            # clustering = DBSCAN(eps=1.05*self.__objRealCell.GetNearestNeighbourDistance()).fit(self.GetAtomsByID(arrIDs)[:,1:4])
-            # arrLabels = clustering.labels_
-            # arrUniqueLabels,arrCounts = np.unique(arrLabels,return_counts=True)
-            # arrMax = np.argmax(arrCounts)
-            # if arrUniqueLabels[arrMax] != -1:
-            #     rtnValue =  arrIDs[arrLabels==arrUniqueLabels[arrMax]]
-            #     self.AddColumn(np.zeros([self.GetNumberOfAtoms(),1]),'GrainNumber',strFormat='%i')
-            #     self.SetColumnByIDs(rtnValue,self.GetColumnIndex('GrainNumber'),np.ones(len(rtnValue)))
         return rtnValue 
     def GetAtomIDsByOrderParameter(self, intOrderIndex: list):
         strColumnName = 'f_' + str(intOrderIndex) + '[2]'
@@ -1361,6 +1837,18 @@ class LAMMPSCorrelate(object): #add grain boundaries and junction lines over dif
         self.__CellVectors = gf.StandardBasisVectors(3)
         self.__BasisConversion = gf.StandardBasisVectors(3)
         self.__BoundaryTypes = ['pp','pp','pp']
+        self.__MatchingMethod = 'greedy'
+        self.__PruningDistance = None
+    def SetMatchingMethod(self, strMethod: str): #'greedy' takes the closest remaining pair each time, 'assignment' minimises the total Hausdorff distance
+        if strMethod not in ['greedy','assignment']:
+            raise Exception('Unknown matching method ' + str(strMethod))
+        self.__MatchingMethod = strMethod
+    def GetMatchingMethod(self)->str:
+        return self.__MatchingMethod
+    def SetPruningDistance(self, fltDistance): #defects further apart than this are never matched and their Hausdorff distance is not computed
+        self.__PruningDistance = fltDistance
+    def GetPruningDistance(self):
+        return self.__PruningDistance
     def AddDefectObject(self, objDefect: gl.DefectObject):
         self.__dctDefects[objDefect.GetTimeStep()] = objDefect
     def GetDefectObject(self, fltTimeStep):
@@ -1397,15 +1885,11 @@ class LAMMPSCorrelate(object): #add grain boundaries and junction lines over dif
         if len(lstPreviousGBIDs) != len(lstCurrentGBIDs):
                 warnings.warn('Number of grain boundaries changed from ' + str(len(lstPreviousGBIDs)) + ' to ' + str(len(lstCurrentGBIDs)) 
                 + ' at time step ' + str(intTimeStep)) 
-        while (len(lstCurrentGBIDs) > 0 and len(lstPreviousGBIDs) > 0):
-            tupCurrentPrevious = np.unravel_index(arrHausdorff.argmin(), arrHausdorff.shape)
-            intCurrent = int(tupCurrentPrevious[0])
-            intPrevious = int(tupCurrentPrevious[1])
+        lstMatches = self.MatchDefects(arrHausdorff)
+        for intCurrent, intPrevious in lstMatches:
             objDefect.GetGrainBoundary(lstCurrentGBIDs[intCurrent]).SetID(lstPreviousGBIDs[intPrevious])
-            del lstCurrentGBIDs[intCurrent]
-            del lstPreviousGBIDs[intPrevious]
-            arrHausdorff = np.delete(arrHausdorff, intCurrent, axis = 0)
-            arrHausdorff = np.delete(arrHausdorff, intPrevious, axis = 1)
+        lstMatched = [x[0] for x in lstMatches]
+        lstCurrentGBIDs = [lstCurrentGBIDs[i] for i in range(len(lstCurrentGBIDs)) if i not in lstMatched]
         while len(lstCurrentGBIDs) > 0: #there are more current GBs than previous GBs
             intID = lstCurrentGBIDs.pop(0)
             if len(objDefect.GetGrainBoundaryIDs()) > 0:
@@ -1425,15 +1909,11 @@ class LAMMPSCorrelate(object): #add grain boundaries and junction lines over dif
         if len(lstPreviousJLIDs) != len(lstCurrentJLIDs):
                 warnings.warn('Number of junction lines changed from ' + str(len(lstPreviousJLIDs)) + ' to ' + str(len(lstCurrentJLIDs)) 
                 + ' at time step ' + str(intTimeStep)) 
-        while (len(lstCurrentJLIDs) > 0 and len(lstPreviousJLIDs) > 0):
-            tupCurrentPrevious = np.unravel_index(arrHausdorff.argmin(), arrHausdorff.shape)
-            intCurrent = int(tupCurrentPrevious[0])
-            intPrevious = int(tupCurrentPrevious[1])
+        lstMatches = self.MatchDefects(arrHausdorff)
+        for intCurrent, intPrevious in lstMatches:
             objDefect.GetJunctionLine(lstCurrentJLIDs[intCurrent]).SetID(lstPreviousJLIDs[intPrevious])
-            del lstCurrentJLIDs[intCurrent]
-            del lstPreviousJLIDs[intPrevious]
-            arrHausdorff = np.delete(arrHausdorff, intCurrent, axis = 0)
-            arrHausdorff = np.delete(arrHausdorff, intPrevious, axis = 1)
+        lstMatched = [x[0] for x in lstMatches]
+        lstCurrentJLIDs = [lstCurrentJLIDs[i] for i in range(len(lstCurrentJLIDs)) if i not in lstMatched]
         while len(lstCurrentJLIDs) > 0: #there are more current GBs than previous GBs
             intID = lstCurrentJLIDs.pop(0)
             if len(objDefect.GetJunctionLineIDs()) > 0:
@@ -1459,19 +1939,76 @@ class LAMMPSCorrelate(object): #add grain boundaries and junction lines over dif
         for j in inPeriodicDirections:
             lstPeriodicity[j] = 'pp'
         return lstPeriodicity
+    def MatchDefects(self, arrDistanceMatrix: np.array)->list: #returns (current, previous) row and column pairs, pruned pairs are infinite and left unmatched
+        lstMatches = []
+        if arrDistanceMatrix.size == 0:
+            return lstMatches
+        if self.__MatchingMethod == 'assignment':
+            arrFinite = np.isfinite(arrDistanceMatrix)
+            fltLarge = 2*np.sum(arrDistanceMatrix[arrFinite]) + 1 #any assignment avoiding a pruned pair is cheaper than one using it
+            arrRows, arrColumns = optimize.linear_sum_assignment(np.where(arrFinite, arrDistanceMatrix, fltLarge))
+            for intCurrent, intPrevious in zip(arrRows, arrColumns):
+                if arrFinite[intCurrent, intPrevious]:
+                    lstMatches.append((int(intCurrent), int(intPrevious)))
+            return sorted(lstMatches, key = lambda x: arrDistanceMatrix[x])
+        arrRemaining = np.copy(arrDistanceMatrix)
+        for i in range(min(arrDistanceMatrix.shape)):
+            tupCurrentPrevious = np.unravel_index(arrRemaining.argmin(), arrRemaining.shape)
+            if not np.isfinite(arrRemaining[tupCurrentPrevious]):
+                break
+            lstMatches.append((int(tupCurrentPrevious[0]), int(tupCurrentPrevious[1])))
+            arrRemaining[tupCurrentPrevious[0],:] = np.inf
+            arrRemaining[:,tupCurrentPrevious[1]] = np.inf
+        return lstMatches
+    def __PeriodicCentroidShifts(self, arrCurrentMeans: np.array, arrPreviousMeans: np.array): #vectorised PeriodicEquivalentMovement over every pair of centroids
+        lstOffsets = []
+        for strBoundary in self.__BoundaryTypes:
+            if strBoundary == 'pp':
+                lstOffsets.append([0,-1,1])
+            else:
+                lstOffsets.append([0])
+        arrOffsets = np.array(list(it.product(*lstOffsets)))
+        arrCoefficients = np.matmul(arrPreviousMeans[np.newaxis,:,:] - arrCurrentMeans[:,np.newaxis,:], self.__BasisConversion)
+        arrIntegers = np.round(arrCoefficients,0)
+        arrDecimals = arrCoefficients - arrIntegers
+        arrCandidates = np.matmul(arrDecimals[:,:,np.newaxis,:] + arrOffsets, np.transpose(self.__CellVectors)) #same metric as gf.InnerProduct
+        arrMin = np.argmin(np.linalg.norm(arrCandidates, axis=3), axis=2)
+        arrShifts = np.matmul(arrIntegers + arrOffsets[arrMin], self.__CellVectors)
+        return np.linalg.norm(arrPreviousMeans[np.newaxis,:,:] - arrShifts - arrCurrentMeans[:,np.newaxis,:], axis=2), arrShifts
     def MakeHausdorffDistanceMatrix(self, lstOfCurrentMeshPoints: list,lstOfPreviousMeshPoints: list)-> np.array:
         arrDistanceMatrix = np.zeros([len(lstOfCurrentMeshPoints), len(lstOfPreviousMeshPoints)])
+        if arrDistanceMatrix.size == 0:
+            return arrDistanceMatrix
+        arrPrune = np.zeros(arrDistanceMatrix.shape, dtype=bool)
+        if self.__PruningDistance is not None: #lower bounds on the Hausdorff distance from the centroids and bounding boxes rule out distant pairs
+            arrCurrentMeans = np.array(list(map(lambda x: np.mean(x, axis=0), lstOfCurrentMeshPoints)))
+            arrPreviousMeans = np.array(list(map(lambda x: np.mean(x, axis=0), lstOfPreviousMeshPoints)))
+            arrCurrentRadii = np.array(list(map(lambda x: np.max(np.linalg.norm(x[1]-x[0],axis=1)), zip(arrCurrentMeans, lstOfCurrentMeshPoints))))
+            arrPreviousRadii = np.array(list(map(lambda x: np.max(np.linalg.norm(x[1]-x[0],axis=1)), zip(arrPreviousMeans, lstOfPreviousMeshPoints))))
+            arrCentroidDistances, arrShifts = self.__PeriodicCentroidShifts(arrCurrentMeans, arrPreviousMeans)
+            arrLowerBound = arrCentroidDistances - np.minimum(arrCurrentRadii[:,np.newaxis], arrPreviousRadii[np.newaxis,:]) #the current centroid is within the Hausdorff distance of the convex hull of the previous points and vice versa
+            arrCurrentMin = np.array(list(map(lambda x: np.min(x, axis=0), lstOfCurrentMeshPoints)))
+            arrCurrentMax = np.array(list(map(lambda x: np.max(x, axis=0), lstOfCurrentMeshPoints)))
+            arrPreviousMin = np.array(list(map(lambda x: np.min(x, axis=0), lstOfPreviousMeshPoints)))[np.newaxis,:,:] - arrShifts
+            arrPreviousMax = np.array(list(map(lambda x: np.max(x, axis=0), lstOfPreviousMeshPoints)))[np.newaxis,:,:] - arrShifts
+            arrBoxBound = np.max(np.maximum(np.abs(arrCurrentMin[:,np.newaxis,:] - arrPreviousMin), np.abs(arrCurrentMax[:,np.newaxis,:] - arrPreviousMax)), axis=2)
+            arrPrune = np.maximum(arrLowerBound, arrBoxBound) > self.__PruningDistance + 1e-5 #small tolerance as the exact shift is recomputed below
+            arrDistanceMatrix[arrPrune] = np.inf
         for intCurrent,arrCurrent in enumerate(lstOfCurrentMeshPoints):
             arrCurrentMean = np.mean(arrCurrent, axis = 0)
             for intPrevious,arrPrevious in enumerate(lstOfPreviousMeshPoints):
+                if arrPrune[intCurrent, intPrevious]:
+                    continue
                 arrPreviousMean = np.mean(arrPrevious, axis = 0)
                 arrPeriodicShift = gf.PeriodicEquivalentMovement(arrCurrentMean, arrPreviousMean, self.__CellVectors, self.__BasisConversion, self.__BoundaryTypes)[2]
                 arrPrevious = arrPrevious - arrPeriodicShift
                 arrDistanceMatrix[intCurrent, intPrevious] = max(spatial.distance.directed_hausdorff(arrCurrent, arrPrevious)[0], spatial.distance.directed_hausdorff(arrPrevious, arrCurrent)[0]) #Hausdorff distance is not symmetric in general and so choose the larger of the two measure.
+                if self.__PruningDistance is not None and arrDistanceMatrix[intCurrent, intPrevious] > self.__PruningDistance:
+                    arrDistanceMatrix[intCurrent, intPrevious] = np.inf
         return arrDistanceMatrix
         
 class QuantisedCuboidPoints(object):
-    def __init__(self, in3DPoints: np.array, inBasisConversion: np.array, inCellVectors: np.array, arrGridDimensions: np.array, intWrapper = None):
+    def __init__(self, in3DPoints: np.array, inBasisConversion: np.array, inCellVectors: np.array, arrGridDimensions: np.array, intWrapper = None, intSlabSize = None):
         arrCuboidCellVectors = np.matmul(inCellVectors,inBasisConversion)
         arrModArray = np.zeros([3])
         self.__BasisVectors = np.zeros([3,3])
@@ -1489,40 +2026,47 @@ class QuantisedCuboidPoints(object):
         self.__Scaling = np.linalg.inv(self.__InverseScaling)
         arrCuboidPoints = np.matmul(in3DPoints, inBasisConversion)
         arrCuboidPoints = np.matmul(arrCuboidPoints, self.__Scaling)    
-        arrValues =  np.zeros([arrModArray[0],arrModArray[1],arrModArray[2]])
-        self.__JunctionLinesArray = np.copy(arrValues)
-        self.__GrainBoundariesArray = np.copy(arrValues)
-        self.__Grains = np.copy(arrValues)
         self.__JunctionLines = []
-        nx,ny,nz = np.shape(arrValues)
         self.__ModArray = arrModArray
         self.__Iterations = 0
-        arrCoordinates = (np.linspace(0,nx-1,nx),np.linspace(0,ny-1,ny),
-                             np.linspace(0,nz-1,nz))
-        for m in range(len(arrCuboidPoints)):
-            k = arrCuboidPoints[m]
-            k = np.round(k,0).astype('int')
-            k = np.mod(k,self.__ModArray)
-            arrValues[k[0],k[1], k[2]] += 1
-        objInterpolate = RegularGridInterpolator(arrCoordinates, arrValues, method = 'linear')
-        self.__DefectPositions = arrValues.astype('bool').astype('int')
-        self.__Coordinates = gf.CreateCuboidPoints(np.array([[0,nx-1],[0,ny-1],[0,nz-1]]))
-        arrOut = objInterpolate(self.__Coordinates)
-        arrOut = np.reshape(arrOut,arrModArray)
-        arrOut = ndimage.filters.gaussian_filter(arrOut, 2, mode = 'wrap')
-        fltThreshold = threshold_otsu(arrOut)
-        arrOut = (arrOut > fltThreshold)
-        arrOut = ndimage.binary_dilation(arrOut, np.ones([3,3,3]))
-        arrOut = arrOut.astype('bool').astype('int') # convert to binary
+        arrVoxels = np.mod(np.round(arrCuboidPoints,0).astype('int'),self.__ModArray) #coordinates along the cell vectors so triclinic cells bin the same way
         self.__Iterations = 3
-        self.__BinaryArray = arrOut
-        self.__InvertBinary = np.invert(self.__BinaryArray.astype('bool')).astype('int')
-        self.__Grains, intGrainLabels  = ndimage.measurements.label(self.__InvertBinary, np.array([[[0,0,0],[0,1,0],[0,0,0]],[[0,1,0],[1,1,1],[0,1,0]],[[0,0,0],[0,1,0],[0,0,0]]])) #don't allow grains to connect diagonally
+        self.__SlabSize = intSlabSize
+        if intSlabSize is None:
+            arrValues =  np.zeros([arrModArray[0],arrModArray[1],arrModArray[2]])
+            self.__JunctionLinesArray = np.copy(arrValues)
+            self.__GrainBoundariesArray = np.copy(arrValues)
+            self.__Grains = np.copy(arrValues)
+            nx,ny,nz = np.shape(arrValues)
+            arrCoordinates = (np.linspace(0,nx-1,nx),np.linspace(0,ny-1,ny),
+                                 np.linspace(0,nz-1,nz))
+            arrValues += np.reshape(np.bincount(np.ravel_multi_index(np.transpose(arrVoxels), tuple(self.__ModArray)), minlength=np.prod(self.__ModArray)), self.__ModArray)
+            self.__DefectPositions = arrValues.astype('bool').astype('int')
+            objInterpolate = RegularGridInterpolator(arrCoordinates, arrValues, method = 'linear')
+            arrOut = objInterpolate(gf.CreateCuboidPoints(np.array([[0,nx-1],[0,ny-1],[0,nz-1]])))
+            arrOut = np.reshape(arrOut,arrModArray)
+            arrOut = ndimage.filters.gaussian_filter(arrOut, 2, mode = 'wrap')
+            fltThreshold = threshold_otsu(arrOut)
+            arrOut = (arrOut > fltThreshold)
+            arrOut = ndimage.binary_dilation(arrOut, np.ones([3,3,3]))
+            arrOut = arrOut.astype('bool').astype('int') # convert to binary
+            self.__BinaryArray = arrOut
+            self.__InvertBinary = np.invert(self.__BinaryArray.astype('bool')).astype('int')
+            self.__Grains, intGrainLabels  = ndimage.measurements.label(self.__InvertBinary, np.array([[[0,0,0],[0,1,0],[0,0,0]],[[0,1,0],[1,1,1],[0,1,0]],[[0,0,0],[0,1,0],[0,0,0]]])) #don't allow grains to connect diagonally
+        else: #the interpolator is the identity at the grid points so the slabs bin the atoms directly
+            self.__SlabSize = max(int(intSlabSize),1)
+            self.__JunctionLinesArray = [] #the full sized arrays are only made on disk when they are found
+            self.__GrainBoundariesArray = []
+            self.__BinaryArray = self.__MakeBinaryInSlabs(arrVoxels)
+            self.__Grains, intGrainLabels = self.__LabelGrainsInSlabs()
         if intGrainLabels <= 1:
             warnings.warn('Only ' + str(intGrainLabels) + ' grain(s) detected')
         self.__Grains = np.asarray(self.__Grains)
-        lstGrainLabels = list(np.unique(self.__Grains))
-        lstGrainLabels.remove(0)
+        if self.__SlabSize is None:
+            lstGrainLabels = list(np.unique(self.__Grains))
+            lstGrainLabels.remove(0)
+        else:
+            lstGrainLabels = list(range(1, intGrainLabels+1)) #the slab labels are already sequential
         self.__GrainLabels = lstGrainLabels
         if intWrapper is not(None):
             self.__blnPeriodic = True
@@ -1531,23 +2075,108 @@ class QuantisedCuboidPoints(object):
             self.MergeEquivalentGrains() #if two grains are periodically linked then merge them into one
             self.MakeReturnGrains()
             self.ExpandGrains() #expand all the grains until the grain boundaries are dissolved
+    def __SlabRanges(self): #the whole grid is one slab when no slab size is set
+        intLength = self.__ModArray[0]
+        intSize = intLength if self.__SlabSize is None else self.__SlabSize
+        return [(i, min(i+intSize, intLength)) for i in range(0, intLength, intSize)]
+    def __MakeArray(self, strType: str)->np.array: #slab mode keeps every full sized array on disk
+        if self.__SlabSize is None:
+            return np.zeros(self.__ModArray, dtype=strType)
+        return np.memmap(tempfile.TemporaryFile(), dtype=strType, mode='w+', shape=tuple(self.__ModArray))
+    def __CountValue(self, inArray: np.array, intValue: int)->int:
+        return sum(np.count_nonzero(inArray[intStart:intEnd] == intValue) for intStart, intEnd in self.__SlabRanges())
+    def __MakeBinaryInSlabs(self, inVoxels: np.array):
+        intLength = self.__ModArray[0]
+        intPlane = self.__ModArray[1]*self.__ModArray[2]
+        intHalo = int(4*2 + 0.5) #matches the truncation of the sigma 2 gaussian filter
+        arrOrder = np.argsort(inVoxels[:,0], kind='stable') #atoms sorted by row so each slab only bins its own atoms
+        arrPlanes = inVoxels[arrOrder,1]*self.__ModArray[2] + inVoxels[arrOrder,2]
+        arrStarts = np.searchsorted(inVoxels[arrOrder,0], np.arange(intLength+1))
+        self.__DefectPositions = self.__MakeArray('uint8')
+        arrSmoothed = self.__MakeArray('float64') #the smoothed field is held on disk
+        fltMin = np.inf
+        fltMax = -np.inf
+        for intStart, intEnd in self.__SlabRanges():
+            arrRows = np.mod(np.arange(intStart - intHalo, intEnd + intHalo), intLength)
+            arrValues = np.stack([np.bincount(arrPlanes[arrStarts[i]:arrStarts[i+1]], minlength=intPlane) for i in arrRows]).astype('float')
+            arrValues = np.reshape(arrValues, (len(arrRows), self.__ModArray[1], self.__ModArray[2]))
+            self.__DefectPositions[intStart:intEnd] = arrValues[intHalo:intHalo + intEnd - intStart] > 0
+            arrSlab = ndimage.filters.gaussian_filter(arrValues, 2, mode = 'wrap')[intHalo:intHalo + intEnd - intStart]
+            arrSmoothed[intStart:intEnd] = arrSlab
+            fltMin = min(fltMin, np.min(arrSlab))
+            fltMax = max(fltMax, np.max(arrSlab))
+        arrHistogram = np.zeros(256, dtype='int')
+        for intStart, intEnd in self.__SlabRanges():
+            arrHistogram += np.histogram(arrSmoothed[intStart:intEnd], bins=256, range=(fltMin, fltMax))[0]
+        arrEdges = np.linspace(fltMin, fltMax, 257)
+        fltThreshold = threshold_otsu(hist=(arrHistogram, (arrEdges[:-1] + arrEdges[1:])/2)) #same histogram threshold_otsu builds from the whole array
+        arrBinary = self.__MakeArray('uint8')
+        for intStart, intEnd in self.__SlabRanges():
+            arrRows = np.arange(intStart-1, intEnd+1)
+            arrSlab = arrSmoothed[np.mod(arrRows, intLength)] > fltThreshold
+            arrSlab[(arrRows < 0) | (arrRows >= intLength)] = False #the dilation is not periodic
+            arrBinary[intStart:intEnd] = ndimage.binary_dilation(arrSlab, np.ones([3,3,3]))[1:-1]
+        del arrSmoothed
+        return arrBinary
+    def __LabelGrainsInSlabs(self):
+        arrStructure = np.array([[[0,0,0],[0,1,0],[0,0,0]],[[0,1,0],[1,1,1],[0,1,0]],[[0,0,0],[0,1,0],[0,0,0]]]) #don't allow grains to connect diagonally
+        intPlane = self.__ModArray[1]*self.__ModArray[2]
+        arrGrains = self.__MakeArray('int32')
+        lstFirst = []
+        intLabels = 0
+        for intStart, intEnd in self.__SlabRanges():
+            arrSlab, intSlabLabels = ndimage.measurements.label(self.__BinaryArray[intStart:intEnd] == 0, arrStructure)
+            arrUnique, arrFirst = np.unique(arrSlab, return_index=True)
+            lstFirst.append(arrFirst[arrUnique > 0] + intStart*intPlane)
+            arrSlab[arrSlab > 0] += intLabels
+            arrGrains[intStart:intEnd] = arrSlab
+            intLabels += intSlabLabels
+        if intLabels == 0:
+            return arrGrains, 0
+        lstRows = []
+        lstColumns = []
+        for intStart, intEnd in self.__SlabRanges()[1:]: #stitch labels which meet across the slab faces
+            arrLower = arrGrains[intStart-1]
+            arrUpper = arrGrains[intStart]
+            arrBoth = (arrLower > 0) & (arrUpper > 0)
+            lstRows.append(arrLower[arrBoth] - 1)
+            lstColumns.append(arrUpper[arrBoth] - 1)
+        arrRows = np.concatenate(lstRows + [np.zeros(0, dtype='int32')])
+        arrColumns = np.concatenate(lstColumns + [np.zeros(0, dtype='int32')])
+        objGraph = sparse.coo_matrix((np.ones(len(arrRows)), (arrRows, arrColumns)), shape=(intLabels, intLabels))
+        intGrainLabels, arrComponents = connected_components(objGraph, directed=False)
+        arrFirst = np.full(intGrainLabels, np.iinfo('int64').max)
+        np.minimum.at(arrFirst, arrComponents, np.concatenate(lstFirst))
+        arrOrder = np.zeros(intGrainLabels, dtype='int32')
+        arrOrder[np.argsort(arrFirst)] = np.arange(1, intGrainLabels+1) #number grains in raster order as ndimage.label does
+        arrLookUp = np.zeros(intLabels+1, dtype='int32')
+        arrLookUp[1:] = arrOrder[arrComponents]
+        for intStart, intEnd in self.__SlabRanges():
+            arrGrains[intStart:intEnd] = arrLookUp[arrGrains[intStart:intEnd]]
+        return arrGrains, intGrainLabels
     def MakeReturnGrains(self):
-        self.__ReturnGrains = np.copy(self.__Grains) #This array is used to evaluate all the lattice points 
-        self.__ReturnGrains[self.__ReturnGrains == 0] = -1 #if they are in a defective region assign the value -1
+        self.__ReturnGrains = self.__MakeArray(self.__Grains.dtype) #This array is used to evaluate all the lattice points 
+        for intStart, intEnd in self.__SlabRanges():
+            arrSlab = np.array(self.__Grains[intStart:intEnd])
+            arrSlab[arrSlab == 0] = -1 #if they are in a defective region assign the value -1
+            self.__ReturnGrains[intStart:intEnd] = arrSlab
     def GetDefectPositions(self):
         return self.__DefectPositions
     def MergeEquivalentGrains(self):
+        arrLookUp = np.arange(max(self.__GrainLabels, default=0)+1) #current label of each original label so the merges only touch the label list
         for j in self.__EquivalentGrains:
             if len(j) > 0:
                 for k in j[1:]:
-                    self.__Grains[self.__Grains == k] = j[0]
-        lstValues = list(np.unique(self.__Grains))
-        lstValues.remove(0)
-        for intIndex, intValue in enumerate(lstValues):
-            self.__Grains[self.__Grains == intValue] = intIndex+1 
-        lstValues = list(np.unique(self.__Grains))
-        lstValues.remove(0)
-        self.__GrainLabels = lstValues        
+                    arrLookUp[arrLookUp == k] = j[0]
+        lstValues = list(np.unique(arrLookUp[self.__GrainLabels]))
+        if 0 in lstValues:
+            lstValues.remove(0)
+        arrRenumber = np.zeros(len(arrLookUp), dtype='int')
+        arrRenumber[lstValues] = np.arange(1, len(lstValues)+1)
+        arrLookUp = arrRenumber[arrLookUp].astype(self.__Grains.dtype)
+        for intStart, intEnd in self.__SlabRanges():
+            self.__Grains[intStart:intEnd] = arrLookUp[self.__Grains[intStart:intEnd]]
+        self.__GrainLabels = list(range(1, len(lstValues)+1))
     def ExtendArrayPeriodically(self, intWrapperWidth: int):
         n = intWrapperWidth
         self.__ExtendedGrains = np.zeros([self.__ModArray[0]+2*n,self.__ModArray[1]+2*n, self.__ModArray[2]+2*n])
@@ -1562,20 +2191,15 @@ class QuantisedCuboidPoints(object):
         self.__ExtendedGrains[:,:,-n:] = self.__ExtendedGrains[:,:,n:2*n]
         self.__ExtendedGrains = self.__ExtendedGrains.astype('int') 
     def CheckPeriodicGrains(self):
-        lstEquivalentGrains = []
-        for intCurrentGrain in self.__GrainLabels:
-            lstMatchedGrains = [intCurrentGrain]
-            for j in range(3):
-                arrCellBoundaryPoints = self.CellBoundaryPoints(j, self.GetGrainPoints(intCurrentGrain),True)
-                arrCellBoundaryPoints[:,j] = arrCellBoundaryPoints[:,j] + self.__ModArray[j] -1
-                lstMatchedGrains.extend(list(np.unique(self.__Grains[arrCellBoundaryPoints[:,0],arrCellBoundaryPoints[:,1],arrCellBoundaryPoints[:,2]])))
-                arrCellBoundaryPoints = self.CellBoundaryPoints(j, self.GetGrainPoints(intCurrentGrain),False)
-                arrCellBoundaryPoints[:,j] = np.zeros(len(arrCellBoundaryPoints[:,j]))
-                lstMatchedGrains.extend(list(np.unique(self.__Grains[arrCellBoundaryPoints[:,0],arrCellBoundaryPoints[:,1],arrCellBoundaryPoints[:,2]])))
-            lstMatchedGrains = list(np.unique(lstMatchedGrains))
-            if 0 in lstMatchedGrains:
-                lstMatchedGrains.remove(0)
-            lstEquivalentGrains.append(lstMatchedGrains)
+        dctMatchedGrains = {intGrain: {intGrain} for intGrain in self.__GrainLabels}
+        for j in range(3): #grains touching on opposite faces of the cell are periodically linked
+            arrZeroFace = np.ravel(np.take(self.__Grains, 0, axis=j))
+            arrOtherFace = np.ravel(np.take(self.__Grains, self.__ModArray[j]-1, axis=j))
+            for arrFace, arrOpposite in [(arrZeroFace, arrOtherFace), (arrOtherFace, arrZeroFace)]:
+                arrBoth = (arrFace > 0) & (arrOpposite > 0)
+                for intGrain, intMatch in np.unique(np.transpose([arrFace[arrBoth], arrOpposite[arrBoth]]), axis=0):
+                    dctMatchedGrains[int(intGrain)].add(int(intMatch))
+        lstEquivalentGrains = [sorted(dctMatchedGrains[intGrain]) for intGrain in self.__GrainLabels]
         self.__EquivalentGrains = lstEquivalentGrains
         return lstEquivalentGrains
     def CellBoundaryPoints(self, intAxis: int, inPoints: np.array, blnZeroFace = True)->np.array: #returns boundary points
@@ -1592,21 +2216,25 @@ class QuantisedCuboidPoints(object):
         inPoints = np.matmul(inPoints, self.__BasisConversion)
         inPoints = np.round(inPoints, 0).astype('int')
         inPoints = np.mod(inPoints, self.__ModArray)
-        if len(np.argwhere(self.__ExpandedGrains == 0)) > 0:
+        if self.__ExpandedDefects > 0:
             warnings.warn('Expanded grain method has not removed all grain boundary atoms')
         if blnExpanded:
             return list(self.__ReturnGrains[inPoints[:,0],inPoints[:,1],inPoints[:,2]])
         else:
-            arrZeros = np.argwhere(self.__BinaryArray == 0)
-            self.__ReturnGrains = np.copy(self.__ExpandedGrains)
-            for j in arrZeros:
-                self.__ReturnGrains[j[0],j[1],j[2]] = 0
+            self.__ReturnGrains = self.__MakeArray(self.__ExpandedGrains.dtype)
+            for intStart, intEnd in self.__SlabRanges():
+                arrSlab = np.array(self.__ExpandedGrains[intStart:intEnd])
+                arrSlab[self.__BinaryArray[intStart:intEnd] == 0] = 0
+                self.__ReturnGrains[intStart:intEnd] = arrSlab
             return list(self.__ReturnGrains[inPoints[:,0],inPoints[:,1],inPoints[:,2]])                     
     def FindGrainBoundaries(self):
+        if self.__SlabSize is not None:
+            self.__GrainBoundariesArray, intLabels = self.__LabelPeriodicInSlabs(self.__GrainBoundariesInSlabs())
+            self.__GrainBoundaryIDs = list(range(1, intLabels+1))
+            return
         arrGrainBoundaries = np.zeros(self.__ModArray) #temporary array 
         lstGrainBoundaryList = []
-        for j in self.__Coordinates:
-            j = j.astype('int')
+        for j in np.ndindex(*self.__ModArray): #raster order without holding a grid of coordinates
             arrBox  = self.__ExpandedGrains[gf.WrapAroundSlice(np.array([[j[0],j[0]+2],[j[1],j[1]+2],[j[2],j[2]+2]]),self.__ModArray)]
             lstValues = list(np.unique(arrBox))
             if len(lstValues) ==2:
@@ -1625,6 +2253,10 @@ class QuantisedCuboidPoints(object):
         self.__GrainBoundaryIDs = lstValues
     def FindJunctionLines(self):
         self.FindGrainBoundaries()
+        if self.__SlabSize is not None:
+            self.__JunctionLinesArray, intLabels = self.__LabelPeriodicInSlabs(self.__JunctionLinesInSlabs())
+            self.__JunctionLineIDs = list(range(1, intLabels+1))
+            return
         arrJunctionLines = np.zeros(self.__ModArray)
         lstJunctionLineList = []
         arrPoints = np.argwhere(self.__GrainBoundariesArray == 0) #junction line points have value 0 in the grain boundaries array
@@ -1647,6 +2279,103 @@ class QuantisedCuboidPoints(object):
         if 0 in lstValues:
             lstValues.remove(0)
         self.__JunctionLineIDs = lstValues
+    def __GrainBoundariesInSlabs(self): #the 2 x 2 x 2 box test of FindGrainBoundaries for a whole slab at once
+        arrGrainBoundaries = self.__MakeArray('int32')
+        intBase = 1 + max(np.max(self.__ExpandedGrains[intStart:intEnd]) for intStart, intEnd in self.__SlabRanges())
+        dctPairs = dict()
+        for intStart, intEnd in self.__SlabRanges():
+            tupCore = (intEnd - intStart, self.__ModArray[1], self.__ModArray[2])
+            lstRows = [np.mod(np.arange(intStart, intEnd+1), self.__ModArray[0])]
+            lstRows += [np.mod(np.arange(self.__ModArray[j]+1), self.__ModArray[j]) for j in [1,2]]
+            arrPadded = self.__ExpandedGrains[np.ix_(*lstRows)]
+            arrBoxes = np.sort(np.stack([arrPadded[i:i+tupCore[0],j:j+tupCore[1],k:k+tupCore[2]] for i,j,k in np.ndindex(2,2,2)]), axis=0)
+            arrBoundary = np.count_nonzero(np.diff(arrBoxes, axis=0), axis=0) == 1 #exactly two grains in the box
+            arrPairs = arrBoxes[0][arrBoundary].astype('int64')*intBase + arrBoxes[-1][arrBoundary]
+            del arrBoxes
+            arrSlab = np.zeros(tupCore, dtype='int32')
+            if len(arrPairs) > 0:
+                arrUnique, arrFirst, arrInverse = np.unique(arrPairs, return_index=True, return_inverse=True)
+                for intPair in arrUnique[np.argsort(arrFirst)]: #number pairs in the raster order they are first found
+                    if int(intPair) not in dctPairs:
+                        dctPairs[int(intPair)] = len(dctPairs) + 1
+                arrSlab[arrBoundary] = np.array([dctPairs[int(intPair)] for intPair in arrUnique])[arrInverse]
+            arrGrainBoundaries[intStart:intEnd] = arrSlab
+        return arrGrainBoundaries
+    def __JunctionLinesInSlabs(self): #the 3 x 3 x 3 box test of FindJunctionLines for a whole slab at once
+        arrJunctionLines = self.__MakeArray('int32')
+        dctLines = dict()
+        for intStart, intEnd in self.__SlabRanges():
+            tupCore = (intEnd - intStart, self.__ModArray[1], self.__ModArray[2])
+            lstRows = [np.mod(np.arange(intStart-1, intEnd+1), self.__ModArray[0])]
+            lstRows += [np.mod(np.arange(-1, self.__ModArray[j]+1), self.__ModArray[j]) for j in [1,2]]
+            arrPadded = self.__GrainBoundariesArray[np.ix_(*lstRows)]
+            arrCandidates = arrPadded[1:-1,1:-1,1:-1] == 0 #junction line points have value 0 in the grain boundaries array
+            arrBoxes = np.sort(np.stack([arrPadded[i:i+tupCore[0],j:j+tupCore[1],k:k+tupCore[2]][arrCandidates] for i,j,k in np.ndindex(3,3,3)], axis=1), axis=1)
+            arrDistinct = np.concatenate([arrBoxes[:,:1] != 0, (np.diff(arrBoxes, axis=1) != 0)], axis=1) #each nonzero value once
+            arrJunction = np.count_nonzero(arrDistinct, axis=1) > 2 #count the number of distinct grain boundaries
+            arrSlab = np.zeros(tupCore, dtype='int32')
+            arrIDs = np.zeros(len(arrBoxes), dtype='int32')
+            for intIndex in np.flatnonzero(arrJunction):
+                tupValues = tuple(arrBoxes[intIndex][arrDistinct[intIndex]].tolist())
+                if tupValues not in dctLines:
+                    dctLines[tupValues] = len(dctLines) + 1
+                arrIDs[intIndex] = dctLines[tupValues]
+            arrSlab[arrCandidates] = arrIDs
+            arrJunctionLines[intStart:intEnd] = arrSlab
+        return arrJunctionLines
+    def __LabelPeriodicInSlabs(self, inArray: np.array): #labels inArray in place, numbered as FindPeriodicBoundaries and the sequential renumbering would
+        intPlane = self.__ModArray[1]*self.__ModArray[2]
+        lstValues = []
+        lstFirst = []
+        intLabels = 0
+        for intStart, intEnd in self.__SlabRanges():
+            arrSlab = np.array(inArray[intStart:intEnd])
+            arrLabels = np.zeros(np.shape(arrSlab), dtype='int32')
+            for intValue, tupSlice in enumerate(ndimage.find_objects(arrSlab), 1): #only the bounding box of each value is labelled
+                if tupSlice is not None:
+                    arrBox, intBoxLabels = ndimage.measurements.label(arrSlab[tupSlice] == intValue, np.ones([3,3,3]))
+                    arrUnique, arrFirst = np.unique(arrBox, return_index=True)
+                    arrFirst = np.transpose(np.unravel_index(arrFirst[arrUnique > 0], np.shape(arrBox))) + [j.start for j in tupSlice] + [intStart, 0, 0]
+                    lstFirst.append(np.ravel_multi_index(np.transpose(arrFirst), tuple(self.__ModArray)))
+                    lstValues.append(np.full(intBoxLabels, intValue))
+                    arrLabels[tupSlice][arrBox > 0] = arrBox[arrBox > 0] + intLabels
+                    intLabels += intBoxLabels
+            inArray[intStart:intEnd] = arrLabels
+        if intLabels == 0:
+            return inArray, 0
+        arrValueOf = np.concatenate([[0]] + lstValues)
+        lstPairs = []
+        def AddPairs(arrOne: np.array, arrTwo: np.array):
+            arrBoth = (arrOne > 0) & (arrTwo > 0)
+            arrBoth[arrBoth] = arrValueOf[arrOne[arrBoth]] == arrValueOf[arrTwo[arrBoth]]
+            lstPairs.append(np.transpose([arrOne[arrBoth], arrTwo[arrBoth]]))
+        for intStart, intEnd in self.__SlabRanges(): #links across the slab faces, including the periodic one
+            arrLower = np.array(inArray[intStart-1])
+            arrUpper = np.array(inArray[intStart])
+            for j, k in np.ndindex(3,3):
+                AddPairs(arrLower, np.roll(arrUpper, (j-1, k-1), axis=(0,1)))
+        for intStart, intEnd in self.__SlabRanges(): #periodic links across the other two cell faces
+            for intAxis in [1,2]:
+                arrZeroFace = np.take(inArray[intStart:intEnd], 0, axis=intAxis)
+                arrOtherFace = np.take(inArray[intStart:intEnd], self.__ModArray[intAxis]-1, axis=intAxis)
+                for i, k in np.ndindex(3,3):
+                    tupOther = slice(max(0, 1-i), len(arrZeroFace) + min(0, 1-i))
+                    tupZero = slice(max(0, i-1), len(arrZeroFace) + min(0, i-1))
+                    AddPairs(arrOtherFace[tupOther], np.roll(arrZeroFace[tupZero], k-1, axis=1))
+        arrPairs = np.concatenate(lstPairs) - 1
+        objGraph = sparse.coo_matrix((np.ones(len(arrPairs)), (arrPairs[:,0], arrPairs[:,1])), shape=(intLabels, intLabels))
+        intComponents, arrComponents = connected_components(objGraph, directed=False)
+        arrValue = np.zeros(intComponents, dtype='int')
+        arrValue[arrComponents] = arrValueOf[1:]
+        arrFirst = np.full(intComponents, np.iinfo('int64').max)
+        np.minimum.at(arrFirst, arrComponents, np.concatenate(lstFirst))
+        arrOrder = np.zeros(intComponents, dtype='int32')
+        arrOrder[np.lexsort((arrFirst, arrValue))] = np.arange(1, intComponents+1) #by value then by the first voxel in raster order
+        arrLookUp = np.zeros(intLabels+1, dtype='int32')
+        arrLookUp[1:] = arrOrder[arrComponents]
+        for intStart, intEnd in self.__SlabRanges():
+            inArray[intStart:intEnd] = arrLookUp[inArray[intStart:intEnd]]
+        return inArray, intComponents
     def FindPeriodicBoundaries(self,inArray: np.array):
         inArray = inArray.astype('int')
         intMaxNumber = 0
@@ -1687,66 +2416,73 @@ class QuantisedCuboidPoints(object):
             return True
         else:
             return False
-    def ExpandGrains(self, n=3):
-        n += 2*self.__Iterations 
-        self.__ExpandedGrains = np.copy(self.__Grains)
-        arrGBPoints = np.argwhere(self.__Grains == 0)
-        arrGBPoints = arrGBPoints.astype('int')
-        arrIndices = gf.CreateCuboidPoints(np.array([[-n,n],[-n,n],[-n,n]]))
-        arrIndices = np.matmul(np.matmul(arrIndices, self.__InverseBasisConversion),self.__InverseScaling)
-        arrDistances = np.reshape(np.array(list(map(np.linalg.norm, arrIndices))),(2*n+1,2*n+1,2*n+1))
-        if len(arrGBPoints) > 0 :
-            for j in arrGBPoints:
-                if self.BoxIsNotWrapped(j, n):
-                    arrBox = self.__Grains[j[0]-n:j[0]+n+1,j[1]-n:j[1]+n+1, j[2]-n:j[2]+n+1]
-                else:
-                    arrBox = self.__Grains[gf.WrapAroundSlice(np.array([[j[0]-n,j[0]+n+1],[j[1]-n,j[1]+n+1], [j[2]-n,j[2]+n+1]]),self.__ModArray)]
-                    arrBox = np.reshape(arrBox,(2*n+1,2*n+1,2*n+1))
-                arrGrainPoints = np.where(arrBox != 0) 
-                if np.size(arrGrainPoints) > 0:
-                    arrGrainDistances = arrDistances[arrGrainPoints]
-                    arrClosestPoint = np.where(arrGrainDistances == np.min(arrGrainDistances))
-                    arrGrainPoints = np.transpose(np.array(arrGrainPoints))
-                    arrPosition = arrGrainPoints[arrClosestPoint]
-                    if len(arrPosition) == 1:    
-                        self.__ExpandedGrains[j[0],j[1],j[2]] = arrBox[arrPosition[0,0],arrPosition[0,1],arrPosition[0,2]]
+    def ExpandGrains(self, n=3): #n is kept for compatibility, the distance transform is not limited to a box around each defect
+        intNumberOfDefects = self.__CountValue(self.__Grains, 0)
+        if intNumberOfDefects == 0 or intNumberOfDefects == np.prod(self.__ModArray):
+            self.__ExpandedGrains = self.__MakeArray(self.__Grains.dtype)
+            for intStart, intEnd in self.__SlabRanges():
+                self.__ExpandedGrains[intStart:intEnd] = self.__Grains[intStart:intEnd]
+            if intNumberOfDefects == 0:
+                warnings.warn("Unable to find any defective regions")
         else:
-            warnings.warn("Unable to find any defective regions")
-        arrGBPoints = np.argwhere(self.__ExpandedGrains == 0)
-        n = 3
-        counter = 0
-        while (counter < len(arrGBPoints)): 
-            l = arrGBPoints[counter]
-            if self.BoxIsNotWrapped(l,n):
-                arrBox = self.__ExpandedGrains[l[0]-n:l[0]+n+1,l[1]-n:l[1]+n+1, l[2]-n:l[2]+n+1]
+            arrMetric = np.matmul(self.__InverseBasisConversion,self.__InverseScaling) #same voxel metric as the distances used to compare grain points
+            arrSampling = np.linalg.norm(arrMetric, axis=1) #exact for cuboid cells where arrMetric is diagonal
+            if self.__SlabSize is None:
+                self.__ExpandedGrains = self.__NearestGrains(0, self.__ModArray[0], arrSampling)
+            else:
+                self.__ExpandedGrains = self.__MakeArray(self.__Grains.dtype)
+                for intStart, intEnd in self.__SlabRanges():
+                    self.__ExpandedGrains[intStart:intEnd] = self.__NearestGrains(intStart, intEnd, arrSampling)
+        self.__ExpandedDefects = self.__CountValue(self.__ExpandedGrains, 0)
+        if self.__ExpandedDefects > 0:
+            warnings.warn('Error expanding grains. The ExpandedGrains array still has ' + str(self.__ExpandedDefects) + ' defect(s)')
+    def __NearestGrains(self, intStart: int, intEnd: int, arrSampling: np.array)->np.array: #labels rows intStart to intEnd with the nearest grain
+        arrHalf = np.ceil(self.__ModArray/2).astype('int') #a halo of half the cell sees the nearest periodic image of every grain
+        arrCore = np.array([intEnd - intStart, self.__ModArray[1], self.__ModArray[2]])
+        arrHalo = np.ones(3, dtype='int') #a thin halo first, which bounds how far the defects are from a grain
+        while True:
+            arrHalo = np.minimum(arrHalo, arrHalf)
+            arrFull = arrHalo >= arrHalf
+            lstRows = [np.mod(np.arange(intStart - arrHalo[0], intEnd + arrHalo[0]), self.__ModArray[0])]
+            lstRows += [np.mod(np.arange(-arrHalo[j], self.__ModArray[j] + arrHalo[j]), self.__ModArray[j]) for j in [1,2]]
+            arrPadded = self.__Grains[np.ix_(*lstRows)]
+            tupCore = tuple(slice(arrHalo[j], arrHalo[j] + arrCore[j]) for j in range(3))
+            if np.any(arrPadded != 0):
+                arrIndices = ndimage.distance_transform_edt(arrPadded == 0, sampling=arrSampling, return_distances=False, return_indices=True) #int32 indices
+                if np.all(arrFull):
+                    break
+                fltFurthest = 0
+                blnInside = True
+                for i in range(arrHalo[0], arrHalo[0] + arrCore[0]): #one plane at a time so the check stays small
+                    arrDefects = np.argwhere(arrPadded[(i,) + tupCore[1:]] == 0) + arrHalo[1:] #only defect voxels need their distance checked
+                    if len(arrDefects) > 0:
+                        arrDefects = np.column_stack([np.full(len(arrDefects), i), arrDefects])
+                        arrNearest = np.transpose(arrIndices[(slice(None),) + tuple(np.transpose(arrDefects))])
+                        arrDistances = np.linalg.norm((arrNearest - arrDefects)*arrSampling, axis=1)
+                        arrCut = np.where(arrFull, np.inf, np.minimum(arrDefects + 1, np.array(np.shape(arrPadded)) - arrDefects)*arrSampling) #nothing beyond the halo can be nearer than this
+                        blnInside = blnInside and np.all(arrDistances < np.min(arrCut, axis=1))
+                        fltFurthest = max(fltFurthest, np.max(arrDistances))
+                if blnInside:
+                    break
+                del arrIndices, arrPadded
+                arrHalo = np.maximum(np.ceil(fltFurthest/arrSampling).astype('int') + 1, arrHalo + 1) #every grain found is a real periodic image so this halo is enough
+            elif np.all(arrFull):
+                return np.zeros(arrCore, dtype=self.__Grains.dtype)
             else:
-                arrBox = self.__ExpandedGrains[gf.WrapAroundSlice(np.array([[l[0]-n,l[0]+n+1],[l[1]-n,l[1]+n+1], [l[2]-n,l[2]+n+1]]),self.__ModArray)]
-            arrBox = arrBox[arrBox != 0]
-            if len(arrBox) > 0:
-                arrValues, arrCounts = np.unique(arrBox, return_counts = True)
-                intGrain = arrValues[np.argmax(arrCounts)]
-                if len(np.argwhere(arrValues == intGrain)) ==1 or n >  np.round(min(self.__ModArray)/2,0).astype('int'):
-                    self.__ExpandedGrains[l[0],l[1],l[2]] = intGrain
-                    counter += 1
-                else:
-                    n += 1
-        intNumberOfDefects = len(np.argwhere(self.__ExpandedGrains == 0))
-        if intNumberOfDefects > 0:
-            warnings.warn('Error expanding grains. The ExpandedGrains array still has ' + str(intNumberOfDefects) + ' defect(s)')
+                arrHalo = 2*arrHalo
+        return arrPadded[tuple(arrIndices[(slice(None),) + tupCore])]
     def GetExpandedGrains(self):
         return self.__ExpandedGrains
     def GetGrainBoundaryPoints(self, intGrainBoundaryID = None):
         if intGrainBoundaryID is None:
-            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__GrainBoundariesArray.astype('int') != 0)) +np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion) 
+            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__GrainBoundariesArray != 0)) +np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion) 
         elif intGrainBoundaryID in self.__GrainBoundaryIDs: 
-            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__GrainBoundariesArray.astype('int') == intGrainBoundaryID))+np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion)
+            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__GrainBoundariesArray == intGrainBoundaryID))+np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion)
         else:
             warnings.warn(str(intGrainBoundaryID) + ' is an invalid grain boundary ID')
     def MergeMeshPoints(self, inGridPoints: np.array):#This merges grain boundaries or junction lines so they form one group of points when they were
         lstPoints = []   #previously split over the simulation cell boundaries
-        arrDistanceMatrix = pairwise_distances(inGridPoints)
-        clustering = DBSCAN(eps=2, metric = 'precomputed', min_samples = 1).fit(arrDistanceMatrix)
-        arrLabels = clustering.labels_
+        arrLabels = gf.RadiusGraphClusters(inGridPoints, 2, 1)
         intLabels = len(np.unique(arrLabels))
         if intLabels > 1: 
             arrConnected = np.ones(3) #assumes the defect is connected in all three directions
@@ -1767,9 +2503,7 @@ class QuantisedCuboidPoints(object):
                 if arrConnected[k] == 0:
                     arrNearPoints = np.where((arrTotal[:,k] >= -self.__ModArray[k]/2) & (arrTotal[:,k] < 3*self.__ModArray[k]/2))[0]
                     arrTotal = arrTotal[arrNearPoints]  
-            arrDistanceMatrix  = pairwise_distances(arrTotal)    
-            clustering = DBSCAN(eps=2, metric = 'precomputed',min_samples = 1).fit(arrDistanceMatrix)
-            arrLabels = clustering.labels_
+            arrLabels = gf.RadiusGraphClusters(arrTotal, 2, 1)
             arrUniqueValues, arrCounts = np.unique(arrLabels, return_counts = True)
             intMaxValue = max(arrCounts)
             arrMaxLabels = arrUniqueValues[arrCounts == intMaxValue]
@@ -1782,9 +2516,9 @@ class QuantisedCuboidPoints(object):
             return inGridPoints
     def GetJunctionLinePoints(self, intJunctionLineID = None)->np.array:
         if intJunctionLineID is None:
-            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__JunctionLinesArray.astype('int') != 0)) +np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion) 
+            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__JunctionLinesArray != 0)) +np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion) 
         elif intJunctionLineID in self.__JunctionLineIDs: 
-            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__JunctionLinesArray.astype('int') == intJunctionLineID))+np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion)
+            return np.matmul(np.matmul(self.MergeMeshPoints(np.argwhere(self.__JunctionLinesArray == intJunctionLineID))+np.ones(3)*0.5, self.__InverseScaling), self.__InverseBasisConversion)
         else:
             warnings.warn(str(intJunctionLineID) + ' is an invalid junction line ID')
     def GetJunctionLineIDs(self)->list:
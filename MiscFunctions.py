@@ -1,4 +1,5 @@
 import sys
+import io
 import numpy as np
 from scipy import stats
 from scipy import optimize
@@ -399,6 +400,25 @@ def RelativeError(inValues: np.array, inAbsoluteErrors: np.array):
     arrRelativeErrors = inAbsoluteErrors/inValues
     arrQuadrature = np.sqrt(np.dot(arrRelativeErrors,arrRelativeErrors))
     return arrQuadrature
+def WriteFormattedRows(fOut, strRowFormat: str, arrValues: np.array, intChunkSize = 65536):
+    #writes each row as strRowFormat % tuple(row) like np.savetxt but formats a chunk of rows with one % operation and writes it
+    #with a single call. float64 and integer arrays are converted to python numbers first, which print the same as numpy scalars.
+    blnText = isinstance(fOut, io.TextIOBase)
+    arrValues = np.asarray(arrValues)
+    if arrValues.ndim == 1:
+        arrValues = np.reshape(arrValues, (-1,1))
+    blnConvert = arrValues.dtype == np.float64 or np.issubdtype(arrValues.dtype, np.integer)
+    for i in range(0, len(arrValues), intChunkSize):
+        arrChunk = arrValues[i:i+intChunkSize]
+        if blnConvert:
+            tupValues = tuple(arrChunk.ravel().tolist())
+        else:
+            tupValues = tuple(arrChunk.ravel())
+        strChunk = (strRowFormat*len(arrChunk)) % tupValues
+        if blnText:
+            fOut.write(strChunk)
+        else:
+            fOut.write(strChunk.encode('latin1'))
 
 
 
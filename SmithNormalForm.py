@@ -243,3 +243,198 @@ class GenericCSLandDSC(SmithNormalForm):
         return np.linalg.inv(self.GetLeftMatrix())
     def GetRightCoordinates(self):
         return np.linalg.inv(self.GetRightMatrix())
+#%%
+intInt64Bound = 2**30 #entries below this bound cannot overflow int64 in one reduction step
+def SmithNormalFormStack(arrMatrices: np.array, arrLeft: np.array, arrRight: np.array, intBound = None)->tuple: #reduces a stack of square integer matrices so that left*original*right is the Smith normal form
+    intLength, intSize = np.shape(arrMatrices)[:2]
+    arrOverflow = np.zeros(intLength, dtype=bool) #matrices that stopped because the next step could overflow
+    for k in range(intSize-1):
+        arrActive = np.where(~arrOverflow)[0]
+        while len(arrActive) > 0:
+            intCount = len(arrActive)
+            arrRange = np.arange(intCount)
+            arrA = arrMatrices[arrActive]
+            arrL = arrLeft[arrActive]
+            arrR = arrRight[arrActive]
+            arrAbs = np.reshape(np.abs(arrA[:,k:,k:]),(intCount,-1))
+            arrNonZero = arrAbs != 0
+            arrEmpty = ~np.any(arrNonZero, axis=1) #the rest of the matrix is zero so all later diagonal entries are zero
+            arrPivot = np.argmin(np.where(arrNonZero, arrAbs, np.max(arrAbs)+1), axis=1) #smallest non-zero entry is moved to the pivot
+            arrRows = np.tile(np.arange(intSize), (intCount,1))
+            arrColumns = np.copy(arrRows)
+            arrRows[arrRange, arrPivot // (intSize-k) + k] = k
+            arrRows[:,k] = arrPivot // (intSize-k) + k
+            arrColumns[arrRange, arrPivot % (intSize-k) + k] = k
+            arrColumns[:,k] = arrPivot % (intSize-k) + k
+            arrA = np.take_along_axis(np.take_along_axis(arrA, arrRows[:,:,np.newaxis], axis=1), arrColumns[:,np.newaxis,:], axis=2)
+            arrL = np.take_along_axis(arrL, arrRows[:,:,np.newaxis], axis=1)
+            arrR = np.take_along_axis(arrR, arrColumns[:,np.newaxis,:], axis=2)
+            arrSign = np.where(arrA[:,k,k] < 0, -1, 1)
+            arrA[:,k,:] *= arrSign[:,np.newaxis]
+            arrL[:,k,:] *= arrSign[:,np.newaxis]
+            arrP = np.where(arrEmpty, 1, arrA[:,k,k])[:,np.newaxis]
+            arrSafe = np.ones(intCount, dtype=bool)
+            if intBound is not None:
+                arrSafe = np.maximum(np.max(np.abs(arrA),axis=(1,2)), np.max(np.abs(arrL),axis=(1,2))) < intBound
+            arrQ = (2*arrA[:,k+1:,k] + arrP) // (2*arrP)*arrSafe[:,np.newaxis] #nearest integer quotient so remainders are at most half the pivot
+            arrA[:,k+1:,:] -= arrQ[:,:,np.newaxis]*arrA[:,k:k+1,:]
+            arrL[:,k+1:,:] -= arrQ[:,:,np.newaxis]*arrL[:,k:k+1,:]
+            if intBound is not None:
+                arrSafe = arrSafe & (np.maximum(np.max(np.abs(arrA),axis=(1,2)), np.max(np.abs(arrR),axis=(1,2))) < intBound)
+            arrQ = (2*arrA[:,k,k+1:] + arrP) // (2*arrP)*arrSafe[:,np.newaxis]
+            arrA[:,:,k+1:] -= arrA[:,:,k:k+1]*arrQ[:,np.newaxis,:]
+            arrR[:,:,k+1:] -= arrR[:,:,k:k+1]*arrQ[:,np.newaxis,:]
+            arrClear = np.all(arrA[:,k+1:,k] == 0, axis=1) & np.all(arrA[:,k,k+1:] == 0, axis=1)
+            arrIndivisible = np.any(arrA[:,k+1:,k+1:] % arrP[:,:,np.newaxis] != 0, axis=2)
+            arrAdd = np.where(arrClear & np.any(arrIndivisible, axis=1) & arrSafe)[0] #pivot must divide the rest so add a row it does not divide
+            intRow = k + 1 + np.argmax(arrIndivisible[arrAdd], axis=1)
+            arrA[arrAdd,k,:] += arrA[arrAdd,intRow,:]
+            arrL[arrAdd,k,:] += arrL[arrAdd,intRow,:]
+            arrMatrices[arrActive] = arrA
+            arrLeft[arrActive] = arrL
+            arrRight[arrActive] = arrR
+            arrOverflow[arrActive[~arrSafe]] = True
+            arrDone = arrEmpty | (arrClear & ~np.any(arrIndivisible, axis=1))
+            arrActive = arrActive[~arrDone & arrSafe]
+    arrRows = np.where(~arrOverflow)[0]
+    arrSign = np.where(arrMatrices[arrRows,-1,-1] < 0, -1, 1)
+    arrMatrices[arrRows,-1,:] *= arrSign[:,np.newaxis]
+    arrLeft[arrRows,-1,:] *= arrSign[:,np.newaxis]
+    return arrMatrices, arrLeft, arrRight, arrOverflow
+def BatchSmithNormalForm(inMatrices: np.array)->tuple: #returns D, L, R with L*M*R = D for every matrix M in the stack, if a single matrix could overflow int64 the whole returned stack has object dtype
+    arrMatrices = np.asarray(inMatrices)
+    if np.ndim(arrMatrices) != 3 or np.shape(arrMatrices)[1] != np.shape(arrMatrices)[2]:
+        raise Exception('BatchSmithNormalForm needs a stack of square matrices, not shape ' + str(np.shape(arrMatrices)))
+    intLength, intSize = np.shape(arrMatrices)[:2]
+    fnInteger = np.frompyfunc(int,1,1)
+    arrIdentity = np.tile(np.identity(intSize, dtype='int64'), (intLength,1,1))
+    if arrMatrices.dtype == object:
+        arrLarge = np.ones(intLength, dtype=bool)
+    else:
+        arrMatrices = np.round(arrMatrices)
+        arrLarge = np.max(np.abs(arrMatrices), axis=(1,2), initial=0) >= intInt64Bound
+    arrD = np.where(arrLarge[:,np.newaxis,np.newaxis], 0, arrMatrices).astype('int64')
+    arrD, arrL, arrR, arrOverflow = SmithNormalFormStack(arrD, np.copy(arrIdentity), np.copy(arrIdentity), intInt64Bound)
+    arrOverflow = arrOverflow | arrLarge
+    if np.any(arrOverflow): #exact python integers for the matrices that would overflow int64 so the whole stack is returned as objects
+        arrRows = np.where(arrOverflow)[0]
+        arrD = arrD.astype(object)
+        arrL = arrL.astype(object)
+        arrR = arrR.astype(object)
+        arrD[arrLarge] = fnInteger(arrMatrices[arrLarge])
+        arrL[arrLarge] = arrIdentity[arrLarge].astype(object)
+        arrR[arrLarge] = arrIdentity[arrLarge].astype(object)
+        arrD[arrRows], arrL[arrRows], arrR[arrRows] = SmithNormalFormStack(arrD[arrRows], arrL[arrRows], arrR[arrRows])[:3]
+    return arrD, arrL, arrR
+def UnimodularInverse(arrMatrices: np.array)->np.array: #exact integer inverse of a stack of 3x3 matrices with determinant +-1 as the floating point inverse loses the CSL for large entries
+    arrColumns = np.swapaxes(arrMatrices,1,2)
+    arrAdjugate = np.stack([np.cross(arrColumns[:,1],arrColumns[:,2]), np.cross(arrColumns[:,2],arrColumns[:,0]), np.cross(arrColumns[:,0],arrColumns[:,1])],axis=1)
+    arrDeterminant = np.sum(arrColumns[:,0]*arrAdjugate[:,0],axis=1)
+    return arrAdjugate*arrDeterminant[:,np.newaxis,np.newaxis]
+def BatchExtendedGCD(arrA: np.array, arrB: np.array)->tuple: #returns g, x, y with x*a + y*b = g >= 0 for every pair of integers
+    arrG, arrX, arrY = np.copy(arrA), np.ones_like(arrA), np.zeros_like(arrA)
+    arrR, arrU, arrV = np.copy(arrB), np.zeros_like(arrA), np.ones_like(arrA)
+    arrActive = arrR != 0
+    while np.any(arrActive):
+        arrQ = np.where(arrActive, arrG // np.where(arrActive, arrR, 1), 0)
+        arrG, arrR = np.where(arrActive, arrR, arrG), np.where(arrActive, arrG - arrQ*arrR, arrR)
+        arrX, arrU = np.where(arrActive, arrU, arrX), np.where(arrActive, arrX - arrQ*arrU, arrU)
+        arrY, arrV = np.where(arrActive, arrV, arrY), np.where(arrActive, arrY - arrQ*arrV, arrV)
+        arrActive = arrR != 0
+    arrSign = np.where(arrG < 0, -1, 1)
+    return arrG*arrSign, arrX*arrSign, arrY*arrSign
+def BatchLLL(arrBases: np.array, fltDelta = 0.99, intMaxIter = 100)->np.array: #LLL reduces the columns of a stack of 3x3 integer bases
+    arrBases = np.copy(arrBases)
+    arrActive = np.arange(len(arrBases))
+    for n in range(intMaxIter):
+        arrB = arrBases[arrActive]
+        arrSwapped = np.zeros(len(arrActive), dtype=bool)
+        for k in range(1,3):
+            for j in range(k-1,-1,-1):
+                arrStar = BatchGramSchmidt(arrB.astype(float))
+                arrMu = np.sum(arrB[:,:,k].astype(float)*arrStar[:,:,j],axis=1)/np.sum(arrStar[:,:,j]**2,axis=1)
+                arrB[:,:,k] -= np.round(arrMu).astype('int64').astype(arrB.dtype)[:,np.newaxis]*arrB[:,:,j]
+            arrStar = BatchGramSchmidt(arrB.astype(float))
+            arrNorms = np.sum(arrStar**2,axis=1)
+            arrMu = np.sum(arrB[:,:,k].astype(float)*arrStar[:,:,k-1],axis=1)/arrNorms[:,k-1]
+            arrSwap = np.where(arrNorms[:,k] < (fltDelta - arrMu**2)*arrNorms[:,k-1])[0]
+            arrB[arrSwap,:,k-1], arrB[arrSwap,:,k] = arrB[arrSwap,:,k], arrB[arrSwap,:,k-1]
+            arrSwapped[arrSwap] = True
+        arrBases[arrActive] = arrB
+        arrActive = arrActive[arrSwapped] #a pass without swaps leaves a reduced basis
+        if len(arrActive) == 0:
+            break
+    return arrBases
+def BatchGramSchmidt(arrBases: np.array)->np.array: #orthogonalises the columns of a stack of floating point bases in order
+    arrStar = np.copy(arrBases)
+    for k in range(1,np.shape(arrBases)[2]):
+        for j in range(k):
+            arrStar[:,:,k] -= (np.sum(arrBases[:,:,k]*arrStar[:,:,j],axis=1)/np.sum(arrStar[:,:,j]**2,axis=1))[:,np.newaxis]*arrStar[:,:,j]
+    return arrStar
+def SublatticeBasis(arrCoordinates: np.array, arrFactors: np.array, arrModulus: np.array)->np.array: #LLL reduced basis of the lattice spanned by coordinates*diag(factors), built from its generators modulo a multiple of the factors which the lattice contains
+    arrBasis = arrModulus[:,np.newaxis,np.newaxis]*np.identity(3, dtype='int64') #upper triangular columns as in the Hermite normal form
+    for j in range(3):
+        arrVector = (arrCoordinates[:,:,j] % arrModulus[:,np.newaxis])*arrFactors[:,j:j+1] % arrModulus[:,np.newaxis]
+        for k in range(2,-1,-1):
+            arrG, arrX, arrY = BatchExtendedGCD(arrBasis[:,k,k], arrVector[:,k])
+            arrColumn = arrX[:,np.newaxis]*arrBasis[:,:,k] + arrY[:,np.newaxis]*arrVector
+            arrVector = ((arrVector[:,k] // arrG)[:,np.newaxis]*arrBasis[:,:,k] - (arrBasis[:,k,k] // arrG)[:,np.newaxis]*arrVector) % arrModulus[:,np.newaxis]
+            arrBasis[:,:,k] = arrColumn
+        for k in range(1,3):
+            for i in range(k-1,-1,-1):
+                arrBasis[:,:,k] -= (arrBasis[:,i,k] // arrBasis[:,i,i])[:,np.newaxis]*arrBasis[:,:,i]
+    return BatchLLL(arrBasis)
+def ReduceCoordinates(arrCoordinates: np.array, arrFirst: np.array, arrSecond: np.array)->np.array: #short unimodular coordinates C with C*diag(first) and C*diag(second) spanning the same lattices as before, each factor must divide the next one along the diagonal
+    arrOffsets = np.stack(np.meshgrid([0,1,-1],[0,1,-1],[0,1,-1], indexing='ij'), axis=-1).reshape(-1,3)[1:].T #the candidates are the small combinations of a reduced basis
+    arrFactors = [np.lcm(arrFirst // np.gcd(arrFirst, arrFirst[:,i:i+1]), arrSecond // np.gcd(arrSecond, arrSecond[:,i:i+1])) for i in range(2)] #column i may only use these multiples of the later columns
+    arrModulus = [np.lcm.reduce(arrFactors[i], axis=1) for i in range(2)]
+    strType = 'int64' if max(np.max(arrModulus[0]), np.max(arrModulus[1])) < intInt64Bound else object #only residues are needed so large coordinates need not be objects
+    lstColumns = []
+    arrFound = np.ones(len(arrCoordinates), dtype=bool)
+    for i in range(2):
+        arrBasis = SublatticeBasis((arrCoordinates % arrModulus[i][:,np.newaxis,np.newaxis]).astype(strType), arrFactors[i].astype(strType), arrModulus[i].astype(strType))
+        arrCandidates = np.swapaxes(np.matmul(arrBasis, arrOffsets.astype(strType)),1,2)
+        if i == 0:
+            arrValid = np.gcd.reduce(arrCandidates, axis=2) == 1 #the first column must be primitive
+        else:
+            arrValid = np.gcd.reduce(np.cross(lstColumns[0][:,np.newaxis,:], arrCandidates), axis=2) == 1 #the first two columns must extend to a unimodular matrix
+        arrLengths = np.where(arrValid, np.sum(arrCandidates.astype(float)**2, axis=2), np.inf)
+        arrFound = arrFound & np.any(arrValid, axis=1)
+        lstColumns.append(arrCandidates[np.arange(len(arrCandidates)),np.argmin(arrLengths, axis=1)])
+    arrCross = np.cross(lstColumns[0], lstColumns[1])
+    arrG, arrX, arrY = BatchExtendedGCD(arrCross[:,0], arrCross[:,1])
+    arrG, arrZ, arrW = BatchExtendedGCD(arrG, arrCross[:,2])
+    arrThird = np.stack([arrZ*arrX, arrZ*arrY, arrW], axis=1) #third.(first x second) = 1
+    arrGram = np.stack([np.sum(lstColumns[i].astype(float)*lstColumns[j].astype(float), axis=1) for i in range(2) for j in range(2)], axis=1).reshape(-1,2,2)
+    arrProjection = np.stack([np.sum(arrThird.astype(float)*lstColumns[i].astype(float), axis=1) for i in range(2)], axis=1)
+    arrRound = np.round(np.linalg.solve(np.where(arrFound[:,np.newaxis,np.newaxis], arrGram, np.identity(2)), arrProjection)).astype('int64').astype(strType)
+    arrThird = arrThird - arrRound[:,0:1]*lstColumns[0] - arrRound[:,1:2]*lstColumns[1]
+    arrResidues = (arrCoordinates % 3).astype('int64')
+    arrSign = np.where(np.sum(arrResidues[:,:,0]*np.cross(arrResidues[:,:,1], arrResidues[:,:,2]), axis=1) % 3 == 1, 1, -1).astype(strType) #the determinant is +-1 so its residue keeps the orientation of the original coordinates
+    arrReduced = np.stack([lstColumns[0], lstColumns[1], arrSign[:,np.newaxis]*arrThird], axis=2)
+    if not(np.all(arrFound)): #no short candidate extends to a unimodular matrix so these keep the exact unreduced coordinates
+        arrReduced = np.where(arrFound[:,np.newaxis,np.newaxis], arrReduced.astype(arrCoordinates.dtype), arrCoordinates)
+    return arrReduced
+def BatchCSLandDSC(inTransitions: np.array, inBasis: np.array)->tuple: #GenericCSLandDSC for a stack of transition matrices
+    arrConjugate = np.matmul(np.linalg.inv(inBasis), np.matmul(inTransitions,inBasis))
+    arrDenominators = np.zeros(len(arrConjugate))
+    arrRemaining = np.array(list(range(len(arrConjugate))))
+    n = 0
+    while len(arrRemaining) > 0 and n < 50000:
+        n +=1
+        arrTest = n*arrConjugate[arrRemaining]
+        arrInteger = np.all(np.around(arrTest,0) == np.around(arrTest,10), axis=(1,2))
+        arrDenominators[arrRemaining[arrInteger]] = n
+        arrRemaining = arrRemaining[~arrInteger]
+    arrDenominators[arrRemaining] = n
+    arrD, arrL, arrR = BatchSmithNormalForm(arrDenominators[:,np.newaxis,np.newaxis]*arrConjugate)
+    arrDiagonal = np.abs(np.diagonal(arrD, axis1=1, axis2=2))
+    arrGCD = np.gcd(arrDiagonal, arrDenominators.astype('int64')[:,np.newaxis].astype(arrDiagonal.dtype))
+    arrLeftFactors = arrDiagonal // arrGCD
+    arrRightFactors = arrDenominators.astype('int64')[:,np.newaxis] // arrGCD
+    arrLeftCoordinates = ReduceCoordinates(UnimodularInverse(arrL), arrLeftFactors, arrGCD) #CSL and denominator times the DSC
+    arrRightCoordinates = UnimodularInverse(ReduceCoordinates(arrR[:,:,::-1], arrRightFactors[:,::-1], (arrLeftFactors[:,-1:] // arrLeftFactors)[:,::-1])[:,:,::-1]) #the same lattices before the transition with the factors in reverse order
+    arrLeftScaling = arrLeftFactors.astype(float)[:,:,np.newaxis]*np.identity(len(inBasis))
+    arrRightScaling = arrRightFactors.astype(float)[:,:,np.newaxis]*np.identity(len(inBasis))
+    arrSigma = np.prod(arrLeftFactors.astype(float), axis=1)
+    return arrSigma, arrLeftScaling, arrRightScaling, arrLeftCoordinates.astype(float), arrRightCoordinates.astype(float)